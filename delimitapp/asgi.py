@@ -13,4 +13,15 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'delimitapp.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported after the Django setup
+from qa_line.events import qa_events_app, EVENTS_PATH_REGEX  # noqa: E402
+
+
+async def application(scope, receive, send):
+    """Serve the quality check events streams directly, and everything else through Django"""
+    if scope['type'] == 'http' and EVENTS_PATH_REGEX.match(scope['path']):
+        await qa_events_app(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------------------
+# TERRITORIAL DELIMITATION TOOLS (ICGC)
+# Authors: Fran Martin
+# Version: 1
+# Date: 20210315
+# Version Python: 3.7
+# ----------------------------------------------------------
+
+"""
+Backends of the reference data used by the QA and Municat runs. The 'gpkg' backend reads the snapshots published by
+updatedb, and the 'postgis' backend queries the PostGIS views directly, so the runs check against the current data.
+The backend is selected with the REFERENCE_BACKEND environment variable
+"""
+
+import os
+
+from dotenv import load_dotenv
+
+from delimitapp.common import reference
+from delimitapp.common.geomstore import read_reference_layer
+from delimitapp.common.postgis import PostgisReference
+
+# Load dotenv in order to get the deployment-specific settings
+load_dotenv()
+REFERENCE_BACKEND = os.getenv('REFERENCE_BACKEND', 'gpkg')
+# ogr connection string of the PostGIS backend, as PG:host=... user=... dbname=... password=...
+REFERENCE_PG_CONNECTION = os.getenv('REFERENCE_PG_CONNECTION')
+
+
+class GpkgReference:
+    """Reference data read from the current snapshot of the working geopackage"""
+
+    def __init__(self, gpkg):
+        """
+        :param gpkg: path to the working geopackage. The current snapshot is resolved once, so a refresh during
+                     the run doesn't affect it
+        """
+        self.version, self.gpkg = reference.get_current_snapshot(gpkg)
+
+    def feature_exists(self, layer_name, **filters):
+        return reference.feature_exists(self.gpkg, layer_name, **filters)
+
+    def get_first_row(self, layer_name, columns, **filters):
+        return reference.get_first_row(self.gpkg, layer_name, columns, **filters)
+
+    def read_features(self, layer_name, **filters):
+        return reference.read_features(self.gpkg, layer_name, **filters)
+
+    def read_layer(self, layer_name, bbox=None):
+        return read_reference_layer(self.gpkg, layer_name, bbox=bbox)
+
+
+def get_reference(gpkg, backend=None, pg_connection=None):
+    """
+    Get the reference data backend of a run
+    :param gpkg: path to the working geopackage
+    :param backend: 'gpkg' or 'postgis'. If None, REFERENCE_BACKEND
+    :param pg_connection: ogr connection string of the PostGIS backend. If None, REFERENCE_PG_CONNECTION
+    :return: reference - Reference data backend
+    """
+    backend = backend or REFERENCE_BACKEND
+    gpkg_reference = GpkgReference(gpkg)
+    if backend == 'gpkg':
+        return gpkg_reference
+    elif backend == 'postgis':
+        pg_connection = pg_connection or REFERENCE_PG_CONNECTION
+        if not pg_connection:
+            raise ValueError("No s'ha configurat la connexio a la base de dades de referencia")
+        # The layers without a PostGIS view are read from the geopackage
+        return PostgisReference(pg_connection, fallback=gpkg_reference)
+    raise ValueError(f'Backend de dades de referencia desconegut: {backend}')
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------------------
+# TERRITORIAL DELIMITATION TOOLS (ICGC)
+# Authors: Fran Martin
+# Version: 1
+# Date: 20210315
+# Version Python: 3.7
+# ----------------------------------------------------------
+
+"""
+Cooperative cancellation of the QA and Municat pipelines. The pipelines check a cancellation token at every stage
+and inside their long loops, stopping when the token is cancelled or the stage exceeds its time budget
+"""
+
+import threading
+import time
+
+
+class PipelineCancelled(Exception):
+    """Exception raised when a pipeline is cancelled or a stage exceeds its time budget"""
+
+    def __init__(self, stage, reason):
+        """
+        :param stage: name of the stage that was running
+        :param reason: reason of the cancellation
+        """
+        super().__init__(f"{stage}: {reason}")
+        self.stage = stage
+        self.reason = reason
+
+
+class CancellationToken:
+    """Cancellation token with per-stage time budgets"""
+
+    def __init__(self, budgets=None):
+        """
+        :param budgets: dict with the max seconds of every stage. The 'total' key limits the whole run. The stages
+                        without budget are not limited
+        """
+        self.budgets = budgets or {}
+        self.started_at = time.monotonic()
+        self.stage = None
+        self.stage_started_at = None
+        self._cancelled = threading.Event()
+        self.reason = ''
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self, reason="Procés cancel·lat per l'usuari"):
+        """
+        Cancel the pipeline. It stops at its next check
+        :param reason: reason of the cancellation
+        """
+        self.reason = reason
+        self._cancelled.set()
+
+    def start_stage(self, name):
+        """
+        Start a new stage, checking that the pipeline can continue
+        :param name: stage name. The budgets of the stages prefixed by a line ID, as '1234:export', are taken by
+                     the name after the prefix
+        """
+        # The previous stage has finished, so only the cancellation and the total budget can stop the new one
+        self.stage = name
+        self.stage_started_at = time.monotonic()
+        self.check()
+
+    def check(self):
+        """Raise PipelineCancelled if the pipeline has been cancelled or a time budget has been exceeded"""
+        if self.cancelled:
+            raise PipelineCancelled(self.stage, self.reason)
+        now = time.monotonic()
+        total_budget = self.budgets.get('total')
+        if total_budget is not None and now - self.started_at > total_budget:
+            raise PipelineCancelled(self.stage, f"S'ha superat el temps màxim del procés ({total_budget} s)")
+        if self.stage is not None:
+            stage_budget = self.budgets.get(self.stage.split(':')[-1])
+            if stage_budget is not None and now - self.stage_started_at > stage_budget:
+                raise PipelineCancelled(self.stage, f"S'ha superat el temps màxim de l'etapa ({stage_budget} s)")
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------------------
+# TERRITORIAL DELIMITATION TOOLS (ICGC)
+# Authors: Fran Martin
+# Version: 1
+# Date: 20210315
+# Version Python: 3.7
+# ----------------------------------------------------------
+
+"""
+Columnar snapshots of the reference layers, as GeoParquet files with the geometries encoded as WKB and the bounding
+box of every row. The rows are sorted by line, so the statistics of every row group allow to skip the row groups
+that don't match a filter or a bounding box, and only the requested columns are decoded.
+It requires pyarrow, which is optional. Without it, the snapshots are neither written nor read
+"""
+
+import json
+import os
+import os.path as path
+
+import numpy as np
+import geopandas as gpd
+from shapely import wkb
+
+from delimitapp.common.utils import link_file
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Number of rows of every row group. Smaller row groups skip more rows, at the cost of larger metadata
+ROW_GROUP_SIZE = 8192
+# Columns with the bounding box of every row
+BBOX_COLUMNS = ('minx', 'miny', 'maxx', 'maxy')
+# Columns used to sort the rows, if the layer has them
+SORT_COLUMNS = ('id_linia',)
+GEOPARQUET_VERSION = '0.4.0'
+
+
+def is_available():
+    """Check whether pyarrow is installed"""
+    return pq is not None
+
+
+def get_columnar_path(columnar_dir, layer_name):
+    """Get the path of the columnar snapshot of a layer"""
+    return path.join(columnar_dir, f'{layer_name}.parquet')
+
+
+def write_columnar_layer(gdf, parquet_path):
+    """
+    Write a layer as a GeoParquet file. The file is written with a temporal name and then renamed, so it's never
+    read incomplete
+    :param gdf: geodataframe with the layer
+    :param parquet_path: path to the GeoParquet file
+    """
+    sort_columns = [column for column in SORT_COLUMNS if column in gdf.columns]
+    if sort_columns:
+        gdf = gdf.sort_values(sort_columns, kind='mergesort')
+    bounds = gdf.geometry.bounds
+    df = gdf.drop(columns='geometry').reset_index(drop=True)
+    for column in BBOX_COLUMNS:
+        df[column] = bounds[column].to_numpy()
+    df['geometry'] = [geom.wkb if geom is not None else None for geom in gdf.geometry]
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    geo_metadata = {
+        'version': GEOPARQUET_VERSION,
+        'primary_column': 'geometry',
+        'columns': {
+            'geometry': {
+                'encoding': 'WKB',
+                'crs': gdf.crs.to_wkt() if gdf.crs is not None else None,
+                'geometry_type': sorted(gdf.geom_type.dropna().unique().tolist()),
+                'bbox': list(gdf.total_bounds) if not gdf.empty else None
+            }
+        }
+    }
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'geo': json.dumps(geo_metadata)})
+    temp_path = f'{parquet_path}.tmp'
+    pq.write_table(table, temp_path, row_group_size=ROW_GROUP_SIZE)
+    os.replace(temp_path, parquet_path)
+
+
+def build_columnar(gpkg, columnar_dir, layer_names, previous_dir=None, changed_layers=None):
+    """
+    Write the columnar snapshots of some layers of a geopackage. The layers that haven't changed since the previous
+    snapshot are hard linked from its columnar directory, instead of being written again
+    :param gpkg: path to the geopackage
+    :param columnar_dir: directory of the columnar snapshots
+    :param layer_names: names of the layers
+    :param previous_dir: columnar directory of the previous snapshot, or None to write all the layers
+    :param changed_layers: names of the layers changed since the previous snapshot. If None, all of them have changed
+    :return: boolean that indicates whether the snapshots have been written, False if pyarrow isn't installed
+    """
+    if not is_available():
+        return False
+    os.makedirs(columnar_dir, exist_ok=True)
+    for layer_name in layer_names:
+        parquet_path = get_columnar_path(columnar_dir, layer_name)
+        previous_path = get_columnar_path(previous_dir, layer_name) if previous_dir is not None else None
+        if changed_layers is not None and layer_name not in changed_layers and path.exists(previous_path):
+            link_file(previous_path, parquet_path)
+        else:
+            write_columnar_layer(gpd.read_file(gpkg, layer=layer_name), parquet_path)
+    return True
+
+
+def get_row_group_stats(metadata, row_group, column_positions):
+    """
+    Get the min and max statistics of some columns of a row group
+    :return: stats - Dict with the column name -> (min, max), only for the columns with statistics
+    """
+    stats = {}
+    for column, position in column_positions.items():
+        column_stats = metadata.row_group(row_group).column(position).statistics
+        if column_stats is not None and column_stats.has_min_max:
+            stats[column] = (column_stats.min, column_stats.max)
+    return stats
+
+
+def cast_filters(schema, filters):
+    """
+    Cast the values of the filters to the types of their columns, as the SQL queries over the geopackage do
+    :param schema: pyarrow schema of the layer
+    :param filters: dict with the field -> value to filter by
+    :return: filters - Dict with the field -> value casted
+    """
+    casted = {}
+    for field, value in filters.items():
+        field_type = schema.field(field).type
+        if pa.types.is_integer(field_type):
+            casted[field] = int(value)
+        elif pa.types.is_floating(field_type):
+            casted[field] = float(value)
+        elif pa.types.is_string(field_type):
+            casted[field] = str(value)
+        else:
+            casted[field] = value
+    return casted
+
+
+def select_row_groups(parquet_file, bbox=None, filters=None):
+    """
+    Select the row groups that can have rows matching the bounding box and the filters, by their statistics
+    :param parquet_file: pyarrow ParquetFile
+    :param bbox: tuple with the minx, miny, maxx, maxy to filter by
+    :param filters: dict with the field -> value to filter by
+    :return: row_groups - List with the positions of the row groups
+    """
+    metadata = parquet_file.metadata
+    column_names = parquet_file.schema_arrow.names
+    filters = filters or {}
+    used_columns = list(filters) + (list(BBOX_COLUMNS) if bbox is not None else [])
+    column_positions = {column: column_names.index(column) for column in used_columns}
+    row_groups = []
+    for row_group in range(metadata.num_row_groups):
+        stats = get_row_group_stats(metadata, row_group, column_positions)
+        if any(field in stats and not stats[field][0] <= value <= stats[field][1] for field, value in filters.items()):
+            continue
+        if bbox is not None and all(column in stats for column in BBOX_COLUMNS):
+            minx, miny, maxx, maxy = bbox
+            if stats['minx'][0] > maxx or stats['maxx'][1] < minx or stats['miny'][0] > maxy or stats['maxy'][1] < miny:
+                continue
+        row_groups.append(row_group)
+    return row_groups
+
+
+def read_columnar_layer(parquet_path, columns=None, bbox=None, **filters):
+    """
+    Read a layer from its columnar snapshot, decoding only the columns requested and the row groups that can match
+    :param parquet_path: path to the GeoParquet file
+    :param columns: names of the attribute columns to read. If None, all of them
+    :param bbox: tuple with the minx, miny, maxx, maxy to filter by. If None, the layer is not filtered by location
+    :param filters: field -> value to filter by
+    :return: gdf - Geodataframe with the matching rows
+    """
+    parquet_file = pq.ParquetFile(parquet_path)
+    filters = cast_filters(parquet_file.schema_arrow, filters)
+    geo_metadata = json.loads(parquet_file.schema_arrow.metadata[b'geo'])
+    crs = geo_metadata['columns']['geometry']['crs']
+    if columns is None:
+        columns = [column for column in parquet_file.schema_arrow.names
+                   if column not in BBOX_COLUMNS and column != 'geometry']
+    read_columns = list(dict.fromkeys(list(columns) + list(filters) + list(BBOX_COLUMNS) + ['geometry']))
+    row_groups = select_row_groups(parquet_file, bbox, filters)
+    df = parquet_file.read_row_groups(row_groups, columns=read_columns).to_pandas()
+
+    # The row groups can have rows that don't match, so the rows are filtered too
+    mask = np.ones(len(df), dtype=bool)
+    for field, value in filters.items():
+        mask &= (df[field] == value).to_numpy()
+    if bbox is not None:
+        minx, miny, maxx, maxy = bbox
+        mask &= ((df['minx'] <= maxx) & (df['maxx'] >= minx) & (df['miny'] <= maxy) & (df['maxy'] >= miny)).to_numpy()
+    df = df[mask]
+
+    geometries = gpd.GeoSeries([wkb.loads(value) if value is not None else None for value in df['geometry']],
+                               index=df.index)
+    return gpd.GeoDataFrame(df[list(columns)], geometry=geometries, crs=crs).reset_index(drop=True)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------------------
+# TERRITORIAL DELIMITATION TOOLS (ICGC)
+# Authors: Fran Martin
+# Version: 1
+# Date: 20210315
+# Version Python: 3.7
+# ----------------------------------------------------------
+
+"""
+Coordinate reference systems management. Detects the CRS of the input layers and reprojects them to ETRS89 in bulk,
+transforming all the coordinates of a layer with a single call to a cached pyproj Transformer
+"""
+
+from functools import lru_cache
+
+import numpy as np
+import geopandas as gpd
+from pyproj import CRS, Transformer
+from pyproj.exceptions import CRSError
+from shapely.geometry import (Point, LineString, LinearRing, Polygon, MultiPoint, MultiLineString, MultiPolygon,
+                              GeometryCollection)
+
+TARGET_EPSG = 25831   # ETRS89 / UTM 31N
+ED50_EPSG = 23031   # ED50 / UTM 31N
+TARGET_CRS = f'EPSG:{TARGET_EPSG}'
+
+
+@lru_cache(maxsize=16)
+def get_transformer(src_epsg, dst_epsg=TARGET_EPSG):
+    """
+    Get the transformer between two CRS. The transformers are cached, as creating them is expensive
+    :param src_epsg: EPSG code of the source CRS
+    :param dst_epsg: EPSG code of the destination CRS
+    :return: transformer - pyproj Transformer, with x, y axis order
+    """
+    return Transformer.from_crs(src_epsg, dst_epsg, always_xy=True)
+
+
+def get_epsg(crs):
+    """
+    Get the EPSG code of a CRS, as read from a layer's .prj file
+    :param crs: CRS, as a pyproj CRS, a dict or a string. Can be None if the layer doesn't have .prj file
+    :return: epsg - EPSG code, or None if the CRS is unknown
+    """
+    if not crs:
+        return None
+    try:
+        return CRS.from_user_input(crs).to_epsg(min_confidence=25)
+    except CRSError:
+        return None
+
+
+def get_coords_parts(geom, parts):
+    """
+    Append the coordinates arrays of every part of a geometry to a list, in the order that build_geometry reads them
+    :param geom: shapely geometry
+    :param parts: list where append the coordinates arrays
+    """
+    if geom is None or geom.is_empty:
+        return
+    if isinstance(geom, Polygon):
+        parts.append(np.asarray(geom.exterior.coords))
+        parts.extend(np.asarray(interior.coords) for interior in geom.interiors)
+    elif isinstance(geom, (MultiPoint, MultiLineString, MultiPolygon, GeometryCollection)):
+        for sub_geom in geom:
+            get_coords_parts(sub_geom, parts)
+    else:
+        parts.append(np.asarray(geom.coords))
+
+
+def build_geometry(geom, parts):
+    """
+    Build a geometry like the given one, taking the new coordinates of its parts from an iterator
+    :param geom: original shapely geometry
+    :param parts: iterator of the transformed coordinates arrays
+    :return: new_geom - Shapely geometry with the transformed coordinates
+    """
+    if geom is None or geom.is_empty:
+        return geom
+    if isinstance(geom, Polygon):
+        exterior = next(parts)
+        return Polygon(exterior, [next(parts) for _ in geom.interiors])
+    if isinstance(geom, (MultiPoint, MultiLineString, MultiPolygon, GeometryCollection)):
+        return type(geom)([build_geometry(sub_geom, parts) for sub_geom in geom])
+    if isinstance(geom, Point):
+        return Point(next(parts)[0])
+    if isinstance(geom, LinearRing):
+        return LinearRing(next(parts))
+    return LineString(next(parts))
+
+
+def transform_geometries(geoms, transformer, decimals=None):
+    """
+    Transform a sequence of geometries, gathering all their coordinates into a single array so the transformer is
+    called only once
+    :param geoms: sequence of shapely geometries
+    :param transformer: pyproj Transformer
+    :param decimals: number of decimals to round the transformed XY coordinates to. If None, they are not rounded
+    :return: new_geoms - List of the transformed geometries
+    """
+    parts = []
+    for geom in geoms:
+        get_coords_parts(geom, parts)
+    if not parts:
+        return list(geoms)
+
+    # The Z coordinate, if exists, is kept as is
+    coords = np.concatenate([part[:, :2] for part in parts])
+    x, y = transformer.transform(coords[:, 0], coords[:, 1])
+    if decimals is not None:
+        x, y = np.round(x, decimals), np.round(y, decimals)
+    bounds = np.cumsum([0] + [len(part) for part in parts])
+    new_parts = []
+    for i, part in enumerate(parts):
+        new_part = np.column_stack((x[bounds[i]:bounds[i + 1]], y[bounds[i]:bounds[i + 1]]))
+        if part.shape[1] > 2:
+            new_part = np.column_stack((new_part, part[:, 2:]))
+        new_parts.append(new_part)
+
+    new_parts = iter(new_parts)
+    return [build_geometry(geom, new_parts) for geom in geoms]
+
+
+def reproject_gdf(gdf, dst_epsg=TARGET_EPSG, decimals=None):
+    """
+    Reproject a geodataframe to the destination CRS, if it's not already in it. A geodataframe without CRS is
+    considered to be in the destination CRS
+    :param gdf: geodataframe to reproject
+    :param dst_epsg: EPSG code of the destination CRS
+    :param decimals: number of decimals to round the reprojected XY coordinates to. If None, they are not rounded
+    :return: gdf - Reprojected geodataframe
+    :return: src_epsg - EPSG code of the source CRS, or None if it's unknown
+    """
+    src_epsg = get_epsg(gdf.crs)
+    if src_epsg is not None and src_epsg != dst_epsg and not gdf.empty:
+        gdf = gdf.copy()
+        new_geoms = transform_geometries(list(gdf.geometry), get_transformer(src_epsg, dst_epsg), decimals)
+        gdf[gdf.geometry.name] = gpd.GeoSeries(new_geoms, index=gdf.index)
+    gdf.crs = f'EPSG:{dst_epsg}'
+
+    return gdf, src_epsg
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------------------
+# TERRITORIAL DELIMITATION TOOLS (ICGC)
+# Authors: Fran Martin
+# Version: 1
+# Date: 20210315
+# Version Python: 3.7
+# ----------------------------------------------------------
+
+"""
+Memory-mapped store of the reference geometries. updatedb writes the reference layers of every snapshot as packed
+arrays (coordinates plus offsets, bounds and some columnar attributes) into .npy files, which the workers map
+read-only. The pages are shared by all the processes of the host, instead of every worker loading its own copy
+of the layers
+"""
+
+import json
+import os
+import os.path as path
+import shutil
+from functools import lru_cache
+
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import Point, LineString, MultiPoint, MultiLineString
+
+from delimitapp.common.reference import get_store_dir, get_columnar_layer
+from delimitapp.common.columnar import read_columnar_layer
+from delimitapp.common.utils import link_file
+
+# File with the layers of the store, written last so a store without it is incomplete
+STORE_META = 'meta.json'
+# Packed geometry types -> shapely constructors of the single and multi geometries
+GEOMETRY_TYPES = {
+    'Point': (Point, MultiPoint),
+    'LineString': (LineString, MultiLineString)
+}
+
+
+def get_array_path(store_dir, layer_name, array_name):
+    """Get the path of an array of a layer of the store"""
+    return path.join(store_dir, f'{layer_name}.{array_name}.npy')
+
+
+def pack_geometries(geometries):
+    """
+    Pack the geometries of a layer as flat arrays
+    :param geometries: GeoSeries with points, linestrings or their multi geometries
+    :return: coords - Array with the XY coordinates of all the parts
+    :return: part_offsets - Array with the position of the first coordinate of every part, and the total
+    :return: geom_offsets - Array with the position of the first part of every geometry, and the total
+    :return: bounds - Array with the bounds of every geometry
+    """
+    coords, part_offsets, geom_offsets = [], [0], [0]
+    n_coords = 0
+    for geom in geometries:
+        parts = [] if geom is None or geom.is_empty else getattr(geom, 'geoms', [geom])
+        for part in parts:
+            part_coords = np.asarray(part.coords)[:, :2]
+            coords.append(part_coords)
+            n_coords += len(part_coords)
+            part_offsets.append(n_coords)
+        geom_offsets.append(len(part_offsets) - 1)
+    coords = np.concatenate(coords) if coords else np.empty((0, 2))
+    bounds = np.array([geom.bounds if geom is not None and not geom.is_empty else (np.nan,) * 4
+                       for geom in geometries]).reshape(-1, 4)
+    return coords, np.array(part_offsets, dtype=np.int64), np.array(geom_offsets, dtype=np.int64), bounds
+
+
+def write_store_layer(store_dir, layer_name, gdf, fields):
+    """
+    Write a layer into a store, as packed geometries and the stored attributes
+    :param store_dir: directory of the store
+    :param layer_name: layer name
+    :param gdf: geodataframe with the layer
+    :param fields: attributes to store
+    :return: layer_meta - Dict with the geometry type, CRS and stored attributes of the layer
+    """
+    geom_types = {geom_type.replace('Multi', '') for geom_type in gdf.geom_type.dropna().unique()}
+    if len(geom_types) > 1 or not geom_types <= set(GEOMETRY_TYPES):
+        raise ValueError(f'Tipus de geometria no suportat a la capa {layer_name}: {geom_types}')
+    arrays = dict(zip(('coords', 'part_offsets', 'geom_offsets', 'bounds'), pack_geometries(gdf.geometry)))
+    arrays['is_multi'] = gdf.geom_type.str.startswith('Multi').fillna(False).to_numpy(dtype=bool)
+    for field in fields:
+        values = gdf[field].to_numpy()
+        # Text fields are stored as fixed width unicode, which can be memory-mapped
+        arrays[field] = values.astype(str) if values.dtype == object else values
+    for array_name, array in arrays.items():
+        np.save(get_array_path(store_dir, layer_name, array_name), array)
+    return {
+        'geometry_type': geom_types.pop() if geom_types else 'Point',
+        'crs': gdf.crs.to_wkt() if gdf.crs is not None else None,
+        'fields': list(fields)
+    }
+
+
+def build_store(gpkg, layers, previous_gpkg=None, changed_layers=None):
+    """
+    Build the store of a snapshot of the working geopackage. The layers that haven't changed since the previous
+    snapshot are hard linked from its store, instead of being read and packed again
+    :param gpkg: path to the snapshot
+    :param layers: dict with the layer name -> attributes to store of every layer
+    :param previous_gpkg: path to the previous snapshot, or None to build all the layers
+    :param changed_layers: names of the layers changed since the previous snapshot. If None, all of them have changed
+    """
+    store_dir = get_store_dir(gpkg)
+    shutil.rmtree(store_dir, ignore_errors=True)
+    os.makedirs(store_dir)
+    previous_meta = {}
+    if previous_gpkg is not None and changed_layers is not None:
+        try:
+            with open(path.join(get_store_dir(previous_gpkg), STORE_META)) as f:
+                previous_meta = json.load(f)
+        except (OSError, ValueError):
+            pass
+    meta = {}
+    for layer_name, fields in layers.items():
+        layer_meta = previous_meta.get(layer_name)
+        if layer_meta is not None and layer_name not in changed_layers and layer_meta['fields'] == list(fields):
+            for array_name in ['coords', 'part_offsets', 'geom_offsets', 'bounds', 'is_multi'] + layer_meta['fields']:
+                link_file(get_array_path(get_store_dir(previous_gpkg), layer_name, array_name),
+                          get_array_path(store_dir, layer_name, array_name))
+            meta[layer_name] = layer_meta
+        else:
+            meta[layer_name] = write_store_layer(store_dir, layer_name, gpd.read_file(gpkg, layer=layer_name), fields)
+    with open(path.join(store_dir, STORE_META), 'w') as f:
+        json.dump(meta, f)
+
+
+class ReferenceStore:
+    """Read-only view of the store of a snapshot. The arrays are memory-mapped, so they are read only when used"""
+
+    def __init__(self, store_dir):
+        """
+        :param store_dir: directory of the store
+        """
+        with open(path.join(store_dir, STORE_META)) as f:
+            self.meta = json.load(f)
+        self.arrays = {}
+        for layer_name, layer_meta in self.meta.items():
+            array_names = ['coords', 'part_offsets', 'geom_offsets', 'bounds', 'is_multi'] + layer_meta['fields']
+            self.arrays[layer_name] = {
+                array_name: np.load(get_array_path(store_dir, layer_name, array_name), mmap_mode='r')
+                for array_name in array_names
+            }
+
+    def has_layer(self, layer_name):
+        return layer_name in self.meta
+
+    def query(self, layer_name, bbox=None, **filters):
+        """
+        Get the features of a layer that intersect a bounding box and match the filters. The candidates are selected
+        over the packed bounds and attributes, and only their geometries are built
+        :param layer_name: layer name
+        :param bbox: tuple with the minx, miny, maxx, maxy to filter by. If None, the layer is not filtered by location
+        :param filters: field -> value to filter by, for the stored attributes
+        :return: gdf - Geodataframe with the stored attributes of the matching features
+        """
+        arrays = self.arrays[layer_name]
+        layer_meta = self.meta[layer_name]
+        mask = np.ones(len(arrays['bounds']), dtype=bool)
+        if bbox is not None:
+            bounds = arrays['bounds']
+            minx, miny, maxx, maxy = bbox
+            mask &= (bounds[:, 0] <= maxx) & (bounds[:, 2] >= minx) & (bounds[:, 1] <= maxy) & (bounds[:, 3] >= miny)
+        for field, value in filters.items():
+            mask &= arrays[field] == value
+        positions = np.flatnonzero(mask)
+
+        single, multi = GEOMETRY_TYPES[layer_meta['geometry_type']]
+        coords, part_offsets, geom_offsets = arrays['coords'], arrays['part_offsets'], arrays['geom_offsets']
+        geometries = []
+        for position in positions:
+            first_part, last_part = geom_offsets[position], geom_offsets[position + 1]
+            if single is Point:
+                parts = [Point(coords[part_offsets[i]]) for i in range(first_part, last_part)]
+            else:
+                parts = [single(coords[part_offsets[i]:part_offsets[i + 1]]) for i in range(first_part, last_part)]
+            if not parts:
+                geometries.append(None)
+            else:
+                geometries.append(multi(parts) if arrays['is_multi'][position] else parts[0])
+
+        data = {field: np.asarray(arrays[field][positions]) for field in layer_meta['fields']}
+        return gpd.GeoDataFrame(data, geometry=gpd.GeoSeries(geometries), crs=layer_meta['crs'])
+
+
+@lru_cache(maxsize=4)
+def open_store(gpkg):
+    """
+    Open the store of a snapshot. The stores are cached by every process, so the arrays are mapped only once
+    :param gpkg: path to the snapshot
+    :return: store - ReferenceStore, or None if the snapshot has no store
+    """
+    store_dir = get_store_dir(gpkg)
+    if not path.exists(path.join(store_dir, STORE_META)):
+        return None
+    return ReferenceStore(store_dir)
+
+
+def read_reference_layer(gpkg, layer_name, bbox=None):
+    """
+    Read a reference layer from the store of its snapshot. If the snapshot has no store, the layer is read from its
+    columnar snapshot, and from the snapshot itself as the last resort
+    :param gpkg: path to the snapshot
+    :param layer_name: layer name
+    :param bbox: tuple with the minx, miny, maxx, maxy to filter by. If None, the whole layer is read
+    :return: gdf - Geodataframe with the layer's features
+    """
+    store = open_store(gpkg)
+    if store is not None and store.has_layer(layer_name):
+        return store.query(layer_name, bbox=bbox)
+    parquet_path = get_columnar_layer(gpkg, layer_name)
+    if parquet_path is not None:
+        return read_columnar_layer(parquet_path, bbox=bbox)
+    return gpd.read_file(gpkg, layer=layer_name, bbox=bbox)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------------------
+# TERRITORIAL DELIMITATION TOOLS (ICGC)
+# Authors: Fran Martin
+# Version: 1
+# Date: 20210315
+# Version Python: 3.7
+# ----------------------------------------------------------
+
+"""
+Batched and transactional writer of geopackages. The writer holds a single GDAL dataset handle for the whole job,
+writes many layers in a single transaction and does the cleanup with the same handle, instead of opening, syncing and
+closing the geopackage for every layer written
+"""
+
+import os.path as path
+
+import numpy as np
+import pandas as pd
+from osgeo import gdal, ogr, osr
+
+# Journal mode of the workspaces. With WAL the commits don't rewrite the database file, and the readers don't block
+# the writer
+JOURNAL_MODE = 'WAL'
+# With WAL, NORMAL synchronous only syncs at the checkpoints, which is safe for scratch data
+SYNCHRONOUS = 'NORMAL'
+# Pandas dtype kind -> OGR field type
+FIELD_TYPES = {
+    'i': ogr.OFTInteger64,
+    'u': ogr.OFTInteger64,
+    'f': ogr.OFTReal,
+    'b': ogr.OFTInteger,
+    'M': ogr.OFTDateTime
+}
+
+
+def get_field_value(value):
+    """
+    Convert a dataframe value to the value set into an OGR field
+    :param value: value of a dataframe cell
+    :return: value - Python value, or None if the value is null
+    """
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, bool):
+        return int(value)
+    if hasattr(value, 'isoformat'):   # Dates and datetimes
+        return value.isoformat()
+    return value
+
+
+def get_geometry_type(gdf):
+    """
+    Get the OGR geometry type of a geodataframe's layer
+    :param gdf: geodataframe, or dataframe without geometries
+    :return: geometry_type - OGR geometry type. wkbNone if the dataframe has no geometries, and wkbUnknown if
+                             they are of mixed types
+    """
+    geometries = gdf.geometry.dropna() if 'geometry' in gdf.columns else []
+    if len(geometries) == 0:
+        return ogr.wkbNone
+    geometry_types = {ogr.CreateGeometryFromWkb(geom.wkb).GetGeometryType() for geom in geometries}
+    return geometry_types.pop() if len(geometry_types) == 1 else ogr.wkbUnknown
+
+
+class GpkgWriter:
+    """Writer of a geopackage, with a single dataset handle that is reused by all the writes and the cleanup"""
+
+    def __init__(self, gpkg, journal_mode=JOURNAL_MODE, synchronous=SYNCHRONOUS):
+        """
+        :param gpkg: path to the geopackage. It's created if doesn't exist
+        :param journal_mode: SQLite journal mode of the geopackage, or None to keep its current one
+        :param synchronous: SQLite synchronous setting of the handle
+        """
+        self.gpkg = gpkg
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self._ds = None
+
+    @property
+    def ds(self):
+        """GDAL dataset handle, opened the first time it's used"""
+        if self._ds is None:
+            if path.exists(self.gpkg):
+                self._ds = gdal.OpenEx(self.gpkg, gdal.OF_VECTOR | gdal.OF_UPDATE, allowed_drivers=['GPKG'])
+            else:
+                self._ds = gdal.GetDriverByName('GPKG').Create(self.gpkg, 0, 0, 0, gdal.GDT_Unknown)
+            if self._ds is None:
+                raise IOError(f"No s'ha pogut obrir el geopackage {self.gpkg}")
+            if self.journal_mode:
+                self.execute(f'PRAGMA journal_mode={self.journal_mode}')
+            self.execute(f'PRAGMA synchronous={self.synchronous}')
+        return self._ds
+
+    def execute(self, sql):
+        """
+        Execute a SQL statement that doesn't return rows
+        :param sql: SQL statement
+        """
+        result = self.ds.ExecuteSQL(sql)
+        if result is not None:
+            self.ds.ReleaseResultSet(result)
+
+    def query(self, sql):
+        """
+        Execute a SQL query
+        :param sql: SQL query
+        :return: rows - List with a tuple of the fields of every row
+        """
+        result = self.ds.ExecuteSQL(sql)
+        if result is None:
+            return []
+        rows = [tuple(feature.GetField(i) for i in range(feature.GetFieldCount())) for feature in result]
+        self.ds.ReleaseResultSet(result)
+        return rows
+
+    def get_layer_names(self):
+        """Get the names of the geopackage's layers"""
+        return [self.ds.GetLayerByIndex(i).GetName() for i in range(self.ds.GetLayerCount())]
+
+    def write_layers(self, layers):
+        """
+        Write some layers into the geopackage in a single transaction, overwriting them if they already exist
+        :param layers: dict with the layer name -> geodataframe or dataframe of every layer
+        """
+        self.ds.StartTransaction()
+        try:
+            for layer_name, gdf in layers.items():
+                self.write_layer(layer_name, gdf)
+            self.ds.CommitTransaction()
+        except Exception:
+            self.ds.RollbackTransaction()
+            raise
+
+    def write_layer(self, layer_name, gdf):
+        """
+        Write a layer into the geopackage, overwriting it if it already exists. It doesn't manage any transaction,
+        so it must be called by write_layers
+        :param layer_name: layer name
+        :param gdf: geodataframe or dataframe with the layer's features
+        """
+        self.delete_layer(layer_name)
+        srs = None
+        if getattr(gdf, 'crs', None) is not None:
+            srs = osr.SpatialReference()
+            srs.ImportFromWkt(gdf.crs.to_wkt())
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        geometry_type = get_geometry_type(gdf)
+        layer = self.ds.CreateLayer(layer_name, srs=srs, geom_type=geometry_type)
+        if layer is None:
+            raise IOError(f"No s'ha pogut crear la capa {layer_name}")
+
+        columns = [column for column in gdf.columns if column != 'geometry']
+        for column in columns:
+            layer.CreateField(ogr.FieldDefn(column, FIELD_TYPES.get(gdf[column].dtype.kind, ogr.OFTString)))
+        layer_defn = layer.GetLayerDefn()
+        geometries = gdf.geometry if geometry_type != ogr.wkbNone else [None] * len(gdf)
+        for values, geom in zip(gdf[columns].itertuples(index=False, name=None), geometries):
+            feature = ogr.Feature(layer_defn)
+            for i, value in enumerate(values):
+                value = get_field_value(value)
+                if value is None:
+                    feature.SetFieldNull(i)
+                else:
+                    feature.SetField(i, value)
+            if geom is not None and not geom.is_empty:
+                feature.SetGeometry(ogr.CreateGeometryFromWkb(geom.wkb))
+            layer.CreateFeature(feature)
+
+    def delete_layer(self, layer_name):
+        """
+        Delete a layer of the geopackage, if exists
+        :param layer_name: layer name
+        """
+        for i in range(self.ds.GetLayerCount()):
+            if self.ds.GetLayerByIndex(i).GetName() == layer_name:
+                self.ds.DeleteLayer(i)
+                return
+
+    def drop_layers(self, keep=()):
+        """
+        Delete all the layers of the geopackage, in a single transaction
+        :param keep: names of the layers to keep
+        """
+        self.ds.StartTransaction()
+        try:
+            for layer_name in self.get_layer_names():
+                if layer_name not in keep:
+                    self.delete_layer(layer_name)
+            self.ds.CommitTransaction()
+        except Exception:
+            self.ds.RollbackTransaction()
+            raise
+
+    def close(self):
+        """Close the dataset handle. With WAL, the last connection checkpoints the changes into the database file"""
+        if self._ds is not None:
+            self._ds.FlushCache()
+            self._ds = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------------------
+# TERRITORIAL DELIMITATION TOOLS (ICGC)
+# Authors: Fran Martin
+# Version: 1
+# Date: 20210315
+# Version Python: 3.7
+# ----------------------------------------------------------
+
+"""
+Wall time and memory metrics of every stage of the QA and Municat pipelines. The memory is measured as the process
+RSS, sampled by a background thread during every stage in order to get its peak, when it's available. Only if
+TRACE_MEMORY is enabled, the memory allocated by Python is measured too with tracemalloc. Both measures are
+process-wide, so concurrent runs in the same process share them.
+The metrics of every run are written into METRICS_DIR, shared by all the processes, so the metrics endpoint reports
+the runs of every worker
+"""
+
+from datetime import datetime
+import glob
+import json
+import os
+import os.path as path
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+
+# Track the memory allocations with tracemalloc. It slows down the whole process, so it's only enabled by setting the
+# DELIMITAPP_TRACE_MEMORY environment variable to 1
+TRACE_MEMORY = os.environ.get('DELIMITAPP_TRACE_MEMORY') == '1'
+# The tracemalloc peak can only be reset by stage from Python 3.9. Before, the traced peak of a stage is not
+# measured, as clearing the traces would spoil the measures of the other runs. The RSS peak is always measured
+RESET_PEAK = hasattr(tracemalloc, 'reset_peak')
+# Seconds between the RSS samples of a stage
+RSS_SAMPLE_INTERVAL = 0.05
+# Directory with the metrics of the recent runs of all the processes
+METRICS_DIR = os.environ.get('DELIMITAPP_METRICS_DIR', path.join(tempfile.gettempdir(), 'delimitapp_metrics'))
+# Number of runs kept for the metrics endpoint
+RECENT_RUNS = 200
+
+MB = 1024 * 1024
+
+
+def get_rss():
+    """
+    Get the resident set size of the process, only where /proc is available
+    :return: rss - Resident memory in bytes, or None if not available
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class RssSampler(threading.Thread):
+    """Background thread that samples the process RSS and keeps its peak, until it's stopped"""
+
+    def __init__(self, start_rss):
+        """
+        :param start_rss: RSS at the start of the stage, in bytes
+        """
+        super().__init__(daemon=True)
+        self.peak = start_rss
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(RSS_SAMPLE_INTERVAL):
+            self.sample()
+
+    def sample(self):
+        """Sample the RSS and update the peak"""
+        rss = get_rss()
+        if rss is not None and rss > self.peak:
+            self.peak = rss
+
+    def stop(self):
+        """
+        Stop sampling
+        :return: peak - Peak RSS of the stage, in bytes
+        """
+        self.stop_event.set()
+        self.join()
+        self.sample()
+        return self.peak
+
+
+class StageMetrics:
+    """Records the wall time and the peak and retained memory of every stage of a run"""
+
+    def __init__(self, process, run_name):
+        """
+        :param process: name of the process, as 'qa_line' or 'municat'
+        :param run_name: name of the run, as the line ID
+        """
+        self.process = process
+        self.run_name = run_name
+        self.started_at = datetime.now().isoformat(timespec='seconds')
+        self.stages = []
+        self.current_stage = None
+        self.stage_start = None
+        self.stage_start_memory = 0
+        self.stage_start_rss = None
+        self.rss_sampler = None
+        if TRACE_MEMORY and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def start_stage(self, name):
+        """
+        Start a new stage, finishing the current one if exists
+        :param name: stage name
+        """
+        self.end_stage()
+        self.current_stage = name
+        if tracemalloc.is_tracing():
+            if RESET_PEAK:
+                tracemalloc.reset_peak()
+            self.stage_start_memory = tracemalloc.get_traced_memory()[0]
+        self.stage_start_rss = get_rss()
+        if self.stage_start_rss is not None:
+            self.rss_sampler = RssSampler(self.stage_start_rss)
+            self.rss_sampler.start()
+        self.stage_start = time.perf_counter()
+
+    def end_stage(self):
+        """Finish the current stage, if exists, and record its metrics"""
+        if self.current_stage is None:
+            return
+        stage = {'stage': self.current_stage, 'seconds': round(time.perf_counter() - self.stage_start, 4)}
+        if self.rss_sampler is not None:
+            peak_rss = self.rss_sampler.stop()
+            self.rss_sampler = None
+            rss = get_rss() or self.stage_start_rss
+            stage['rss_mb'] = round(rss / MB, 2)
+            stage['peak_rss_mb'] = round(peak_rss / MB, 2)
+            # Memory growth of the process at the peak of the stage and at its end
+            stage['peak_mb'] = round((peak_rss - self.stage_start_rss) / MB, 2)
+            stage['retained_mb'] = round((rss - self.stage_start_rss) / MB, 2)
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if RESET_PEAK:
+                stage['traced_peak_mb'] = round((peak - self.stage_start_memory) / MB, 2)
+            stage['traced_retained_mb'] = round((current - self.stage_start_memory) / MB, 2)
+        self.stages.append(stage)
+        self.current_stage = None
+
+    def finish(self, sidecar_path=None):
+        """
+        Finish the run, writing its metrics into the sidecar file and into METRICS_DIR for the metrics endpoint
+        :param sidecar_path: path of the JSON sidecar file, next to the run's log
+        """
+        self.end_stage()
+        metrics = self.to_dict()
+        if sidecar_path:
+            try:
+                with open(sidecar_path, 'w') as f:
+                    json.dump(metrics, f, indent=2)
+            except OSError:
+                pass
+        save_run_metrics(metrics)
+
+    def to_dict(self):
+        """Run's metrics as a dict"""
+        return {
+            'process': self.process,
+            'run': self.run_name,
+            'started_at': self.started_at,
+            'seconds': round(sum(stage['seconds'] for stage in self.stages), 4),
+            'peak_mb': max((stage.get('peak_mb', 0) for stage in self.stages), default=0),
+            'max_rss_mb': max((stage.get('peak_rss_mb', 0) for stage in self.stages), default=0),
+            'stages': self.stages
+        }
+
+
+def get_sidecar_path(log_path):
+    """
+    Get the path of the metrics sidecar file of a run's log
+    :param log_path: path of the run's log
+    :return: sidecar_path - Path of the sidecar file, or None if the run doesn't have log
+    """
+    return f'{path.splitext(log_path)[0]}.metrics.json' if log_path else None
+
+
+def get_metrics_paths():
+    """Get the paths of the runs' metrics files in METRICS_DIR, from the oldest to the newest"""
+    # The file names start with the finish time, so they sort by age
+    return sorted(glob.glob(path.join(glob.escape(METRICS_DIR), '*.json')))
+
+
+def save_run_metrics(metrics):
+    """
+    Write the metrics of a run into METRICS_DIR, and remove the ones older than the last RECENT_RUNS. The file is
+    written with a temporal name and then renamed, so it's never read incomplete
+    :param metrics: dict with the run's metrics
+    """
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        metrics_path = path.join(METRICS_DIR, f"{datetime.now().strftime('%Y%m%d%H%M%S%f')}-{uuid.uuid4().hex[:8]}.json")
+        with open(f'{metrics_path}.tmp', 'w') as f:
+            json.dump(metrics, f)
+        os.replace(f'{metrics_path}.tmp', metrics_path)
+    except OSError:   # The metrics never stop a run
+        return
+    for old_path in get_metrics_paths()[:-RECENT_RUNS]:
+        try:
+            os.remove(old_path)
+        except OSError:   # Removed by another process
+            continue
+
+
+def get_recent_metrics():
+    """
+    Get the metrics of the recent runs of all the processes and a summary of every stage, with its mean and max time
+    and peak memory
+    :return: metrics - Dict with the recent runs and the stages summary by process
+    """
+    runs = []
+    for metrics_path in get_metrics_paths()[-RECENT_RUNS:]:
+        try:
+            with open(metrics_path) as f:
+                runs.append(json.load(f))
+        except (OSError, ValueError):   # Removed by another process
+            continue
+    summary = {}
+    for run in runs:
+        for stage in run['stages']:
+            # Municat stages are prefixed by the line ID
+            stage_name = stage['stage'].split(':')[-1]
+            item = summary.setdefault(run['process'], {}).setdefault(stage_name, {
+                'count': 0, 'mean_seconds': 0, 'max_seconds': 0, 'mean_peak_mb': 0, 'max_peak_mb': 0,
+                'mean_retained_mb': 0, 'max_rss_mb': 0})
+            item['count'] += 1
+            item['mean_seconds'] += (stage['seconds'] - item['mean_seconds']) / item['count']
+            item['max_seconds'] = max(item['max_seconds'], stage['seconds'])
+            peak = stage.get('peak_mb', 0)
+            item['mean_peak_mb'] += (peak - item['mean_peak_mb']) / item['count']
+            item['max_peak_mb'] = max(item['max_peak_mb'], peak)
+            item['mean_retained_mb'] += (stage.get('retained_mb', 0) - item['mean_retained_mb']) / item['count']
+            item['max_rss_mb'] = max(item['max_rss_mb'], stage.get('peak_rss_mb', 0))
+
+    return {'stages': summary, 'runs': runs}
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------------------
+# TERRITORIAL DELIMITATION TOOLS (ICGC)
+# Authors: Fran Martin
+# Version: 1
+# Date: 20210315
+# Version Python: 3.7
+# ----------------------------------------------------------
+
+"""
+Reference data read directly from the PostGIS views, as an alternative to the geopackage snapshots refreshed by
+updatedb. The connections are pooled by every process, the line, session and bounding box filters are sent to the
+database as SQL, and the features are fetched with a server-side cursor in batches
+"""
+
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+import json
+import queue
+
+import pandas as pd
+import geopandas as gpd
+from osgeo import gdal, ogr
+
+# Reference layers -> PostGIS views
+REFERENCE_VIEWS = {
+    'fita_mem': 'sidm3.v_fita_mem',
+    'tram_linia_mem': 'sidm3.v_tram_linia_mem',
+    'fita_rep': 'sidm3.v_fita_rep',
+    'tram_linia_rep': 'sidm3.v_tram_linia_rep'
+}
+# Number of connections of every process
+POOL_SIZE = 4
+# Seconds waiting for a free connection
+POOL_TIMEOUT = 60
+# Number of features fetched from the server-side cursor at once
+FETCH_BATCH_SIZE = 5000
+
+
+class ConnectionPool:
+    """Pool of ogr PostGIS connections. The connections are opened when they are used the first time"""
+
+    def __init__(self, conn_string, size=POOL_SIZE):
+        """
+        :param conn_string: ogr PostGIS connection string, as PG:host=... user=... dbname=... password=...
+        :param size: number of connections
+        """
+        self.conn_string = conn_string
+        self._connections = queue.LifoQueue()
+        for _ in range(size):
+            self._connections.put(None)
+
+    @contextmanager
+    def connection(self):
+        """Take a connection from the pool, giving it back when done. A connection that fails is reopened"""
+        try:
+            ds = self._connections.get(timeout=POOL_TIMEOUT)
+        except queue.Empty:
+            raise IOError('No hi ha cap connexio lliure a la base de dades')
+        try:
+            if ds is None:
+                # The page size of the cursor is taken when the connection is opened
+                gdal.SetConfigOption('OGR_PG_CURSOR_PAGE', str(FETCH_BATCH_SIZE))
+                ds = ogr.Open(self.conn_string)
+                if ds is None:
+                    raise IOError("No s'ha pogut connectar a la base de dades")
+            yield ds
+        except Exception:
+            ds = None
+            raise
+        finally:
+            self._connections.put(ds)
+
+
+@lru_cache(maxsize=None)
+def get_pool(conn_string):
+    """Get the connection pool of a database, shared by all the threads of the process"""
+    return ConnectionPool(conn_string)
+
+
+def get_sql_literal(value):
+    """Get the SQL literal of a filter's value"""
+    if isinstance(value, (int, float)):
+        return str(value)
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def get_sql_where(filters):
+    """
+    Get the WHERE clause of equality filters
+    :param filters: dict with the field -> value to filter by
+    :return: where - WHERE clause
+    """
+    return ' AND '.join(f'{field} = {get_sql_literal(value)}' for field, value in filters.items())
+
+
+def get_layer_info(layer):
+    """
+    Get the fields and CRS of an ogr layer
+    :return: columns - List with the fields' names
+    :return: crs - WKT of the layer's CRS, or None if it hasn't
+    """
+    layer_defn = layer.GetLayerDefn()
+    columns = [layer_defn.GetFieldDefn(i).GetName() for i in range(layer_defn.GetFieldCount())]
+    spatial_ref = layer.GetSpatialRef()
+    return columns, spatial_ref.ExportToWkt() if spatial_ref is not None else None
+
+
+class PostgisReference:
+    """
+    Reference data read from the PostGIS views. The layers without a view, as id_linia_muni, are read from the
+    fallback reference
+    """
+
+    def __init__(self, conn_string, fallback):
+        """
+        :param conn_string: ogr PostGIS connection string
+        :param fallback: reference used for the layers without a view
+        """
+        self.pool = get_pool(conn_string)
+        self.fallback = fallback
+        # The data is read live, so the version is the time the run started
+        self.version = f"postgis:{datetime.now().strftime('%Y%m%d%H%M%S')}"
+
+    def feature_exists(self, layer_name, **filters):
+        """
+        Check if any feature of a layer matches the filters
+        :param layer_name: layer name
+        :param filters: field -> value to filter by
+        :return: boolean that indicates whether any feature matches
+        """
+        if layer_name not in REFERENCE_VIEWS:
+            return self.fallback.feature_exists(layer_name, **filters)
+        return bool(self.query(f'SELECT 1 FROM {REFERENCE_VIEWS[layer_name]} WHERE {get_sql_where(filters)} LIMIT 1'))
+
+    def get_first_row(self, layer_name, columns, **filters):
+        """
+        Get some columns of the first row of a layer that matches the filters
+        :param layer_name: layer name
+        :param columns: names of the columns to get
+        :param filters: field -> value to filter by
+        :return: row - Tuple with the columns' values, or None if no row matches
+        """
+        if layer_name not in REFERENCE_VIEWS:
+            return self.fallback.get_first_row(layer_name, columns, **filters)
+        rows = self.query(f'SELECT {", ".join(columns)} FROM {REFERENCE_VIEWS[layer_name]} '
+                          f'WHERE {get_sql_where(filters)} LIMIT 1')
+        return rows[0] if rows else None
+
+    def query(self, sql):
+        """
+        Execute a SQL query
+        :param sql: SQL query
+        :return: rows - List with a tuple of the fields of every row
+        """
+        with self.pool.connection() as ds:
+            result = ds.ExecuteSQL(sql)
+            if result is None:
+                return []
+            rows = [tuple(feature.GetField(i) for i in range(feature.GetFieldCount())) for feature in result]
+            ds.ReleaseResultSet(result)
+            return rows
+
+    def iter_features(self, layer_name, bbox=None, batch_size=FETCH_BATCH_SIZE, **filters):
+        """
+        Iterate over the features of a view that intersect a bounding box and match the filters, in batches. The
+        filters are sent to the database, which returns the features through a server-side cursor
+        :param layer_name: layer name
+        :param bbox: tuple with the minx, miny, maxx, maxy to filter by. If None, the layer is not filtered by location
+        :param batch_size: number of features of every batch
+        :param filters: field -> value to filter by
+        :return: gdf - Geodataframe with a batch of features
+        """
+        with self.pool.connection() as ds:
+            layer = ds.GetLayerByName(REFERENCE_VIEWS[layer_name])
+            columns, crs = get_layer_info(layer)
+            layer.SetAttributeFilter(get_sql_where(filters) if filters else None)
+            if bbox is not None:
+                layer.SetSpatialFilterRect(*bbox)
+            layer.ResetReading()
+            try:
+                features = []
+                for feature in layer:
+                    features.append(json.loads(feature.ExportToJson()))
+                    if len(features) == batch_size:
+                        yield gpd.GeoDataFrame.from_features(features, crs=crs)[columns + ['geometry']]
+                        features = []
+                if features:
+                    yield gpd.GeoDataFrame.from_features(features, crs=crs)[columns + ['geometry']]
+            finally:
+                # The connection is reused, so its layer can't keep the filters
+                layer.SetAttributeFilter(None)
+                layer.SetSpatialFilter(None)
+
+    def read_features(self, layer_name, bbox=None, **filters):
+        """
+        Read the features of a layer that intersect a bounding box and match the filters
+        :param layer_name: layer name
+        :param bbox: tuple with the minx, miny, maxx, maxy to filter by. If None, the layer is not filtered by location
+        :param filters: field -> value to filter by
+        :return: gdf - Geodataframe with the matching features
+        """
+        if layer_name not in REFERENCE_VIEWS:
+            return self.fallback.read_features(layer_name, **filters)
+        batches = list(self.iter_features(layer_name, bbox=bbox, **filters))
+        if not batches:
+            with self.pool.connection() as ds:
+                columns, crs = get_layer_info(ds.GetLayerByName(REFERENCE_VIEWS[layer_name]))
+            return gpd.GeoDataFrame(columns=columns + ['geometry'], geometry='geometry', crs=crs)
+        return gpd.GeoDataFrame(pd.concat(batches, ignore_index=True), crs=batches[0].crs)
+
+    def read_layer(self, layer_name, bbox=None):
+        """
+        Read a reference layer, or only its features that intersect a bounding box
+        :param layer_name: layer name
+        :param bbox: tuple with the minx, miny, maxx, maxy to filter by. If None, the whole layer is read
+        :return: gdf - Geodataframe with the layer's features
+        """
+        if layer_name not in REFERENCE_VIEWS:
+            return self.fallback.read_layer(layer_name, bbox=bbox)
+        return self.read_features(layer_name, bbox=bbox)
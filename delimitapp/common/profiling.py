@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------------------
+# TERRITORIAL DELIMITATION TOOLS (ICGC)
+# Authors: Fran Martin
+# Version: 1
+# Date: 20210315
+# Version Python: 3.7
+# ----------------------------------------------------------
+
+"""
+On-demand profiling of the heavy views. A staff user can profile a single request adding profile=1 to its query
+string. The profile is saved as a pstats dump, that can be opened with snakeviz or flameprof, and a JSON with the
+wall time breakdown and the GDAL and fiona call counts.
+"""
+
+from datetime import datetime
+import cProfile
+import functools
+import json
+import os
+import os.path as path
+import pstats
+import tempfile
+import time
+
+from django.http import HttpRequest
+
+# Query string parameter that enables the profiling
+PROFILE_PARAM = 'profile'
+# Modules whose calls are counted as GDAL and fiona calls
+IO_MODULES = ('fiona', 'osgeo', path.join('geopandas', 'io'))
+
+
+def profiling_requested(request):
+    """
+    Check whether the request asks to be profiled and the user is allowed to
+    :param request: Http request
+    :return: boolean that indicates if the request must be profiled
+    """
+    user = getattr(request, 'user', None)
+    return request.GET.get(PROFILE_PARAM) == '1' and user is not None and user.is_authenticated and user.is_staff
+
+
+def get_wall_time_breakdown(stats, entry):
+    """
+    Get the cumulative time of every function directly called by the entry function
+    :param stats: pstats.Stats of the request
+    :param entry: tuple with the filename and the name of the entry function
+    :return: breakdown - List of dicts with the function name, number of calls and cumulative time, sorted by time
+    """
+    breakdown = []
+    for (filename, line, func_name), (cc, n_calls, tt, ct, callers) in stats.stats.items():
+        if any(caller[0] == entry[0] and caller[2] == entry[1] for caller in callers):
+            breakdown.append({'function': func_name, 'calls': n_calls, 'seconds': round(ct, 4)})
+
+    return sorted(breakdown, key=lambda item: item['seconds'], reverse=True)
+
+
+def get_io_call_counts(stats):
+    """
+    Get the number of calls to every GDAL and fiona function
+    :param stats: pstats.Stats of the request
+    :return: call_counts - Dict with the function and its number of calls
+    """
+    call_counts = {}
+    for (filename, line, func_name), (cc, n_calls, tt, ct, callers) in stats.stats.items():
+        # Built-in functions, as the GDAL bindings, don't have a filename and carry the module in the function name
+        location = func_name if filename == '~' else filename
+        if any(module in location for module in IO_MODULES):
+            name = func_name if filename == '~' else f'{path.basename(filename)}:{func_name}'
+            call_counts[name] = call_counts.get(name, 0) + n_calls
+
+    return dict(sorted(call_counts.items(), key=lambda item: item[1], reverse=True))
+
+
+def save_profile(profiler, base_path, wall_time, entry):
+    """
+    Save the profile as a pstats dump and its summary as JSON
+    :param profiler: cProfile.Profile of the request
+    :param base_path: path of the output files, without extension
+    :param wall_time: wall time of the request, in seconds
+    :param entry: tuple with the filename and the name of the entry function
+    """
+    profiler.dump_stats(f'{base_path}.prof')
+    stats = pstats.Stats(profiler)
+    summary = {
+        'wall_time': round(wall_time, 4),
+        'breakdown': get_wall_time_breakdown(stats, entry),
+        'io_calls': get_io_call_counts(stats)
+    }
+    with open(f'{base_path}.profile.json', 'w') as f:
+        json.dump(summary, f, indent=2)
+
+
+def profiled(base_path, entry_name='get'):
+    """
+    Decorator that profiles a view, both class-based view method or function view, when a staff user requests it
+    :param base_path: function that gets the view's instance, or None if it's a function view, and returns the path
+                      of the output files without extension. If it returns None, the files are saved into the temp
+                      directory
+    :param entry_name: name of the function, from the view's module, whose callees are used as the wall time breakdown
+    """
+    def decorator(view_func):
+        entry = (view_func.__code__.co_filename, entry_name)
+
+        @functools.wraps(view_func)
+        def wrapper(*args, **kwargs):
+            if isinstance(args[0], HttpRequest):
+                view, request = None, args[0]
+            else:
+                view, request = args[0], args[1]
+            if not profiling_requested(request):
+                return view_func(*args, **kwargs)
+
+            profiler = cProfile.Profile()
+            start = time.perf_counter()
+            try:
+                return profiler.runcall(view_func, *args, **kwargs)
+            finally:
+                wall_time = time.perf_counter() - start
+                output_path = base_path(view)
+                if output_path is None:
+                    date = datetime.now().strftime("%Y%m%d-%H%M%S")
+                    output_path = path.join(tempfile.gettempdir(), f'profile-{view_func.__name__}-{date}')
+                os.makedirs(path.dirname(output_path), exist_ok=True)
+                save_profile(profiler, output_path, wall_time, entry)
+        return wrapper
+    return decorator
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------------------
+# TERRITORIAL DELIMITATION TOOLS (ICGC)
+# Authors: Fran Martin
+# Version: 1
+# Date: 20210315
+# Version Python: 3.7
+# ----------------------------------------------------------
+
+"""
+Snapshots and lookups of the reference layers of the working geopackage.
+
+Every update of the reference layers is built into a new versioned snapshot of the working geopackage and published
+by atomically replacing a pointer file, so the readers keep using the snapshot they resolved when they started.
+The lookups read the columnar snapshots of the layers if they exist, or else run as SQL queries using the attribute
+indexes created by updatedb, and return only the matching rows instead of filtering the whole layers in memory
+"""
+
+from contextlib import closing
+import glob
+import json
+import os
+import os.path as path
+import shutil
+import sqlite3
+import time
+from urllib.request import pathname2url
+
+import geopandas as gpd
+from osgeo import ogr
+
+from delimitapp.common.columnar import is_available as is_columnar_available, get_columnar_path, read_columnar_layer
+
+
+# Number of snapshots always kept, besides the current one, for the readers that are still using them
+SNAPSHOT_RETENTION = 2
+# Seconds that a snapshot is kept since it was superseded, by default. The readers can use it until they finish,
+# so it can't be shorter than the longest run
+SNAPSHOT_MIN_AGE = 3600
+
+
+def get_pointer_path(gpkg):
+    """Get the path of the pointer file with the current snapshot version of a geopackage"""
+    return f'{path.splitext(gpkg)[0]}.current'
+
+
+def get_snapshot_path(gpkg, version):
+    """Get the path of a snapshot of a geopackage"""
+    return f'{path.splitext(gpkg)[0]}.{version}.gpkg'
+
+
+def get_published_marker(gpkg):
+    """Get the path of the marker file of a snapshot, whose modification time is when the snapshot was published"""
+    return f'{path.splitext(gpkg)[0]}.published'
+
+
+def get_store_dir(gpkg):
+    """Get the directory of the memory-mapped geometry store of a snapshot"""
+    return f'{path.splitext(gpkg)[0]}.store'
+
+
+def get_columnar_dir(gpkg):
+    """Get the directory of the columnar snapshots of the layers of a snapshot"""
+    return f'{path.splitext(gpkg)[0]}.columnar'
+
+
+def get_columnar_layer(gpkg, layer_name):
+    """
+    Get the columnar snapshot of a layer
+    :param gpkg: path to the snapshot
+    :param layer_name: layer name
+    :return: parquet_path - Path to the layer's GeoParquet file, or None if it doesn't exist or can't be read
+    """
+    parquet_path = get_columnar_path(get_columnar_dir(gpkg), layer_name)
+    if is_columnar_available() and path.exists(parquet_path):
+        return parquet_path
+    return None
+
+
+def get_current_snapshot(gpkg):
+    """
+    Get the current snapshot of a geopackage. A process must resolve it once and use it until it finishes
+    :param gpkg: path to the working geopackage
+    :return: version - Snapshot version, empty if no snapshot has been published yet
+    :return: snapshot_path - Path to the snapshot, or to the working geopackage itself if there are no snapshots
+    """
+    try:
+        with open(get_pointer_path(gpkg)) as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return '', gpkg
+    return version, get_snapshot_path(gpkg, version)
+
+
+def publish_snapshot(gpkg, version):
+    """
+    Publish a snapshot as the current one, replacing the pointer file atomically
+    :param gpkg: path to the working geopackage
+    :param version: snapshot version
+    """
+    pointer_path = get_pointer_path(gpkg)
+    temp_path = f'{pointer_path}.tmp'
+    open(get_published_marker(get_snapshot_path(gpkg, version)), 'w').close()
+    with open(temp_path, 'w') as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, pointer_path)
+
+
+def get_published_time(snapshot):
+    """
+    Get the time when a snapshot was published. The snapshots published before the marker files existed take the
+    time when they were last written
+    :param snapshot: path to the snapshot
+    :return: published_at - Timestamp of the publication
+    """
+    try:
+        return path.getmtime(get_published_marker(snapshot))
+    except OSError:
+        return path.getmtime(snapshot)
+
+
+def get_removable_snapshots(gpkg, min_age=SNAPSHOT_MIN_AGE, retention=SNAPSHOT_RETENTION):
+    """
+    Get the old snapshots of a geopackage that were superseded longer than min_age ago, besides the current one and
+    the newest ones. A snapshot is superseded when the next one is published. The snapshots newer than the current
+    one are still being built, so they are never removable
+    :param gpkg: path to the working geopackage
+    :param min_age: seconds that a snapshot is kept since it was superseded, as a reader that resolved it just
+                    before can still be using it
+    :param retention: number of old snapshots always kept besides the current one
+    :return: snapshots - List with the paths of the removable snapshots, from the newest to the oldest
+    """
+    current_version, current_path = get_current_snapshot(gpkg)
+    if not current_version:
+        return []
+    snapshot_prefix = f'{path.splitext(gpkg)[0]}.'
+    snapshots = sorted(glob.glob(f'{glob.escape(snapshot_prefix)}[0-9]*.gpkg'), reverse=True)
+    old_snapshots = [snapshot for snapshot in snapshots if snapshot[len(snapshot_prefix):-len('.gpkg')] < current_version]
+    now = time.time()
+    # Every snapshot was superseded when the newer one was published
+    superseded_times = [get_published_time(snapshot) for snapshot in [current_path] + old_snapshots[:-1]]
+    return [snapshot for snapshot, superseded_at in list(zip(old_snapshots, superseded_times))[retention:]
+            if now - superseded_at >= min_age]
+
+
+def remove_snapshot(snapshot):
+    """
+    Remove a snapshot with its marker, store and columnar snapshots
+    :param snapshot: path to the snapshot
+    """
+    for snapshot_file in snapshot, get_published_marker(snapshot):
+        if path.exists(snapshot_file):
+            os.remove(snapshot_file)
+    shutil.rmtree(get_store_dir(snapshot), ignore_errors=True)
+    shutil.rmtree(get_columnar_dir(snapshot), ignore_errors=True)
+
+
+def remove_old_snapshots(gpkg, min_age=SNAPSHOT_MIN_AGE, retention=SNAPSHOT_RETENTION):
+    """
+    Remove the old snapshots of a geopackage that were superseded longer than min_age ago, keeping always the current
+    one and the newest ones
+    :param gpkg: path to the working geopackage
+    :param min_age: seconds that a snapshot is kept since it was superseded
+    :param retention: number of old snapshots always kept besides the current one
+    """
+    for snapshot in get_removable_snapshots(gpkg, min_age, retention):
+        remove_snapshot(snapshot)
+
+
+def connect(gpkg):
+    """
+    Open a read-only connection to a geopackage
+    :param gpkg: path to the geopackage
+    :return: conn - sqlite3 connection
+    """
+    return sqlite3.connect(f'file:{pathname2url(gpkg)}?mode=ro', uri=True)
+
+
+def get_where(filters):
+    """
+    Get the WHERE clause of equality filters, with its parameters
+    :param filters: dict with the field -> value to filter by
+    :return: where - WHERE clause, with a placeholder for every value
+    :return: params - Tuple with the values
+    """
+    where = ' AND '.join(f'"{field}" = ?' for field in filters)
+    return where, tuple(filters.values())
+
+
+def feature_exists(gpkg, layer_name, **filters):
+    """
+    Check if any feature of a layer matches the filters
+    :param gpkg: path to the geopackage
+    :param layer_name: layer name
+    :param filters: field -> value to filter by
+    :return: boolean that indicates whether any feature matches
+    """
+    where, params = get_where(filters)
+    with closing(connect(gpkg)) as conn:
+        return conn.execute(f'SELECT 1 FROM "{layer_name}" WHERE {where} LIMIT 1', params).fetchone() is not None
+
+
+def get_first_row(gpkg, layer_name, columns, **filters):
+    """
+    Get some columns of the first row of a layer or table that matches the filters
+    :param gpkg: path to the geopackage
+    :param layer_name: layer or table name
+    :param columns: names of the columns to get
+    :param filters: field -> value to filter by
+    :return: row - Tuple with the columns' values, or None if no row matches
+    """
+    where, params = get_where(filters)
+    select = ', '.join(f'"{column}"' for column in columns)
+    with closing(connect(gpkg)) as conn:
+        return conn.execute(f'SELECT {select} FROM "{layer_name}" WHERE {where} LIMIT 1', params).fetchone()
+
+
+def read_features(gpkg, layer_name, **filters):
+    """
+    Read the features of a layer that match the filters. If the layer has a columnar snapshot, only its row groups
+    that can match are read. If not, the features' IDs are found with an indexed SQL query and then only those
+    features are read
+    :param gpkg: path to the geopackage
+    :param layer_name: layer name
+    :param filters: field -> value to filter by
+    :return: gdf - Geodataframe with the matching features
+    """
+    parquet_path = get_columnar_layer(gpkg, layer_name)
+    if parquet_path is not None:
+        return read_columnar_layer(parquet_path, **filters)
+
+    ds = ogr.Open(gpkg)
+    layer = ds.GetLayerByName(layer_name)
+    layer_defn = layer.GetLayerDefn()
+    columns = [layer_defn.GetFieldDefn(i).GetName() for i in range(layer_defn.GetFieldCount())]
+    spatial_ref = layer.GetSpatialRef()
+    crs = spatial_ref.ExportToWkt() if spatial_ref is not None else None
+
+    where, params = get_where(filters)
+    with closing(connect(gpkg)) as conn:
+        fids = [row[0] for row in conn.execute(f'SELECT "{layer.GetFIDColumn()}" FROM "{layer_name}" WHERE {where}',
+                                               params)]
+    features = [json.loads(layer.GetFeature(fid).ExportToJson()) for fid in fids]
+    ds = None
+
+    if not features:
+        return gpd.GeoDataFrame(columns=columns + ['geometry'], geometry='geometry', crs=crs)
+    return gpd.GeoDataFrame.from_features(features, crs=crs)[columns + ['geometry']]
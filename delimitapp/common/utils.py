@@ -12,6 +12,17 @@
 Common functions
 """
 
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:   # Windows
+    fcntl = None
+
+# Linux ioctl request that clones a file sharing its blocks, as a copy-on-write copy
+FICLONE = 0x40049409
+
 
 def line_id_2_txt(line_id):
     """
@@ -29,3 +40,32 @@ def line_id_2_txt(line_id):
         line_id_txt = line_id_str
 
     return line_id_txt
+
+
+def link_file(src, dst):
+    """
+    Hard link a file that won't be modified, copying it if the filesystem doesn't support hard links
+    :param src: path to the source file
+    :param dst: path to the new file
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def clone_file(src, dst):
+    """
+    Copy a file as a copy-on-write clone, which shares the blocks of the source and takes the same time whatever
+    its size, where the filesystem supports it (Btrfs, XFS). Otherwise, the file is copied
+    :param src: path to the source file
+    :param dst: path to the new file
+    """
+    if fcntl is not None:
+        try:
+            with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------------------
+# TERRITORIAL DELIMITATION TOOLS (ICGC)
+# Authors: Fran Martin
+# Version: 1
+# Date: 20210315
+# Version Python: 3.7
+# ----------------------------------------------------------
+
+"""
+Private scratch workspaces of the QA and Municat runs. Every run writes its temporal layers into its own geopackage,
+which is removed whole at the end, so concurrent runs don't share any writable file. All the writes and the cleanup
+of a run go through a single geopackage writer
+"""
+
+import os
+import os.path as path
+import shutil
+import tempfile
+
+from delimitapp.common.gpkgwriter import GpkgWriter
+
+
+class Workspace:
+    """Scratch geopackage of a run, into its own temporal directory"""
+
+    def __init__(self, base_dir=None, prefix='workspace_'):
+        """
+        :param base_dir: directory where create the workspace's directory. If None, the system's temporal directory
+        :param prefix: prefix of the workspace's directory name
+        """
+        if base_dir:
+            os.makedirs(base_dir, exist_ok=True)
+        self.dir = tempfile.mkdtemp(prefix=prefix, dir=base_dir)
+        self.gpkg = path.join(self.dir, 'workspace.gpkg')
+        self.writer = GpkgWriter(self.gpkg)
+
+    def write_layers(self, layers):
+        """
+        Write some layers into the workspace in a single transaction
+        :param layers: dict with the layer name -> geodataframe or dataframe of every layer
+        """
+        self.writer.write_layers(layers)
+
+    def clear(self):
+        """Remove all the layers of the workspace"""
+        if path.exists(self.gpkg):
+            self.writer.drop_layers()
+
+    def remove(self):
+        """Remove the workspace"""
+        self.writer.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.remove()
@@ -19,6 +19,7 @@ import delimitapp.views
 
 urlpatterns = [
     re_path(r'^$', delimitapp.views.index, name='index'),
+    re_path(r'^metrics/$', delimitapp.views.metrics, name='metrics'),
     re_path(r'^admin/', admin.site.urls),
     re_path(r'^qa-line/', include('qa_line.urls')),
     re_path(r'^municat/', include('municat_generator.urls')),
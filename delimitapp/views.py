@@ -1,7 +1,21 @@
 # Create your views here.
+from django.http import JsonResponse
 from django.shortcuts import render, redirect
 
+from delimitapp.common.metrics import get_recent_metrics
+
 
 def index(request):
     return render(request, '../../delimitapp/templates/index.html')
 
+
+def metrics(request):
+    """
+    Wall time and memory metrics of the recent QA and Municat runs, by stage. Only the staff can get them
+    :param request: Http request
+    :return: JSON response with the metrics
+    """
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated or not user.is_staff:
+        return JsonResponse({'detail': "No tens permís per consultar les mètriques"}, status=403)
+    return JsonResponse(get_recent_metrics())
@@ -11,6 +11,7 @@
 import os
 import csv
 import math
+from datetime import datetime
 
 # Third party imports
 from django.views import View
@@ -25,6 +26,7 @@ from dotenv import load_dotenv
 # Local imports
 from doc_generator.config import *
 from delimitapp.common.utils import line_id_2_txt
+from delimitapp.common.profiling import profiled
 
 # Load dotenv in order to protect secret information
 load_dotenv()
@@ -46,6 +48,7 @@ class MunicatDataExtractor(View):
     council_1_data = None
     council_2_data = None
 
+    @profiled(lambda view: letters_profile_path('Municat_extraction_profile'))
     def get(self, request):
         """
         Main entry point. This method is called when someone wants to init the process of extracting the
@@ -161,6 +164,17 @@ class MunicatDataExtractor(View):
         self.council_2_data = None
 
 
+def letters_profile_path(name):
+    """
+    Get the path of the letter generators' profiling files, next to the Municat output data
+    :param name: name of the profiled process
+    :return: path of the profiling files, without extension
+    """
+    date = datetime.now().strftime("%Y%m%d-%H%M%S")
+    return os.path.join(os.path.dirname(INFO_MUNICAT_OUTPUT_DATA), f'{name}-{date}')
+
+
+@profiled(lambda view: letters_profile_path('Letters_doc_profile'), entry_name='generate_letters_doc')
 def generate_letters_doc(request):
     """
     Generate all the letters in docx format
@@ -250,6 +264,7 @@ def generate_letters_doc(request):
     return redirect("letter-generator-page")
 
 
+@profiled(lambda view: letters_profile_path('Letters_pdf_profile'), entry_name='generate_letters_pdf')
 def generate_letters_pdf(request):
     """
     Convert all the docx files into pdf files
@@ -21,7 +21,6 @@ import logging
 
 # Third party imports
 import geopandas as gpd
-from osgeo import gdal
 from django.http import JsonResponse
 from django.shortcuts import render, redirect
 from django.views import View
@@ -30,6 +29,22 @@ from django.contrib import messages
 # Local imports
 from municat_generator.config import *
 from delimitapp.common.utils import line_id_2_txt
+from delimitapp.common.profiling import profiled
+from delimitapp.common.metrics import StageMetrics, get_sidecar_path
+from delimitapp.common.crs import TARGET_CRS
+from delimitapp.common.cancellation import CancellationToken, PipelineCancelled
+from delimitapp.common.workspace import Workspace
+from delimitapp.common.backends import get_reference
+
+# Time budgets in seconds of the stages of every line. The 'total' budget limits the whole run
+MUNICAT_STAGE_BUDGETS = {
+    'total': 3600,
+    'extraction': 600,
+    'data_management': 600,
+    'export': 600
+}
+# Directory of the runs' private workspaces
+WORKSPACES_DIR = path.join(path.dirname(WORK_GPKG), 'workspaces')
 
 
 class MunicatDataGenerator(View):
@@ -41,15 +56,17 @@ class MunicatDataGenerator(View):
     current_date = None
     logger = logging.getLogger()
     log_path = None
+    metrics = None
+    token = None
+    workspace = None
+    reference = None
+    reference_version = None
     # MTT parameters
     line_id = None
     session_id = None
     mtt_date = None
     mtt_num = None
     # Geodataframes for data managing
-    line_tram_mem_gdf = None
-    fita_mem_gdf = None
-    line_id_muni_gdf = None
     line_tram_temp_gdf = None
     fita_temp_gdf = None
     # Municipis's names
@@ -60,6 +77,7 @@ class MunicatDataGenerator(View):
     # Response data
     response_data = {}
 
+    @profiled(lambda view: path.splitext(view.log_path)[0] if view.log_path else None)
     def get(self, request):
         """
         Main entry point. This method is called when someone wants to init the process of extracting and managing
@@ -69,19 +87,27 @@ class MunicatDataGenerator(View):
         # SET UP WORKING ENVIRONMENT
         # Set up parameters
         self.set_up()
-        # Set the layers geodataframe
-        self.set_layers_gdf()
+        self.metrics = StageMetrics('municat', self.current_date)
+        self.token = CancellationToken(MUNICAT_STAGE_BUDGETS)
+        # The reference data backend is resolved once, so a refresh of the snapshot during the run doesn't affect it
+        self.reference = get_reference(WORK_GPKG)
+        self.reference_version = self.reference.version
+        self.logger.info(f"Versio de les dades de referencia: {self.reference_version or 'sense versio'}")
 
         #######################
         # EXTRACTION PROCESS START
         # Check that the input data file exists
         if not path.exists(MTT):
+            self.metrics.finish(get_sidecar_path(self.log_path))
             messages.error(request, "No s'ha trobat l'arxiu amb l'informació d'entrada")
             return redirect("index")
 
         with open(MTT) as f:
-            f_reader = csv.reader(f, delimiter=",")
-            for row in f_reader:
+            rows = list(csv.reader(f, delimiter=","))
+        # The extracted layers are written into a private workspace, so the runs don't share any writable file
+        self.workspace = Workspace(WORKSPACES_DIR, prefix='municat_')
+        try:
+            for row_pos, row in enumerate(rows):
                 # #######################
                 # LOAD CONFIGURATION
                 # Read input data
@@ -94,10 +120,15 @@ class MunicatDataGenerator(View):
                 # Log those class variables
                 self.log_municat_data()
                 # Get the names of the municipies
-                self.get_muni_names()
+                muni_names_exist = self.get_muni_names()
+                if not muni_names_exist:
+                    msg = f"   No s'han trobat els municipis de la linia {line_id} a la base de dades"
+                    self.add_warning_response(msg, line_id)
+                    break
 
                 # #######################
                 # VALIDATE WORKING ENVIRONMENT
+                self.start_stage(f'{line_id}:preparation')
                 self.logger.info("Preparant entorn de treball...")
                 try:
                     self.rm_temp()  # Delete previous temp files if exist
@@ -115,6 +146,7 @@ class MunicatDataGenerator(View):
                 # #######################
                 # DATA EXTRACTION
                 # Extract points and lines and export them as shapefiles
+                self.start_stage(f'{line_id}:extraction')
                 try:
                     self.extract_data()
                     self.logger.info('   Geometries extretes correctament')
@@ -133,6 +165,7 @@ class MunicatDataGenerator(View):
                 # #######################
                 # DATA MANAGEMENT
                 # Delete auxiliary points from the point gdf
+                self.start_stage(f'{line_id}:data_management')
                 self.delete_aux()
                 # Delete and manage columns to the gdf
                 self.manage_delete_fields()
@@ -147,10 +180,20 @@ class MunicatDataGenerator(View):
                 # #######################
                 # DATA EXPORT
                 # Export the data as ESRI shapefiles and DXF files
+                self.start_stage(f'{line_id}:export')
                 self.export_data()
                 # Copy PDF to the output folder
                 self.copy_pdf()
                 self.logger.info(f'Carpeta municat de la linia {line_id} generada correctament\n')
+        except PipelineCancelled as e:
+            # Neither the line being generated nor the pending ones have their output folder
+            self.logger.error(f"Generació interrompuda a l'etapa {e.stage} => {e.reason}")
+            for row in rows[row_pos:]:
+                self.add_warning_response(f'   No s\'ha generat la carpeta de la linia {row[0]}', str(row[0]))
+        finally:
+            self.workspace.remove()
+
+        self.metrics.finish(get_sidecar_path(self.log_path))
 
         # Send response. The message's type depends on the success of the process. In that sense, if exists
         # any line ID in a warning-line JSON array it indicates that for some reason, the app could not be able
@@ -203,14 +246,6 @@ class MunicatDataGenerator(View):
             f.write(f"\tData:   {date}\n")
             f.write("\n")
 
-    def set_layers_gdf(self):
-        """Open all the necessary layers as geodataframes with geopandas"""
-        # SIDM3
-        self.line_tram_mem_gdf = gpd.read_file(WORK_GPKG, layer='tram_linia_mem')
-        self.fita_mem_gdf = gpd.read_file(WORK_GPKG, layer='fita_mem')
-        # Table id_linia_muni
-        self.line_id_muni_gdf = gpd.read_file(WORK_GPKG, layer='id_linia_muni')
-
     def set_municat_data(self, line_id, session_id, mtt_date, mtt_num):
         """
         Extract the data from the input csv file and set it as class parameters
@@ -231,11 +266,13 @@ class MunicatDataGenerator(View):
     def get_muni_names(self):
         """
         Get the names of the municipis that share de line
+        :return: boolean that indicates if the line exists in the municipis table
         """
-        line_id_filter = self.line_id_muni_gdf['IDLINIA'] == int(self.line_id)
-        munis_line_id = self.line_id_muni_gdf[line_id_filter]
-        self.muni_1 = munis_line_id.NOMMUNI1.iloc[0]
-        self.muni_2 = munis_line_id.NOMMUNI2.iloc[0]
+        muni_names = self.reference.get_first_row('id_linia_muni', ('NOMMUNI1', 'NOMMUNI2'), IDLINIA=int(self.line_id))
+        if muni_names is None:
+            return False
+        self.muni_1, self.muni_2 = muni_names
+        return True
 
     def check_session_id(self):
         """
@@ -243,7 +280,8 @@ class MunicatDataGenerator(View):
         :return: boolean that indicates if the given session ID exists in the database
         """
         self.logger.info("Comprovant que l'ID sessio introduit existeix a la base de dades...")
-        if (self.session_id in self.line_tram_mem_gdf.id_sessio_carrega.values) and (self.session_id in self.fita_mem_gdf.id_sessio_carrega.values):
+        if (self.reference.feature_exists('tram_linia_mem', id_sessio_carrega=self.session_id) and
+                self.reference.feature_exists('fita_mem', id_sessio_carrega=self.session_id)):
             self.logger.info('   Existeix')
             return True
         else:
@@ -252,27 +290,29 @@ class MunicatDataGenerator(View):
     def extract_data(self):
         """Extract, manage and export the data"""
         self.logger.info('Extraient geometries de la base de dades...')
-        for layer in self.fita_mem_gdf, self.line_tram_mem_gdf:
+        layers = {}
+        for layer in 'fita_mem', 'tram_linia_mem':
             geom_type = ''
-            session_line_id_gdf = layer[(layer['id_sessio_carrega'] == self.session_id) & (layer['id_linia'] == float(self.line_id))]
-            if layer.geom_type.iloc[0] == 'Point':
+            session_line_id_gdf = self.reference.read_features(layer, id_sessio_carrega=self.session_id,
+                                                               id_linia=int(self.line_id))
+            if session_line_id_gdf.empty:
+                raise Exception(f'No hi ha cap geometria de la sessio i la linia a {layer}')
+            if session_line_id_gdf.geom_type.iloc[0] == 'Point':
                 geom_type = 'Fita'
-            elif layer.geom_type.iloc[0] == 'MultiLineString':
+            elif session_line_id_gdf.geom_type.iloc[0] == 'MultiLineString':
                 geom_type = 'Line_tram'
             # Check the result
             if geom_type != 'Fita' and geom_type != 'Line_tram':
                 msg = 'Alguna de les geometries no són Punts o Multilínies'
                 raise Exception(msg)
-            # Export to the workspace geopackage
-            layer_name = f'{geom_type}_mem_municat_temp'
-            session_line_id_gdf.to_file(WORK_GPKG, layer=layer_name, driver="GPKG")
-            # Set the new layers's geodataframes
-            if geom_type == 'Fita':
-                self.fita_temp_gdf = gpd.read_file(WORK_GPKG, layer=layer_name)
-                self.fita_temp_gdf.crs = {'init': 'epsg:25831'}
-            elif geom_type == 'Line_tram':
-                self.line_tram_temp_gdf = gpd.read_file(WORK_GPKG, layer=layer_name)
-                self.line_tram_temp_gdf.crs = {'init': 'epsg:25831'}
+            layers[f'{geom_type}_mem_municat_temp'] = session_line_id_gdf
+        # Export both layers to the workspace geopackage in a single transaction
+        self.workspace.write_layers(layers)
+        # Set the new layers's geodataframes
+        self.fita_temp_gdf = gpd.read_file(self.workspace.gpkg, layer='Fita_mem_municat_temp')
+        self.fita_temp_gdf.crs = TARGET_CRS
+        self.line_tram_temp_gdf = gpd.read_file(self.workspace.gpkg, layer='Line_tram_mem_municat_temp')
+        self.line_tram_temp_gdf.crs = TARGET_CRS
 
     def delete_aux(self):
         """Delete auxiliary points from the points layers"""
@@ -298,8 +338,8 @@ class MunicatDataGenerator(View):
         self.line_tram_temp_gdf = self.line_tram_temp_gdf.rename({'id_linia': 'ID_LINIA'}, axis='columns')
 
         # Set the CRS again
-        self.fita_temp_gdf.crs = {'init': 'epsg:25831'}
-        self.line_tram_temp_gdf.crs = {'init': 'epsg:25831'}
+        self.fita_temp_gdf.crs = TARGET_CRS
+        self.line_tram_temp_gdf.crs = TARGET_CRS
 
     def dissolve_line(self):
         """Dissolve all the line's tram into a single line"""
@@ -429,6 +469,14 @@ class MunicatDataGenerator(View):
         shutil.copyfile(path_pdf, path_pdf_output)
         self.logger.info("   Document PDF exportat")
 
+    def start_stage(self, name):
+        """
+        Start a new stage, measuring it and checking that the run has not exceeded its time budget
+        :param name: stage name
+        """
+        self.token.start_stage(name)
+        self.metrics.start_stage(name)
+
     def add_warning_response(self, message, line_id):
         """
         Add the line ID to the JSON response data as a warning that the app could not be able to generate
@@ -445,7 +493,5 @@ class MunicatDataGenerator(View):
 
     def rm_temp(self):
         """Remove temporal files from the workspace"""
-        gpkg = gdal.OpenEx(WORK_GPKG, gdal.OF_UPDATE, allowed_drivers=['GPKG'])
-        for layer in TEMP_ENTITIES:
-            gpkg.ExecuteSQL(f'DROP TABLE {layer}')
+        self.workspace.clear()
         self.logger.info('   Arxius temporals esborrats')
@@ -1,3 +1,10 @@
 from django.contrib import admin
 
-# Register your models here.
+from qa_line.models import QARun
+
+
+@admin.register(QARun)
+class QARunAdmin(admin.ModelAdmin):
+    list_display = ('line_id', 'line_type', 'started_at', 'duration', 'result', 'n_vertexs')
+    list_filter = ('line_type', 'result')
+    search_fields = ('line_id',)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------------------
+# TERRITORIAL DELIMITATION TOOLS (ICGC)
+# Authors: Fran Martin
+# Version: 1.0
+# Version Python: 3.7
+# ----------------------------------------------------------
+
+"""
+JSON API of the quality check, in order to submit lines and get their reports from scripts
+"""
+
+from django.core.paginator import Paginator
+from rest_framework import status
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from qa_line.jobs import submit_job, get_job
+from qa_line.reports import load_report, filter_reports, REPORT_PAGE_SIZE
+from qa_line.serializers import QALineSerializer, QAJobSerializer, QAReportSerializer
+
+
+class QAApiView(APIView):
+    """Base view of the quality check JSON API"""
+    renderer_classes = [JSONRenderer]
+    parser_classes = [JSONParser]
+
+
+class QAJobListView(QAApiView):
+    """Submit one or many lines to check"""
+
+    def post(self, request):
+        """
+        Submit the quality check of one or many lines. The body can be a line, as {"line_id": 1, "line_type": "mtt"},
+        a list of lines, or a dict with the list of lines under the "lines" key
+        :return: list with the jobs submitted
+        """
+        lines = request.data
+        if isinstance(lines, dict) and 'lines' in lines:
+            lines = lines['lines']
+        many = isinstance(lines, list)
+        serializer = QALineSerializer(data=lines, many=many)
+        serializer.is_valid(raise_exception=True)
+        lines = serializer.validated_data if many else [serializer.validated_data]
+
+        jobs = [submit_job(str(line['line_id']), line['line_type']) for line in lines]
+        return Response({'jobs': QAJobSerializer([job.to_dict() for job in jobs], many=True).data},
+                        status=status.HTTP_202_ACCEPTED)
+
+
+class QAJobDetailView(QAApiView):
+    """Status, result and cancellation of a quality check job"""
+
+    def get(self, request, job_id):
+        """
+        Get the status of a job and, if finished, a summary of its result with the number of errors by check
+        :return: job's status and summary
+        """
+        job = get_job(job_id)
+        if job is None:
+            return Response({'detail': "No existeix el procés"}, status=status.HTTP_404_NOT_FOUND)
+        data = QAJobSerializer(job.to_dict()).data
+        response = load_report(job.report_id) if job.report_id else None
+        if response is not None:
+            checks = {}
+            for report in response['response'].get('reports', []):
+                if report.get('check'):
+                    checks.setdefault(report['check'], 0)
+                    if report['level'] in ('ERROR', 'CRITICAL'):
+                        checks[report['check']] += 1
+            data['result'] = response['response']['result']
+            data['checks'] = [{'check': check, 'n_errors': n_errors} for check, n_errors in checks.items()]
+        return Response(data)
+
+    def delete(self, request, job_id):
+        """
+        Cancel a job. A running job stops at its next check and sends a partial report with the checks skipped
+        :return: job's status
+        """
+        job = get_job(job_id)
+        if job is None:
+            return Response({'detail': "No existeix el procés"}, status=status.HTTP_404_NOT_FOUND)
+        if not job.cancel():
+            return Response({'detail': "El procés ja ha acabat", 'status': job.status}, status=status.HTTP_409_CONFLICT)
+        return Response(QAJobSerializer(job.to_dict()).data, status=status.HTTP_202_ACCEPTED)
+
+
+class QAReportView(QAApiView):
+    """Stored report of a quality check"""
+
+    def get(self, request, report_id):
+        """
+        Get the report's messages, paginated and filtered by the 'level' and 'check' query parameters
+        :return: page with the report's messages
+        """
+        response = load_report(report_id)
+        if response is None:
+            return Response({'detail': "No existeix l'informe"}, status=status.HTTP_404_NOT_FOUND)
+        response = response['response']
+        reports = filter_reports(response.get('reports', []), request.query_params.get('level'),
+                                 request.query_params.get('check'))
+        page = Paginator(reports, REPORT_PAGE_SIZE).get_page(request.query_params.get('page'))
+        return Response({
+            'result': response['result'],
+            'message': response['message'],
+            'reference_version': response.get('reference_version', ''),
+            'count': page.paginator.count,
+            'page': page.number,
+            'num_pages': page.paginator.num_pages,
+            'reports': QAReportSerializer(page.object_list, many=True).data
+        })
+
+
+class QAJobReportView(QAReportView):
+    """Stored report of a quality check job"""
+
+    def get(self, request, job_id):
+        """Get the report of a finished job"""
+        job = get_job(job_id)
+        if job is None:
+            return Response({'detail': "No existeix el procés"}, status=status.HTTP_404_NOT_FOUND)
+        if not job.report_id:
+            return Response({'detail': "El procés no té cap informe", 'status': job.status, 'message': job.message},
+                            status=status.HTTP_409_CONFLICT)
+        return super().get(request, job.report_id)
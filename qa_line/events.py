@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------------------
+# TERRITORIAL DELIMITATION TOOLS (ICGC)
+# Authors: Fran Martin
+# Version: 1.0
+# Version Python: 3.7
+# ----------------------------------------------------------
+
+"""
+Server-Sent Events stream of the quality check jobs, served directly by the ASGI application. Every connection is a
+coroutine that polls the job's events, so no worker thread is held per connected browser. The events live in the
+memory of the process that runs the job, so only that process can stream the reports. The other processes poll the
+job's saved status, and only stream its stage transitions and its status, without the reports.
+It needs an ASGI server, as uvicorn (see the README), as the WSGI servers hold a worker per open stream
+"""
+
+import asyncio
+import json
+import re
+
+from asgiref.sync import sync_to_async
+
+from qa_line.jobs import get_job
+
+# Path of the events stream
+EVENTS_PATH_REGEX = re.compile(r'^/qa-line/events/(?P<job_id>[0-9a-f]{32})/$')
+# Seconds between polls of the job's events
+POLL_INTERVAL = 0.5
+# Seconds between polls of the saved status of the jobs that run in another process
+SAVED_STATUS_POLL_INTERVAL = 2
+# Seconds between keep alive comments, in order to keep open the connection through proxies
+KEEP_ALIVE_INTERVAL = 15
+
+
+async def send_response(send, status, body):
+    """Send a simple plain text response"""
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'text/plain; charset=utf-8')]})
+    await send({'type': 'http.response.body', 'body': body.encode('utf-8')})
+
+
+async def wait_disconnect(receive):
+    """Wait until the client disconnects"""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def send_events_headers(send):
+    """Start the events stream response"""
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                            (b'x-accel-buffering', b'no')]})
+
+
+async def stream_saved_status(job, receive, send):
+    """
+    Stream the stage transitions and the status of a job that runs in another process, polling its saved status
+    until the job finishes or the client disconnects
+    :param job: job loaded from its saved status
+    """
+    await send_events_headers(send)
+    disconnected = asyncio.ensure_future(wait_disconnect(receive))
+    stage, status = None, None
+    idle_time = 0
+    try:
+        while not disconnected.done():
+            body = ''
+            if job.stage and job.stage != stage:
+                stage = job.stage
+                body += f"event: stage\ndata: {json.dumps({'check': stage})}\n\n"
+            if job.status != status:
+                status = job.status
+                body += f"event: {'done' if job.finished else 'status'}\ndata: {json.dumps(job.to_dict())}\n\n"
+            if body:
+                await send({'type': 'http.response.body', 'body': body.encode('utf-8'), 'more_body': True})
+                idle_time = 0
+            elif idle_time >= KEEP_ALIVE_INTERVAL:
+                await send({'type': 'http.response.body', 'body': b': keep-alive\n\n', 'more_body': True})
+                idle_time = 0
+            if job.finished:
+                break
+            await asyncio.sleep(SAVED_STATUS_POLL_INTERVAL)
+            idle_time += SAVED_STATUS_POLL_INTERVAL
+            job = await sync_to_async(get_job)(job.job_id) or job
+        if not disconnected.done():
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        disconnected.cancel()
+
+
+async def qa_events_app(scope, receive, send):
+    """
+    ASGI application that streams the events of a quality check job as Server-Sent Events. Every event has an
+    incremental ID, so a browser that reconnects goes on from the last event received. The jobs that run in another
+    process only stream their stage transitions and their status, polled from the database
+    """
+    match = EVENTS_PATH_REGEX.match(scope['path'])
+    job = await sync_to_async(get_job)(match.group('job_id')) if match else None
+    if job is None:
+        await send_response(send, 404, "No existeix el procés")
+        return
+    if not job.local:
+        # The job runs in another process, whose events can't be read
+        await stream_saved_status(job, receive, send)
+        return
+
+    headers = dict(scope.get('headers', []))
+    last_event_id = headers.get(b'last-event-id', b'0').decode()
+    sent = int(last_event_id) if last_event_id.isdigit() else 0
+
+    await send_events_headers(send)
+    disconnected = asyncio.ensure_future(wait_disconnect(receive))
+    idle_time = 0
+    try:
+        while not disconnected.done():
+            finished = job.finished   # Read before the events, so the last events are never lost
+            events = job.events[sent:]
+            if events:
+                body = ''
+                for event in events:
+                    sent += 1
+                    body += f"id: {sent}\nevent: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
+                await send({'type': 'http.response.body', 'body': body.encode('utf-8'), 'more_body': True})
+                idle_time = 0
+            elif idle_time >= KEEP_ALIVE_INTERVAL:
+                await send({'type': 'http.response.body', 'body': b': keep-alive\n\n', 'more_body': True})
+                idle_time = 0
+            if finished and sent >= len(job.events):
+                break
+            await asyncio.sleep(POLL_INTERVAL)
+            idle_time += POLL_INTERVAL
+        if not disconnected.done():
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        disconnected.cancel()
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------------------
+# TERRITORIAL DELIMITATION TOOLS (ICGC)
+# Authors: Fran Martin
+# Version: 1.0
+# Version Python: 3.7
+# ----------------------------------------------------------
+
+"""
+Background quality check jobs, whose reports and stage transitions can be followed while they are produced. The jobs
+run in the process that received them, but their status and the check they are running are saved into the
+database, so any process that serves the API can report, follow and cancel them. The events stream, with the reports,
+is only kept in the memory of the process that runs the job
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+import uuid
+
+from delimitapp.common.cancellation import CancellationToken
+
+# Max number of quality checks running at the same time
+QA_MAX_WORKERS = 2
+# Seconds that a finished job is kept in memory
+JOB_RETENTION = 3600
+
+
+class QAJob:
+    """Quality check of a line running in background"""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    PARTIAL = 'partial'
+    CANCELLED = 'cancelled'
+    ERROR = 'error'
+
+    def __init__(self, line_id, line_type):
+        self.job_id = uuid.uuid4().hex
+        self.line_id = line_id
+        self.line_type = line_type
+        self.status = self.PENDING
+        self.message = ''
+        self.report_id = None
+        self.created_at = time.time()
+        self.finished_at = None
+        # Check that the job is running
+        self.stage = ''
+        self.token = None
+        # Whether the job runs in this process or it has been loaded from the database
+        self.local = True
+        # Events produced by the job, in order. Appending to a list is atomic, so the readers don't need a lock
+        self.events = []
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        Get a job running in another process from its saved status
+        :param record: QAJobRecord of the job
+        :return: job - The job, without events
+        """
+        job = cls(record.line_id, record.line_type)
+        job.job_id = record.job_id
+        job.status = record.status
+        job.message = record.message
+        job.report_id = record.report_id or None
+        job.created_at = record.created_at
+        job.finished_at = record.finished_at
+        job.stage = record.stage
+        job.local = False
+        return job
+
+    @property
+    def finished(self):
+        return self.status in (self.DONE, self.PARTIAL, self.CANCELLED, self.ERROR)
+
+    def cancel(self):
+        """
+        Cancel the job. A pending job doesn't start, and a running one stops at its next check and sends a partial
+        report
+        :return: boolean that indicates whether the job could be cancelled or it was already finished
+        """
+        if self.finished:
+            return False
+        if not self.local:
+            # The process that runs the job stops it when it reads the request
+            request_cancel(self.job_id)
+        elif self.token is None:
+            self.set_status(self.CANCELLED, "Procés cancel·lat abans de començar")
+        else:
+            self.token.cancel()
+        return True
+
+    def add_event(self, event, data):
+        """
+        Add an event to the job
+        :param event: event type, as 'stage', 'report', 'status' or 'done'
+        :param data: dict with the event data
+        """
+        self.events.append({'event': event, 'data': data})
+
+    def set_status(self, status, message=''):
+        """Set the job status and add its event"""
+        self.status = status
+        self.message = message
+        if self.finished:
+            self.finished_at = time.time()
+        save_job(self)
+        self.add_event('done' if self.finished else 'status', self.to_dict())
+
+    def to_dict(self):
+        """Job's status as a dict"""
+        return {
+            'job_id': self.job_id,
+            'line_id': self.line_id,
+            'line_type': self.line_type,
+            'status': self.status,
+            'message': self.message,
+            'report_id': self.report_id
+        }
+
+
+class JobEventHandler(logging.Handler):
+    """Logging handler that adds the QA reports to a job as events"""
+
+    def __init__(self, job):
+        super().__init__()
+        self.job = job
+        self.check = ''
+
+    def emit(self, record):
+        message = record.getMessage()
+        if not message.startswith(' '):   # Reports without indentation are the beginning of a check
+            self.check = message
+            self.job.stage = message
+            self.job.add_event('stage', {'check': message})
+            # The other processes follow the job by its saved stage, and can request its cancellation
+            save_stage(self.job.job_id, message)
+            if self.job.token is not None and is_cancel_requested(self.job.job_id):
+                self.job.token.cancel()
+        self.job.add_event('report', {'level': record.levelname, 'report_message': message, 'check': self.check})
+
+
+_executor = ThreadPoolExecutor(max_workers=QA_MAX_WORKERS)
+_jobs = {}
+_jobs_lock = threading.Lock()
+logger = logging.getLogger(__name__)
+
+
+def save_job(job):
+    """
+    Save the status of a job into the database. If it can't be saved, the job is only known by this process
+    :param job: the job to save
+    """
+    from qa_line.models import QAJobRecord
+
+    try:
+        QAJobRecord.objects.update_or_create(job_id=job.job_id, defaults={
+            'line_id': job.line_id,
+            'line_type': job.line_type,
+            'status': job.status,
+            'message': job.message,
+            'report_id': job.report_id or '',
+            'created_at': job.created_at,
+            'finished_at': job.finished_at
+        })
+    except Exception as e:
+        logger.warning(f"No s'ha pogut desar l'estat del procés {job.job_id} => {e}")
+
+
+def save_stage(job_id, stage):
+    """Save the check that a job is running, for the processes that follow it from its saved status"""
+    from qa_line.models import QAJobRecord
+
+    try:
+        QAJobRecord.objects.filter(job_id=job_id).update(stage=stage)
+    except Exception as e:
+        logger.warning(f"No s'ha pogut desar l'etapa del procés {job_id} => {e}")
+
+
+def request_cancel(job_id):
+    """Request the cancellation of a job that runs in another process"""
+    from qa_line.models import QAJobRecord
+
+    QAJobRecord.objects.filter(job_id=job_id, finished_at__isnull=True).update(cancel_requested=True)
+
+
+def is_cancel_requested(job_id):
+    """Check whether the cancellation of a job has been requested from another process"""
+    from qa_line.models import QAJobRecord
+
+    try:
+        return QAJobRecord.objects.filter(job_id=job_id, cancel_requested=True).exists()
+    except Exception:
+        return False
+
+
+def submit_job(line_id, line_type):
+    """
+    Submit a quality check job
+    :param line_id: line ID
+    :param line_type: line type, 'mtt' or 'rep'
+    :return: job - The job submitted
+    """
+    job = QAJob(line_id, line_type)
+    with _jobs_lock:
+        # Forget the old finished jobs
+        now = time.time()
+        for job_id in [job_id for job_id, job_ in _jobs.items() if job_.finished and now - job_.finished_at > JOB_RETENTION]:
+            del _jobs[job_id]
+        _jobs[job.job_id] = job
+    save_job(job)
+    _executor.submit(run_job, job)
+
+    return job
+
+
+def get_job(job_id):
+    """
+    Get a job by its ID. The jobs of other processes, or finished longer than JOB_RETENTION ago, are loaded from
+    the database
+    :param job_id: job ID
+    :return: job - The job, or None if it doesn't exist
+    """
+    from qa_line.models import QAJobRecord
+
+    job = _jobs.get(job_id)
+    if job is None:
+        record = QAJobRecord.objects.filter(job_id=job_id).first()
+        job = QAJob.from_record(record) if record is not None else None
+    return job
+
+
+def run_job(job):
+    """
+    Run the quality check of a job
+    :param job: the job to run
+    """
+    from qa_line.views import CheckQualityLine, QA_STAGE_BUDGETS
+
+    if job.finished:   # Cancelled while pending
+        return
+    if is_cancel_requested(job.job_id):
+        job.set_status(QAJob.CANCELLED, "Procés cancel·lat abans de començar")
+        return
+    job.token = CancellationToken(QA_STAGE_BUDGETS)
+    job.set_status(QAJob.RUNNING)
+    try:
+        qa = CheckQualityLine()
+        input_error = qa.check_input(job.line_id)
+        if input_error:
+            job.set_status(QAJob.ERROR, input_error)
+            return
+        response = qa.run_qa(job.line_id, job.line_type, log_handlers=[JobEventHandler(job)], token=job.token,
+                             run_id=job.job_id)
+        job.report_id = qa.report_id
+        if response['response']['result'] == 'error':
+            job.set_status(QAJob.ERROR, response['response']['message'])
+        elif response['response']['result'] == 'partial':
+            status = QAJob.CANCELLED if job.token.cancelled else QAJob.PARTIAL
+            job.set_status(status, response['response']['message'])
+        else:
+            job.set_status(QAJob.DONE, response['response']['message'])
+    except Exception as e:
+        job.set_status(QAJob.ERROR, f'Error inesperat executant el control de qualitat => {e}')
@@ -1,17 +1,161 @@
+import glob
+import os
+import os.path as path
+import shutil
+import time
+from contextlib import closing
+from datetime import datetime
 from django.core.management.base import BaseCommand
-from osgeo import gdal
 from qa_line.config import *
-from fiona import listlayers
+from qa_line.management.commands.updatedb import SYNC_STATE_TABLE, SNAPSHOT_MIN_AGE, get_staging_dir
+from qa_line.jobs import JOB_RETENTION
+from qa_line.reports import remove_old_reports
+from qa_line.models import QAJobRecord
+from qa_line.views import WORKSPACES_DIR, QA_STAGE_BUDGETS
+from municat_generator.views import WORKSPACES_DIR as MUNICAT_WORKSPACES_DIR
+from delimitapp.common.gpkgwriter import GpkgWriter
+from delimitapp.common.reference import connect, get_current_snapshot, get_snapshot_path, get_store_dir, \
+    get_columnar_dir, get_published_marker, publish_snapshot, remove_old_snapshots
+
+# Folders and files not modified for longer than this are left by crashed runs, as no run can last so long
+ORPHAN_AGE = 2 * QA_STAGE_BUDGETS['total']   # Seconds
 
 
 class Command(BaseCommand):
-    """Clear and remove temp layers in the geopackage database"""
+    """
+    Maintenance of the working geopackage: remove the temp layers, report the size and free pages of every layer,
+    rebuild the indexes, VACUUM and ANALYZE, and remove the folders and files left by crashed runs, the old jobs and
+    the old reports
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--report', action='store_true', help='Only report the size of the layers')
+        parser.add_argument('--no-vacuum', action='store_true', help="Don't rebuild the indexes and VACUUM")
 
     def handle(self, *args, **options):
-        """Remove all of the temporal files from the workspace"""
-        gpkg = gdal.OpenEx(WORK_GPKG, gdal.OF_UPDATE, allowed_drivers=['GPKG'])
-        for layer_name in listlayers(WORK_GPKG):
-            if layer_name not in PERSISTENT_ENTITIES:
-                gpkg.ExecuteSQL(f'DROP TABLE {layer_name}')
+        """Clear and maintain the working geopackage and the published reference snapshot"""
+        version, current_gpkg = get_current_snapshot(WORK_GPKG)
+        if options['report']:
+            self.write_report(WORK_GPKG)
+            if version:
+                self.write_report(current_gpkg)
+            return
 
+        # Remove all of the temporal layers from the workspace
+        with GpkgWriter(WORK_GPKG, journal_mode=None) as writer:
+            writer.drop_layers(keep=set(PERSISTENT_ENTITIES) | {SYNC_STATE_TABLE})
         self.stdout.write('Arxius temporals esborrats')
+
+        if not options['no_vacuum']:
+            self.compact(WORK_GPKG)
+            if version:
+                self.compact_snapshot(current_gpkg)
+        self.remove_orphans()
+        self.remove_old_jobs()
+        self.stdout.write(f'{remove_old_reports()} informes antics esborrats')
+
+    def write_report(self, gpkg):
+        """
+        Write the size of every layer and the free pages of a geopackage. The size of the layers is taken from
+        the dbstat table, which not every SQLite build has
+        :param gpkg: path to the geopackage
+        """
+        with closing(connect(gpkg)) as conn:
+            page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+            page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+            freelist_count = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            layer_names = [row[0] for row in conn.execute('SELECT table_name FROM gpkg_contents ORDER BY table_name')]
+            try:
+                sizes = dict(conn.execute('SELECT name, SUM(pgsize) FROM dbstat GROUP BY name').fetchall())
+            except Exception:
+                sizes = {}
+            self.stdout.write(f'{gpkg}: {page_count * page_size / 2 ** 20:.1f} MB, {freelist_count} pagines lliures '
+                              f'de {page_count} ({100 * freelist_count / max(page_count, 1):.1f}%)')
+            for layer_name in layer_names:
+                n_features = conn.execute(f'SELECT COUNT(*) FROM "{layer_name}"').fetchone()[0]
+                # The size of a layer includes its attribute and spatial indexes
+                layer_size = sum(size for name, size in sizes.items()
+                                 if name == layer_name or name.startswith((f'idx_{layer_name}_', f'rtree_{layer_name}_')))
+                size_text = f'{layer_size / 2 ** 20:.1f} MB' if sizes else 'mida desconeguda'
+                self.stdout.write(f'   {layer_name}: {n_features} elements, {size_text}')
+
+    def compact(self, gpkg):
+        """
+        Rebuild the indexes of a geopackage, VACUUM it and update the statistics of the query planner. The
+        geopackage can't be in use, as VACUUM needs an exclusive lock
+        :param gpkg: path to the geopackage
+        """
+        self.write_report(gpkg)
+        with GpkgWriter(gpkg, journal_mode=None) as writer:
+            for table_name, column_name in writer.query('SELECT table_name, column_name FROM gpkg_geometry_columns'):
+                has_spatial_index = writer.query(f"SELECT HasSpatialIndex('{table_name}', '{column_name}')")[0][0]
+                if has_spatial_index:
+                    writer.execute(f"SELECT DisableSpatialIndex('{table_name}', '{column_name}')")
+                    writer.execute(f"SELECT CreateSpatialIndex('{table_name}', '{column_name}')")
+            writer.execute('REINDEX')
+            writer.execute('VACUUM')
+            writer.execute('ANALYZE')
+        self.stdout.write('Index reconstruits i geopackage compactat')
+        self.write_report(gpkg)
+
+    def compact_snapshot(self, current_gpkg):
+        """
+        Compact the published reference snapshot. The snapshot is being read by the running processes, so it's
+        compacted as a copy that is published as a new version, together with its store and columnar snapshots
+        :param current_gpkg: path to the current snapshot
+        """
+        version = datetime.now().strftime('%Y%m%d%H%M%S')
+        new_gpkg = get_snapshot_path(WORK_GPKG, version)
+        shutil.copyfile(current_gpkg, new_gpkg)
+        try:
+            for get_dir in get_store_dir, get_columnar_dir:
+                if path.exists(get_dir(current_gpkg)):
+                    shutil.copytree(get_dir(current_gpkg), get_dir(new_gpkg))
+            self.compact(new_gpkg)
+        except Exception:
+            os.remove(new_gpkg)
+            for get_dir in get_store_dir, get_columnar_dir:
+                shutil.rmtree(get_dir(new_gpkg), ignore_errors=True)
+            raise
+        publish_snapshot(WORK_GPKG, version)
+        remove_old_snapshots(WORK_GPKG, SNAPSHOT_MIN_AGE)
+        self.stdout.write(f'Dades de referencia compactades a la versio {version}')
+
+    def remove_old_jobs(self):
+        """
+        Remove the saved status of the jobs finished longer than JOB_RETENTION ago, and of the jobs that never
+        finished because their process crashed
+        """
+        now = time.time()
+        n_removed, _ = QAJobRecord.objects.filter(finished_at__lt=now - JOB_RETENTION).delete()
+        n_crashed, _ = QAJobRecord.objects.filter(finished_at__isnull=True, created_at__lt=now - ORPHAN_AGE).delete()
+        self.stdout.write(f'{n_removed + n_crashed} processos antics esborrats')
+
+    def remove_orphans(self):
+        """
+        Remove the workspaces, with the line folders copied into them, and unpublished snapshots, with their staging
+        geopackages, left by crashed runs. Only the ones that have not been modified for longer than ORPHAN_AGE are removed
+        """
+        current_version, _ = get_current_snapshot(WORK_GPKG)
+        snapshot_prefix = f'{path.splitext(WORK_GPKG)[0]}.'
+        # Workspaces of the QA and Municat runs
+        orphans = glob.glob(path.join(WORKSPACES_DIR, '*')) + glob.glob(path.join(MUNICAT_WORKSPACES_DIR, '*'))
+        # Snapshots newer than the current one were never published
+        for snapshot in glob.glob(f'{glob.escape(snapshot_prefix)}[0-9]*.gpkg'):
+            version = snapshot[len(snapshot_prefix):-len('.gpkg')]
+            if version > current_version:
+                orphans += [snapshot, get_store_dir(snapshot), get_columnar_dir(snapshot), get_published_marker(snapshot),
+                            get_staging_dir(snapshot)]
+
+        now = time.time()
+        n_removed = 0
+        for orphan in orphans:
+            if not path.exists(orphan) or now - path.getmtime(orphan) < ORPHAN_AGE:
+                continue
+            if path.isdir(orphan):
+                shutil.rmtree(orphan, ignore_errors=True)
+            else:
+                os.remove(orphan)
+            n_removed += 1
+            self.stdout.write(f'   Esborrat {orphan}')
+        self.stdout.write(f"{n_removed} carpetes i arxius orfes esborrats")
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------------------
+# TERRITORIAL DELIMITATION TOOLS (ICGC)
+# Authors: Fran Martin
+# Version: 1.0
+# Version Python: 3.7
+# ----------------------------------------------------------
+
+"""
+Load test of the QA, Municat and letters endpoints. Generates synthetic line folders, calls the
+endpoints against a running server at increasing concurrency, and reports the latency percentiles and the errors of
+every endpoint. The synthetic folders and the runs they produce are removed at the end, unless --keep is given
+"""
+
+import json
+import os
+import shutil
+import time
+import random
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import CookieJar
+from urllib.parse import urlencode, urlparse
+from urllib.request import build_opener, HTTPCookieProcessor
+
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import Point, LineString
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from qa_line.config import *
+from qa_line.views import PREFLIGHT_FIELDS
+from qa_line.models import QARun, QAJobRecord
+from delimitapp.common.crs import TARGET_CRS
+
+# Synthetic lines' IDs start from this value, in order to not overwrite any real line
+SYNTHETIC_LINE_ID = 9000
+REQUEST_TIMEOUT = 600   # Seconds
+
+
+class Command(BaseCommand):
+    """Load test of the QA, Municat and letters endpoints against a running server, at increasing concurrency"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default='http://127.0.0.1:8000', help='URL of the running server')
+        parser.add_argument('--concurrency', default='1,2,4,8', help='Concurrency levels, separated by commas')
+        parser.add_argument('--requests', type=int, default=20, help='Number of requests of every concurrency level')
+        parser.add_argument('--mix', default='qa=8,municat=1,letters=1',
+                            help='Weight of every endpoint in the requests mix, as qa=8,municat=1,letters=1')
+        parser.add_argument('--lines', type=int, default=4, help='Number of synthetic lines to create')
+        parser.add_argument('--points', type=int, default=200, help='Number of points of every synthetic line')
+        parser.add_argument('--line-type', choices=['mtt', 'rep'], default='mtt', help='Type of the synthetic lines')
+        parser.add_argument('--expedient', help='Expedient of the letters generation requests')
+        parser.add_argument('--keep', action='store_true', help="Don't remove the synthetic lines at the end")
+        parser.add_argument('--seed', type=int, default=0, help='Random seed of the requests mix')
+
+    def handle(self, *args, **options):
+        """Run the load test"""
+        mix = self.parse_mix(options['mix'])
+        if 'letters' in mix and not options['expedient']:
+            self.stdout.write("No s'ha indicat cap expedient, s'exclouen les cartes de la barreja")
+            del mix['letters']
+        if not mix:
+            raise CommandError('La barreja de peticions és buida')
+        concurrency_levels = [int(level) for level in options['concurrency'].split(',')]
+
+        line_ids = []
+        if 'qa' in mix:
+            line_ids = [str(SYNTHETIC_LINE_ID + i) for i in range(options['lines'])]
+            # Never overwrite the folders of a line, as a real one could use the same ID
+            for line_id in line_ids:
+                for folder in (os.path.join(UPLOAD_DIR, line_id), os.path.join(LINES_DIR, line_id)):
+                    if os.path.exists(folder):
+                        raise CommandError(f'Ja existeix la carpeta {folder}, no es pot crear la linia sintètica')
+
+        rng = random.Random(options['seed'])
+        test_started_at = timezone.now()
+        try:
+            for line_id in line_ids:
+                self.create_synthetic_line(line_id, options['line_type'], options['points'])
+            if line_ids:
+                self.stdout.write(f"{len(line_ids)} linies sintètiques de {options['points']} punts creades")
+            self.stdout.write('Concurrencia\tPeticions\tPet/s\tp50 (s)\tp90 (s)\tp99 (s)\tMaxim (s)\tErrors (%)')
+            for concurrency in concurrency_levels:
+                calls = [self.get_call(rng.choices(list(mix), weights=list(mix.values()))[0], rng, line_ids, options)
+                         for _ in range(options['requests'])]
+                started_at = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                    results = list(executor.map(lambda call: self.run_call(*call), calls))
+                elapsed = time.perf_counter() - started_at
+                self.write_results(concurrency, results, elapsed)
+        finally:
+            if not options['keep']:
+                for line_id in line_ids:
+                    self.remove_synthetic_line(line_id)
+            # The synthetic runs must not appear in the QA history
+            if line_ids:
+                QARun.objects.filter(line_id__in=[int(line_id) for line_id in line_ids],
+                                     started_at__gte=test_started_at).delete()
+                QAJobRecord.objects.filter(line_id__in=line_ids, created_at__gte=test_started_at.timestamp()).delete()
+
+    @staticmethod
+    def parse_mix(mix_text):
+        """
+        Parse the requests mix
+        :param mix_text: mix as endpoint=weight pairs separated by commas
+        :return: mix - Dict with the weight of every endpoint
+        """
+        mix = {}
+        for item in mix_text.split(','):
+            endpoint, _, weight = item.partition('=')
+            if endpoint not in ('qa', 'municat', 'letters'):
+                raise CommandError(f'Endpoint desconegut: {endpoint}')
+            if float(weight or 1) > 0:
+                mix[endpoint] = float(weight or 1)
+        return mix
+
+    @staticmethod
+    def get_call(endpoint, rng, line_ids, options):
+        """
+        Get the request of an endpoint
+        :return: endpoint - Endpoint name
+        :return: url - URL to request
+        :return: success_path - Path where the request ends when it succeeds, or None if any path means success
+        """
+        base_url = options['base_url'].rstrip('/')
+        if endpoint == 'qa':
+            query = urlencode({'line_id': rng.choice(line_ids), 'line_type': options['line_type']})
+            # The QA renders the errors in place, and redirects to the report page only when the check is done
+            return endpoint, f'{base_url}/qa-line/check/?{query}', '/qa-line/report'
+        elif endpoint == 'municat':
+            return endpoint, f'{base_url}/municat/', None
+        query = urlencode({'expedient': options['expedient']})
+        return endpoint, f'{base_url}/doc-generator/letters/generate-doc/?{query}', None
+
+    @staticmethod
+    def run_call(endpoint, url, success_path):
+        """
+        Request an URL, following the redirects with its own session. The JSON responses with an 'error' result
+        and the requests that don't end in the success path are errors too
+        :return: endpoint - Endpoint name
+        :return: latency - Seconds until the response is read
+        :return: ok - Boolean that indicates whether the request succeeded
+        """
+        opener = build_opener(HTTPCookieProcessor(CookieJar()))
+        started_at = time.perf_counter()
+        try:
+            with opener.open(url, timeout=REQUEST_TIMEOUT) as response:
+                body = response.read()
+                ok = response.status < 400
+                if success_path is not None:
+                    ok = ok and urlparse(response.geturl()).path.rstrip('/') == success_path
+                if ok and response.headers.get_content_type() == 'application/json':
+                    data = json.loads(body)
+                    ok = data.get('response', data).get('result') != 'error'
+        except (OSError, ValueError):   # Includes the HTTP errors, the timeouts and the invalid JSON responses
+            ok = False
+        return endpoint, time.perf_counter() - started_at, ok
+
+    def write_results(self, concurrency, results, elapsed):
+        """Write the throughput, latency percentiles and error rate of a concurrency level, total and by endpoint"""
+        groups = defaultdict(list)
+        for endpoint, latency, ok in results:
+            groups['total'].append((latency, ok))
+            groups[endpoint].append((latency, ok))
+        for name, group in groups.items():
+            latencies = np.array([latency for latency, ok in group])
+            errors = sum(1 for latency, ok in group if not ok)
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+            label = f'{concurrency}' if name == 'total' else f'  {name}'
+            self.stdout.write(f'{label}\t{len(group)}\t{len(group) / elapsed:.2f}\t{p50:.2f}\t{p90:.2f}\t{p99:.2f}\t'
+                              f'{latencies.max():.2f}\t{100 * errors / len(group):.1f}')
+
+    @staticmethod
+    def create_synthetic_line(line_id, line_type, n_points):
+        """
+        Create a synthetic line's folder into the uploading directory, with a zigzag line of found fites
+        :param line_id: ID of the synthetic line
+        :param line_type: line type, 'mtt' or 'rep'
+        :param n_points: number of points of the line
+        """
+        line_folder = os.path.join(UPLOAD_DIR, line_id)
+        doc_delim = os.path.join(line_folder, 'DocDelim')
+        for sub_dir in set(SUB_DIR_LIST) | {'Cartografia', 'Taules', 'Fotografies'}:
+            os.makedirs(os.path.join(doc_delim, sub_dir), exist_ok=True)
+        # Logs' directories
+        for log_dir in (WORK_REC_DIR, WORK_REP_DIR):
+            os.makedirs(os.path.join(LINES_DIR, line_id, log_dir), exist_ok=True)
+
+        # Points along a zigzag line, south of Catalonia in order to not touch the real lines
+        x0, y0 = 300000 + 1000 * (int(line_id) - SYNTHETIC_LINE_ID), 4400000
+        coords = [(x0 + 50 * i, y0 + (25 if i % 2 else 0), 100.0 + i % 7) for i in range(n_points)]
+        point_ids = [f'{line_id}-{i + 1}' for i in range(n_points)]
+        etiquetes = [f'F-{i + 1}' for i in range(n_points)]
+
+        layers = {
+            'Punt': gpd.GeoDataFrame({
+                'ID_PUNT': point_ids, 'ETIQUETA': etiquetes, 'CONTACTE': [None] * n_points,
+                'FOTOS': [f'{etiqueta}.jpg' for etiqueta in etiquetes]
+            }, geometry=[Point(coord) for coord in coords], crs=TARGET_CRS),
+            'PUNT_FIT': gpd.GeoDataFrame({
+                'ID_PUNT': point_ids, 'ID_FITA': [str(i + 1) for i in range(n_points)], 'TROBADA': ['1'] * n_points,
+                'AUX': ['0'] * n_points
+            }),
+            'P_Proposta': gpd.GeoDataFrame({
+                'ID_PUNT': point_ids, 'PFF': [1] * n_points, 'ESFITA': [1] * n_points,
+                'ORDPF': list(range(1, n_points + 1))
+            })
+        }
+        trams = [LineString([coords[i][:2], coords[i + 1][:2]]) for i in range(n_points - 1)]
+        tram_layer_name = 'Lin_TramPpta' if line_type == 'mtt' else 'Lin_Tram'
+        tram_fields = {field: [None] * len(trams) for field in PREFLIGHT_FIELDS[tram_layer_name]}
+        tram_fields.update({
+            'ID': list(range(1, len(trams) + 1)), 'ID_LINIA': [int(line_id)] * len(trams),
+            'ID_FITA1': point_ids[:-1], 'ID_FITA2': point_ids[1:]
+        })
+        if line_type == 'rep':
+            tram_fields['ID_TRAM'] = list(range(1, len(trams) + 1))
+        layers[tram_layer_name] = gpd.GeoDataFrame(tram_fields, geometry=trams, crs=TARGET_CRS)
+
+        shapes_list = OFFICIAL_SHAPES_LIST if line_type == 'mtt' else NONOFFICIAL_SHAPES_LIST
+        entities = [(os.path.join(doc_delim, 'Cartografia'), shape) for shape in shapes_list]
+        entities += [(os.path.join(doc_delim, 'Taules'), dbf) for dbf in TABLE_LIST]
+        for folder, entity in entities:
+            entity_name = entity.split('.')[0]
+            if entity_name not in layers:   # Other layers are written empty
+                layers[entity_name] = gpd.GeoDataFrame({'ID': [1]}, geometry=[Point(x0, y0)], crs=TARGET_CRS).iloc[:0]
+            layer = layers[entity_name]
+            if 'geometry' not in layer.columns:   # Tables are written as DBF files
+                layer = gpd.GeoDataFrame(layer.assign(geometry=[Point(0, 0)] * len(layer)), crs=TARGET_CRS)
+                layer.to_file(os.path.join(folder, f'{entity_name}.shp'))
+                for extension in ('.shp', '.shx', '.prj', '.cpg'):
+                    path_ = os.path.join(folder, f'{entity_name}{extension}')
+                    if os.path.exists(path_):
+                        os.remove(path_)
+            else:
+                layer.to_file(os.path.join(folder, f'{entity_name}.shp'))
+
+        # Photos of the found points
+        for etiqueta in etiquetes:
+            open(os.path.join(doc_delim, 'Fotografies', f'{etiqueta}.jpg'), 'wb').close()
+
+    @staticmethod
+    def remove_synthetic_line(line_id):
+        """Remove a synthetic line's folders"""
+        for folder in (os.path.join(UPLOAD_DIR, line_id), os.path.join(LINES_DIR, line_id)):
+            if os.path.exists(folder):
+                shutil.rmtree(folder)
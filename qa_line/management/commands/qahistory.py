@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from qa_line.models import QARun
+from qa_line.views import QA_CHECKS
+
+
+class Command(BaseCommand):
+    """Query the QA history across lines"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--failing', metavar='CHECK', choices=QA_CHECKS,
+                            help=f"Lines whose latest run fails the check, given its key: {', '.join(QA_CHECKS)}")
+        parser.add_argument('--durations', action='store_true', help='QA duration grouped by the line size')
+        parser.add_argument('--bin-size', type=int, default=10000, help='Number of vertexs of every line size group')
+
+    def handle(self, *args, **options):
+        """Query the QA history"""
+        if options['failing']:
+            runs = QARun.objects.failing_check(options['failing']).order_by('line_id').distinct()
+            for run in runs:
+                self.stdout.write(f"{run.line_id}\t{run.line_type}\t{run.started_at:%Y-%m-%d %H:%M}\t{run.report_id}")
+            self.stdout.write(f"{len(runs)} linies fallen el control")
+
+        if options['durations']:
+            self.stdout.write('Vertex\tExecucions\tMitjana (s)\tMaxim (s)')
+            for group in QARun.objects.duration_by_size(options['bin_size']):
+                self.stdout.write(f"{group['vertexs_bin']}\t{group['n_runs']}\t{group['mean_duration']:.1f}\t"
+                                  f"{group['max_duration']:.1f}")
@@ -1,31 +1,337 @@
 import os
-from django.core.management.base import BaseCommand
-import geopandas as gpd
+import os.path as path
+import shutil
+import sqlite3
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from osgeo import gdal, ogr
 from qa_line.config import *
+from delimitapp.common.reference import get_current_snapshot, get_snapshot_path, get_store_dir, \
+    get_columnar_dir, publish_snapshot, remove_old_snapshots, get_removable_snapshots, remove_snapshot
+from delimitapp.common.geomstore import build_store
+from delimitapp.common.columnar import build_columnar
+from delimitapp.common.gpkgwriter import GpkgWriter
+from delimitapp.common.utils import clone_file
+from delimitapp.common.postgis import REFERENCE_VIEWS
+from qa_line.views import QA_STAGE_BUDGETS
+from municat_generator.views import MUNICAT_STAGE_BUDGETS
+
+# Layers of the local working geopackage -> PostGIS view and its key field
+SYNC_LAYERS = {
+    'fita_mem': (REFERENCE_VIEWS['fita_mem'], 'id_fita'),
+    'tram_linia_mem': (REFERENCE_VIEWS['tram_linia_mem'], 'id_tram_linia'),
+    'fita_rep': (REFERENCE_VIEWS['fita_rep'], 'id_fita'),
+    'tram_linia_rep': (REFERENCE_VIEWS['tram_linia_rep'], 'id_tram_linia')
+}
+# Table of the local working geopackage with the hash of every feature synchronized
+SYNC_STATE_TABLE = 'sync_state'
+# Number of features deleted or requested to the database at once
+SYNC_BATCH_SIZE = 1000
+# Number of layers whose hashes are requested, or that are copied whole, at the same time, each one with its own
+# database connection
+TRANSFER_WORKERS = 4
+# Number of features written in every transaction of a layer transfer
+TRANSFER_BATCH_SIZE = 65536
+PG_CONNECTION = f'PG:host={host} user={user} dbname={dbname} password={pwd}'
+# The snapshot being built isn't published until it's complete, and it's removed if the update fails, so its writes
+# don't need to be synced. It keeps the rollback journal, as the readers open the published snapshots read-only
+SNAPSHOT_SYNCHRONOUS = 'OFF'
+# Seconds that a superseded snapshot is kept, as the QA and Municat runs that resolved it can last up to their total
+# time budget
+SNAPSHOT_MIN_AGE = max(QA_STAGE_BUDGETS['total'], MUNICAT_STAGE_BUDGETS['total'])
+# Fields of the reference layers used by the lookups of the QA and Municat, which get an attribute index
+REFERENCE_INDEXES = {
+    'fita_mem': ('id_fita', 'id_linia', 'id_sessio_carrega'),
+    'tram_linia_mem': ('id_tram_linia', 'id_linia', 'id_sessio_carrega'),
+    'fita_rep': ('id_fita', 'id_linia'),
+    'tram_linia_rep': ('id_tram_linia', 'id_linia'),
+    'id_linia_muni': ('IDLINIA',)
+}
+# Reference layers written into the memory-mapped geometry store shared by the workers, with their stored attributes
+STORE_LAYERS = {
+    'fita_mem': ('id_fita', 'id_linia'),
+    'tram_linia_mem': ('id_tram_linia', 'id_linia'),
+    'fita_rep': ('id_fita', 'id_linia'),
+    'tram_linia_rep': ('id_tram_linia', 'id_linia')
+}
+
+
+def get_staging_dir(gpkg):
+    """Get the directory of the staging geopackages of the layers copied whole into a snapshot"""
+    return f'{path.splitext(gpkg)[0]}.staging'
+
+
+def get_batches(items, size=SYNC_BATCH_SIZE):
+    """Split a list into batches of the given size"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
 
 class Command(BaseCommand):
     """Update the local database with data from the PostGIS"""
+    # Snapshot of the working geopackage being built, its writer and the connection to its sync state
+    gpkg = None
+    writer = None
+    state = None
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Copy all the layers, instead of only the changes')
 
     def handle(self, *args, **options):
-        """Update local database"""
-        # Export layers to the updating environment
-        cmd = f'''ogr2ogr -f GPKG {UPDATING_GPKG} PG:"host={host} user={user} dbname={dbname} password={pwd} tables=sidm3.v_fita_mem,sidm3.v_tram_linia_mem,sidm3.v_fita_rep,sidm3.v_tram_linia_rep"'''
-        os.system(cmd)
-        # Copy layers to the local working geopackage
-        # Official
-        # Points
-        point_mem_gdf = gpd.read_file(UPDATING_GPKG, layer='sidm3.v_fita_mem')
-        point_mem_gdf.to_file(WORK_GPKG, layer='fita_mem', driver="GPKG")
-        # Tram line
-        tram_mem_gdf = gpd.read_file(UPDATING_GPKG, layer='sidm3.v_tram_linia_mem')
-        tram_mem_gdf.to_file(WORK_GPKG, layer='tram_linia_mem', driver="GPKG")
-        # Non official
-        # Points
-        point_rep_gdf = gpd.read_file(UPDATING_GPKG, layer='sidm3.v_fita_rep')
-        point_rep_gdf.to_file(WORK_GPKG, layer='fita_rep', driver="GPKG")
-        # Tram line
-        tram_rep_gdf = gpd.read_file(UPDATING_GPKG, layer='sidm3.v_tram_linia_rep')
-        tram_rep_gdf.to_file(WORK_GPKG, layer='tram_linia_rep', driver="GPKG")
-
-        print("Geopackage local actualitzat")
+        """
+        Update local database. The update is built into a new snapshot of the working geopackage, which is published
+        only when it's complete, so the running QA and Municat processes keep reading the snapshot they started with
+        """
+        pg = ogr.Open(PG_CONNECTION)
+        if pg is None:
+            raise CommandError("No s'ha pogut connectar a la base de dades")
+        _, current_gpkg = get_current_snapshot(WORK_GPKG)
+        version = datetime.now().strftime('%Y%m%d%H%M%S')
+        self.gpkg = get_snapshot_path(WORK_GPKG, version)
+        base_gpkg = self.create_snapshot(current_gpkg)
+        # All the writes of the update go through a single handle of the snapshot
+        self.writer = GpkgWriter(self.gpkg, journal_mode=None, synchronous=SNAPSHOT_SYNCHRONOUS)
+        self.state = sqlite3.connect(self.gpkg)
+        self.state.execute(f'PRAGMA synchronous={SNAPSHOT_SYNCHRONOUS}')
+        try:
+            changed_layers = self.update_snapshot(pg, options['full'])
+            self.state.close()
+            self.writer.close()
+            # Only the changed layers are written again, the others are linked from the snapshot it was built from
+            build_store(self.gpkg, STORE_LAYERS, base_gpkg, changed_layers)
+            self.stdout.write('   Magatzem de geometries de referencia creat')
+            if build_columnar(self.gpkg, get_columnar_dir(self.gpkg), SYNC_LAYERS, get_columnar_dir(base_gpkg),
+                              changed_layers):
+                self.stdout.write('   Capes de referencia exportades a GeoParquet')
+            else:
+                self.stdout.write("   pyarrow no està instal·lat, no s'exporten les capes de referencia a GeoParquet")
+        except Exception:
+            self.state.close()
+            self.writer.close()
+            os.remove(self.gpkg)
+            shutil.rmtree(get_store_dir(self.gpkg), ignore_errors=True)
+            shutil.rmtree(get_columnar_dir(self.gpkg), ignore_errors=True)
+            raise
+        finally:
+            pg = None   # Close the connection
+            if base_gpkg != current_gpkg:
+                # The rest of the recycled snapshot is only needed while building the new one
+                remove_snapshot(base_gpkg)
+        publish_snapshot(WORK_GPKG, version)
+        remove_old_snapshots(WORK_GPKG, SNAPSHOT_MIN_AGE)
+        self.stdout.write(f"Geopackage local actualitzat a la versio {version}")
+
+    def create_snapshot(self, current_gpkg):
+        """
+        Create the new snapshot without copying the whole geopackage. The newest snapshot that no reader can be using
+        anymore is recycled, renaming it, and the update brings it up to date from its own sync state. Otherwise, the
+        current snapshot is cloned, which only shares its blocks on the filesystems with copy-on-write clones and
+        copies it on the rest
+        :param current_gpkg: path to the current snapshot
+        :return: base_gpkg - Path to the snapshot the new one is built from
+        """
+        for snapshot in get_removable_snapshots(WORK_GPKG, SNAPSHOT_MIN_AGE)[:1]:
+            try:
+                os.replace(snapshot, self.gpkg)
+                self.stdout.write(f'   Snapshot {snapshot} reutilitzat')
+                return snapshot
+            except OSError:   # Still open by some process
+                pass
+        clone_file(current_gpkg, self.gpkg)
+        return current_gpkg
+
+    def update_snapshot(self, pg, full):
+        """
+        Update the snapshot. Only the features that are new, have changed or have been removed since the last
+        update are applied, comparing a hash of every feature computed by the PostGIS with the sync state
+        :param pg: PostGIS ogr datasource
+        :param full: whether to copy all the layers, instead of only the changes
+        :return: changed_layers - Set with the names of the layers that have changed
+        """
+        self.create_sync_state()
+        local_layers = set(self.get_local_layers())
+
+        # Layers that are copied whole, because they don't exist yet or a full update is requested
+        full_layers = [layer_name for layer_name in SYNC_LAYERS
+                       if full or layer_name not in local_layers or not self.load_sync_state(layer_name)]
+        # The hashes of all the layers are requested concurrently
+        with ThreadPoolExecutor(max_workers=TRANSFER_WORKERS) as executor:
+            all_remote_hashes = dict(zip(SYNC_LAYERS, executor.map(self.get_remote_hashes, SYNC_LAYERS)))
+        changed_layers = set(full_layers)
+        if full_layers:
+            self.full_copy(full_layers)
+            for layer_name in full_layers:
+                self.save_sync_state(layer_name, all_remote_hashes[layer_name], replace=True)
+                self.stdout.write(f'   Capa {layer_name} copiada completament')
+
+        for layer_name in SYNC_LAYERS:
+            if layer_name in full_layers:
+                continue
+            remote_hashes = all_remote_hashes[layer_name]
+            local_hashes = self.load_sync_state(layer_name)
+            new = [feature_id for feature_id in remote_hashes if feature_id not in local_hashes]
+            changed = [feature_id for feature_id, hash_ in remote_hashes.items()
+                       if feature_id in local_hashes and local_hashes[feature_id] != hash_]
+            removed = [feature_id for feature_id in local_hashes if feature_id not in remote_hashes]
+            if new or changed or removed:
+                changed_layers.add(layer_name)
+                self.apply_changes(pg, layer_name, new, changed, removed)
+                changed_hashes = {feature_id: remote_hashes[feature_id] for feature_id in new + changed}
+                self.save_sync_state(layer_name, changed_hashes, removed=removed)
+            self.stdout.write(f'   Capa {layer_name}: {len(new)} noves, {len(changed)} modificades, '
+                              f'{len(removed)} esborrades')
+
+        self.create_indexes()
+        return changed_layers
+
+    def create_indexes(self):
+        """
+        Create the attribute indexes of the reference layers and their R-tree spatial indexes, if they don't exist.
+        The full copies recreate the layers, so they are checked after every update
+        """
+        gpkg = self.writer.ds
+        for layer_name, fields in REFERENCE_INDEXES.items():
+            layer = gpkg.GetLayerByName(layer_name)
+            if layer is None:
+                continue
+            layer_defn = layer.GetLayerDefn()
+            for field in fields:
+                if layer_defn.GetFieldIndex(field) >= 0:
+                    self.writer.execute(f'CREATE INDEX IF NOT EXISTS "idx_{layer_name}_{field}" ON "{layer_name}" ("{field}")')
+            geom_column = layer.GetGeometryColumn()
+            if geom_column:
+                has_spatial_index = self.writer.query(f"SELECT HasSpatialIndex('{layer_name}', '{geom_column}')")[0][0]
+                if not has_spatial_index:
+                    self.writer.execute(f"SELECT CreateSpatialIndex('{layer_name}', '{geom_column}')")
+                    self.stdout.write(f'   Index espacial de la capa {layer_name} creat')
+        # Update the statistics used by the query planner
+        self.writer.execute('ANALYZE')
+
+    def get_local_layers(self):
+        """Get the layers of the local working geopackage"""
+        return self.writer.get_layer_names()
+
+    @staticmethod
+    def get_remote_hashes(layer_name):
+        """
+        Get the hash of every feature of a layer's PostGIS view. The hash is computed by the database from the whole
+        row, so only the keys and hashes are transferred. Every call opens its own connection, so the layers can be
+        requested concurrently. It raises CommandError if the connection or the query fail
+        :param layer_name: local layer name
+        :return: hashes - Dict with the key -> hash of every feature
+        """
+        view, key = SYNC_LAYERS[layer_name]
+        pg = ogr.Open(PG_CONNECTION)
+        if pg is None:
+            raise CommandError(f"No s'ha pogut connectar a la base de dades per llegir la vista {view}")
+        try:
+            result = pg.ExecuteSQL(f'SELECT {key} AS feature_id, md5(v::text) AS hash FROM {view} v')
+            if result is None:
+                raise CommandError(f"No s'ha pogut llegir la vista {view} de la base de dades")
+            try:
+                return {feature.GetField(0): feature.GetField(1) for feature in result}
+            finally:
+                pg.ReleaseResultSet(result)
+        finally:
+            pg = None   # Close the connection
+
+    def apply_changes(self, pg, layer_name, new, changed, removed):
+        """
+        Apply the changes of a PostGIS view to its local layer, in a single transaction. The changed features are
+        deleted and inserted again
+        :param pg: PostGIS ogr datasource
+        :param layer_name: local layer name
+        :param new: keys of the new features
+        :param changed: keys of the changed features
+        :param removed: keys of the removed features
+        """
+        view, key = SYNC_LAYERS[layer_name]
+        gpkg = self.writer.ds
+        layer = gpkg.GetLayerByName(layer_name)
+        layer_defn = layer.GetLayerDefn()
+        src_layer = pg.GetLayerByName(view)
+        gpkg.StartTransaction()
+        try:
+            for batch in get_batches(changed + removed):
+                self.writer.execute(f'DELETE FROM "{layer_name}" WHERE {key} IN ({", ".join(str(int(i)) for i in batch)})')
+            for batch in get_batches(new + changed):
+                src_layer.SetAttributeFilter(f'{key} IN ({", ".join(str(int(i)) for i in batch)})')
+                for src_feature in src_layer:
+                    feature = ogr.Feature(layer_defn)
+                    feature.SetFrom(src_feature)
+                    layer.CreateFeature(feature)
+            gpkg.CommitTransaction()
+        except Exception:
+            gpkg.RollbackTransaction()
+            raise
+        finally:
+            src_layer.SetAttributeFilter(None)
+
+    def full_copy(self, layer_names):
+        """
+        Copy whole layers from the PostGIS to the snapshot. Up to TRANSFER_WORKERS layers are dumped at once, each
+        one with its own connection into its own staging geopackage, as a geopackage can't be written by many
+        connections at once. Then they are copied one after another into the snapshot through its writer, which is
+        a local copy much faster than the transfer from the database. GDAL streams the features in batches, without
+        loading the whole layer in memory
+        :param layer_names: names of the local layers to copy
+        """
+        staging_dir = get_staging_dir(self.gpkg)
+        os.makedirs(staging_dir, exist_ok=True)
+        staging_gpkgs = {layer_name: path.join(staging_dir, f'{layer_name}.gpkg') for layer_name in layer_names}
+        try:
+            with ThreadPoolExecutor(max_workers=TRANSFER_WORKERS) as executor:
+                list(executor.map(lambda layer_name: self.translate_layer(
+                    staging_gpkgs[layer_name], PG_CONNECTION, SYNC_LAYERS[layer_name][0], layer_name), layer_names))
+            for layer_name in layer_names:
+                self.translate_layer(self.writer.ds, staging_gpkgs[layer_name], layer_name, layer_name)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    @staticmethod
+    def translate_layer(dst, src, src_layer_name, dst_layer_name):
+        """
+        Copy a layer between two datasources with GDAL, overwriting the destination layer if exists
+        :param dst: path to the destination geopackage, that is created if doesn't exist, or its opened GDAL dataset
+        :param src: source datasource
+        :param src_layer_name: source layer name
+        :param dst_layer_name: destination layer name
+        """
+        ds = gdal.VectorTranslate(dst, src, format='GPKG', accessMode='overwrite',
+                                  layers=[src_layer_name], layerName=dst_layer_name,
+                                  options=['-gt', str(TRANSFER_BATCH_SIZE)])
+        if ds is None:
+            raise CommandError(f"No s'ha pogut copiar la capa {src_layer_name} a {dst_layer_name}")
+        ds = None
+
+    def create_sync_state(self):
+        """Create the sync state table, if it doesn't exist"""
+        with self.state:
+            self.state.execute(f'CREATE TABLE IF NOT EXISTS {SYNC_STATE_TABLE} (layer_name TEXT NOT NULL, '
+                               f'feature_id INTEGER NOT NULL, hash TEXT NOT NULL, PRIMARY KEY (layer_name, feature_id))')
+
+    def load_sync_state(self, layer_name):
+        """
+        Get the hash of every feature of a local layer, as it was when synchronized
+        :return: hashes - Dict with the key -> hash of every feature
+        """
+        return dict(self.state.execute(f'SELECT feature_id, hash FROM {SYNC_STATE_TABLE} WHERE layer_name = ?',
+                                       (layer_name,)).fetchall())
+
+    def save_sync_state(self, layer_name, hashes, removed=(), replace=False):
+        """
+        Save the hashes of the features synchronized, in a single transaction
+        :param layer_name: local layer name
+        :param hashes: dict with the key -> hash of the new and changed features
+        :param removed: keys of the removed features
+        :param replace: whether to replace the whole layer's state
+        """
+        with self.state:
+            if replace:
+                self.state.execute(f'DELETE FROM {SYNC_STATE_TABLE} WHERE layer_name = ?', (layer_name,))
+            self.state.executemany(f'DELETE FROM {SYNC_STATE_TABLE} WHERE layer_name = ? AND feature_id = ?',
+                                   ((layer_name, int(feature_id)) for feature_id in removed))
+            self.state.executemany(f'INSERT OR REPLACE INTO {SYNC_STATE_TABLE} (layer_name, feature_id, hash) '
+                                   f'VALUES (?, ?, ?)',
+                                   ((layer_name, int(feature_id), hash_) for feature_id, hash_ in hashes.items()))
@@ -0,0 +1,69 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QARun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('line_id', models.IntegerField()),
+                ('line_type', models.CharField(choices=[('mtt', 'MTT'), ('rep', 'Replantejament')], max_length=3)),
+                ('started_at', models.DateTimeField()),
+                ('duration', models.FloatField(help_text='Seconds')),
+                ('result', models.CharField(max_length=10)),
+                ('message', models.TextField(blank=True)),
+                ('report_id', models.CharField(blank=True, max_length=32)),
+                ('n_trams', models.IntegerField(null=True)),
+                ('n_vertexs', models.IntegerField(null=True)),
+                ('n_points', models.IntegerField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='QACheckResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('check_name', models.CharField(max_length=255)),
+                ('status', models.CharField(choices=[('OK', 'OK'), ('ERROR', 'ERROR')], max_length=5)),
+                ('n_errors', models.IntegerField(default=0)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='checks', to='qa_line.qarun')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='QAErrorRecord',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('check_name', models.CharField(max_length=255)),
+                ('level', models.CharField(max_length=10)),
+                ('message', models.TextField()),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='errors', to='qa_line.qarun')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='qarun',
+            index=models.Index(fields=['line_id', 'line_type', '-started_at'], name='qa_run_line_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='qarun',
+            index=models.Index(fields=['started_at'], name='qa_run_started_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='qarun',
+            index=models.Index(fields=['n_vertexs'], name='qa_run_vertexs_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='qacheckresult',
+            index=models.Index(fields=['check_name', 'status'], name='qa_check_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='qaerrorrecord',
+            index=models.Index(fields=['check_name', 'level'], name='qa_error_level_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qa_line', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='qarun',
+            name='reference_version',
+            field=models.CharField(blank=True, default='', help_text='Reference data snapshot version', max_length=32),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qa_line', '0002_qarun_reference_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QAJobRecord',
+            fields=[
+                ('job_id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('line_id', models.CharField(max_length=16)),
+                ('line_type', models.CharField(choices=[('mtt', 'MTT'), ('rep', 'Replantejament')], max_length=3)),
+                ('status', models.CharField(max_length=10)),
+                ('message', models.TextField(blank=True)),
+                ('report_id', models.CharField(blank=True, max_length=32)),
+                ('created_at', models.FloatField(help_text='Timestamp')),
+                ('finished_at', models.FloatField(help_text='Timestamp', null=True)),
+                ('cancel_requested', models.BooleanField(default=False, help_text='Cancellation requested from another process')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['finished_at'], name='qa_job_finished_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qa_line', '0003_qajobrecord'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='qajobrecord',
+            name='stage',
+            field=models.TextField(blank=True, help_text='Check that the job is running'),
+        ),
+    ]
@@ -1,3 +1,126 @@
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------------------
+# TERRITORIAL DELIMITATION TOOLS (ICGC)
+# Authors: Fran Martin
+# Version: 1.0
+# Version Python: 3.7
+# ----------------------------------------------------------
+
+"""
+History of the quality checks done, in order to query them across lines
+"""
+
 from django.db import models
+from django.db.models import OuterRef, Subquery
+
+
+class QARunQuerySet(models.QuerySet):
+    """Queries over the quality check runs"""
+
+    def latest_per_line(self):
+        """
+        Get only the latest run of every line and line type
+        :return: queryset with the latest runs
+        """
+        latest = QARun.objects.filter(line_id=OuterRef('line_id'), line_type=OuterRef('line_type')).order_by('-started_at')
+        return self.filter(pk=Subquery(latest.values('pk')[:1]))
+
+    def failing_check(self, check):
+        """
+        Get the latest runs of the lines that currently fail a check
+        :param check: check's key, from QA_CHECKS
+        :return: queryset with the latest runs that fail the check
+        """
+        return self.latest_per_line().filter(checks__check_name=check, checks__status=QACheckResult.ERROR)
+
+    def duration_by_size(self, bin_size=10000):
+        """
+        Get the mean and max duration of the runs grouped by the line's number of vertexs
+        :param bin_size: number of vertexs of every group
+        :return: queryset with the vertexs group, the number of runs and their mean and max duration
+        """
+        vertexs_bin = models.ExpressionWrapper(models.F('n_vertexs') / bin_size * bin_size, output_field=models.IntegerField())
+        return self.filter(n_vertexs__isnull=False).annotate(vertexs_bin=vertexs_bin).values('vertexs_bin')\
+            .annotate(n_runs=models.Count('pk'), mean_duration=models.Avg('duration'),
+                      max_duration=models.Max('duration')).order_by('vertexs_bin')
+
+
+class QARun(models.Model):
+    """Quality check run of a line"""
+    MTT = 'mtt'
+    REP = 'rep'
+    LINE_TYPES = [(MTT, 'MTT'), (REP, 'Replantejament')]
+
+    line_id = models.IntegerField()
+    line_type = models.CharField(max_length=3, choices=LINE_TYPES)
+    started_at = models.DateTimeField()
+    duration = models.FloatField(help_text='Seconds')
+    result = models.CharField(max_length=10)
+    message = models.TextField(blank=True)
+    report_id = models.CharField(max_length=32, blank=True)
+    reference_version = models.CharField(max_length=32, blank=True, help_text='Reference data snapshot version')
+    n_trams = models.IntegerField(null=True)
+    n_vertexs = models.IntegerField(null=True)
+    n_points = models.IntegerField(null=True)
+
+    objects = QARunQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['line_id', 'line_type', '-started_at'], name='qa_run_line_idx'),
+            models.Index(fields=['started_at'], name='qa_run_started_idx'),
+            models.Index(fields=['n_vertexs'], name='qa_run_vertexs_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.line_id} ({self.line_type}) {self.started_at}'
+
+
+class QACheckResult(models.Model):
+    """Status of every check of a quality check run"""
+    OK = 'OK'
+    ERROR = 'ERROR'
+    STATUSES = [(OK, 'OK'), (ERROR, 'ERROR')]
+
+    run = models.ForeignKey(QARun, related_name='checks', on_delete=models.CASCADE)
+    check_name = models.CharField(max_length=255)
+    status = models.CharField(max_length=5, choices=STATUSES)
+    n_errors = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['check_name', 'status'], name='qa_check_status_idx'),
+        ]
+
+
+class QAErrorRecord(models.Model):
+    """Error reported by a quality check run"""
+    run = models.ForeignKey(QARun, related_name='errors', on_delete=models.CASCADE)
+    check_name = models.CharField(max_length=255)
+    level = models.CharField(max_length=10)
+    message = models.TextField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['check_name', 'level'], name='qa_error_level_idx'),
+        ]
+
+
+class QAJobRecord(models.Model):
+    """Status of a quality check job, shared by all the processes that serve the API"""
+    job_id = models.CharField(max_length=32, primary_key=True)
+    line_id = models.CharField(max_length=16)
+    line_type = models.CharField(max_length=3, choices=QARun.LINE_TYPES)
+    status = models.CharField(max_length=10)
+    message = models.TextField(blank=True)
+    report_id = models.CharField(max_length=32, blank=True)
+    created_at = models.FloatField(help_text='Timestamp')
+    finished_at = models.FloatField(null=True, help_text='Timestamp')
+    stage = models.TextField(blank=True, help_text='Check that the job is running')
+    cancel_requested = models.BooleanField(default=False, help_text='Cancellation requested from another process')
 
-# Create your models here.
+    class Meta:
+        indexes = [
+            models.Index(fields=['finished_at'], name='qa_job_finished_idx'),
+        ]
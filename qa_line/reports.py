@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------------------
+# TERRITORIAL DELIMITATION TOOLS (ICGC)
+# Authors: Fran Martin
+# Version: 1.0
+# Version Python: 3.7
+# ----------------------------------------------------------
+
+"""
+Server-side storage of the quality check reports
+"""
+
+import os
+import os.path as path
+import glob
+import gzip
+import json
+import re
+import time
+import uuid
+
+from qa_line.config import *
+
+# Directory where the reports are stored as compressed JSON files
+REPORTS_DIR = path.join(WORK_DIR, 'qa_reports')
+# Number of report messages per page
+REPORT_PAGE_SIZE = 100
+# Report ID format, in order to avoid reading files outside the reports directory
+REPORT_ID_REGEX = re.compile(r'^[0-9a-f]{32}$')
+# Seconds that a report is kept. The older ones are removed by cleardb
+REPORT_RETENTION = 30 * 24 * 3600
+
+
+def get_report_path(report_id):
+    """
+    Get the path to the report's file
+    :param report_id: report ID
+    :return: report_path - Path to the report's file, or None if the report ID is not valid
+    """
+    if not report_id or not REPORT_ID_REGEX.match(report_id):
+        return None
+    return path.join(REPORTS_DIR, f'{report_id}.json.gz')
+
+
+def save_report(response):
+    """
+    Save the response with the reports as a compressed JSON file
+    :param response: dict with the response data
+    :return: report_id - ID of the stored report
+    """
+    if not path.exists(REPORTS_DIR):
+        os.makedirs(REPORTS_DIR)
+    report_id = uuid.uuid4().hex
+    report_path = get_report_path(report_id)
+    # Write into a temp file and rename it, in order to never read a half written report
+    temp_path = f'{report_path}.tmp'
+    with gzip.open(temp_path, 'wt', encoding='utf-8') as f:
+        json.dump(response, f)
+    os.replace(temp_path, report_path)
+
+    return report_id
+
+
+def load_report(report_id):
+    """
+    Load a stored report
+    :param report_id: report ID
+    :return: response - Dict with the response data, or None if the report doesn't exist
+    """
+    report_path = get_report_path(report_id)
+    if report_path is None or not path.exists(report_path):
+        return None
+    with gzip.open(report_path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def remove_old_reports(retention=REPORT_RETENTION):
+    """
+    Remove the stored reports older than the retention, and the temp files of the reports never finished
+    :param retention: seconds that a report is kept
+    :return: n_removed - Number of reports removed
+    """
+    now = time.time()
+    n_removed = 0
+    for report_path in glob.glob(path.join(glob.escape(REPORTS_DIR), '*.json.gz*')):
+        try:
+            if now - path.getmtime(report_path) > retention:
+                os.remove(report_path)
+                n_removed += 1
+        except FileNotFoundError:   # Removed by another process
+            continue
+    return n_removed
+
+
+def filter_reports(reports, level=None, check=None):
+    """
+    Filter the report messages by level and check
+    :param reports: list with the report messages
+    :param level: level of the messages to keep, as INFO or ERROR
+    :param check: check of the messages to keep
+    :return: filtered_reports - List with the report messages that match the filters
+    """
+    return [report for report in reports
+            if (not level or report['level'] == level) and (not check or report.get('check') == check)]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------------------
+# TERRITORIAL DELIMITATION TOOLS (ICGC)
+# Authors: Fran Martin
+# Version: 1.0
+# Version Python: 3.7
+# ----------------------------------------------------------
+
+"""
+Serializers of the quality check JSON API
+"""
+
+from rest_framework import serializers
+
+
+class QALineSerializer(serializers.Serializer):
+    """Line to check"""
+    line_id = serializers.IntegerField(min_value=0)
+    line_type = serializers.ChoiceField(choices=['mtt', 'rep'], default='mtt')
+
+
+class QAJobSerializer(serializers.Serializer):
+    """Quality check job's status"""
+    job_id = serializers.CharField()
+    line_id = serializers.CharField()
+    line_type = serializers.CharField()
+    status = serializers.CharField()
+    message = serializers.CharField(allow_blank=True)
+    report_id = serializers.CharField(allow_null=True)
+
+
+class QAReportSerializer(serializers.Serializer):
+    """Report message of a quality check"""
+    level = serializers.CharField()
+    report_message = serializers.CharField(allow_blank=True)
+    check = serializers.CharField(allow_blank=True, default='')
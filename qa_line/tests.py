@@ -1,3 +1,603 @@
-from django.test import TestCase
+# -*- coding: utf-8 -*-
 
-# Create your tests here.
+# ----------------------------------------------------------
+# TERRITORIAL DELIMITATION TOOLS (ICGC)
+# Authors: Fran Martin
+# Version: 1.0
+# Version Python: 3.7
+# ----------------------------------------------------------
+
+"""
+Tests of the quality check and of the reference data it reads
+"""
+
+import json
+import logging
+import os
+import os.path as path
+import shutil
+import tempfile
+import time
+from unittest import mock, skipUnless
+
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import Point, LineString, MultiLineString
+from django.test import SimpleTestCase
+
+from qa_line.config import WORK_GPKG
+from qa_line.views import CheckQualityLine, CheckHistoryHandler
+from qa_line.reports import save_report, load_report, get_report_path, remove_old_reports
+from delimitapp.common.cancellation import CancellationToken
+from delimitapp.common.geomstore import pack_geometries, write_store_layer, ReferenceStore, STORE_META
+from delimitapp.common.backends import get_reference, GpkgReference, REFERENCE_PG_CONNECTION
+from delimitapp.common.postgis import ConnectionPool, PostgisReference, REFERENCE_VIEWS
+from delimitapp.common import columnar, metrics
+from delimitapp.common.crs import reproject_gdf, ED50_EPSG, TARGET_EPSG
+
+CRS = 'EPSG:25831'
+
+
+class ReferenceStoreTest(SimpleTestCase):
+    """Round trip of the reference layers through the memory-mapped geometry store"""
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.store_dir, ignore_errors=True)
+        self.trams = gpd.GeoDataFrame({
+            'id_tram_linia': [1, 2, 3],
+            'id_linia': [10, 10, 20]
+        }, geometry=[
+            LineString([(0, 0), (10, 0)]),
+            MultiLineString([[(20, 0), (30, 0)], [(30, 0), (30, 10), (40, 10)]]),
+            LineString([(100, 100), (110, 110)])
+        ], crs=CRS)
+        self.fites = gpd.GeoDataFrame({
+            'id_fita': ['F1', 'F2', 'F3'],
+            'id_linia': [10, 10, 20]
+        }, geometry=[Point(0, 0), None, Point(100, 100)], crs=CRS)
+        meta = {
+            'tram_linia_mem': write_store_layer(self.store_dir, 'tram_linia_mem', self.trams, ('id_tram_linia', 'id_linia')),
+            'fita_mem': write_store_layer(self.store_dir, 'fita_mem', self.fites, ('id_fita', 'id_linia'))
+        }
+        with open(path.join(self.store_dir, STORE_META), 'w') as f:
+            json.dump(meta, f)
+        self.store = ReferenceStore(self.store_dir)
+
+    def test_pack_geometries(self):
+        coords, part_offsets, geom_offsets, bounds = pack_geometries(self.trams.geometry)
+        self.assertEqual(coords.shape, (9, 2))
+        self.assertEqual(part_offsets.tolist(), [0, 2, 4, 7, 9])
+        self.assertEqual(geom_offsets.tolist(), [0, 1, 3, 4])
+        np.testing.assert_array_equal(bounds[1], (20, 0, 40, 10))
+
+    def test_pack_empty_geometries(self):
+        coords, part_offsets, geom_offsets, bounds = pack_geometries(self.fites.geometry)
+        self.assertEqual(coords.shape, (2, 2))
+        self.assertEqual(geom_offsets.tolist(), [0, 1, 1, 2])
+        self.assertTrue(np.isnan(bounds[1]).all())
+
+    def test_query_without_bbox(self):
+        trams = self.store.query('tram_linia_mem')
+        self.assertEqual(trams['id_tram_linia'].tolist(), [1, 2, 3])
+        for geom, original in zip(trams.geometry, self.trams.geometry):
+            self.assertEqual(geom.geom_type, original.geom_type)
+            self.assertTrue(geom.equals(original))
+        fites = self.store.query('fita_mem')
+        self.assertEqual(fites['id_fita'].tolist(), ['F1', 'F2', 'F3'])
+        self.assertIsNone(fites.geometry.iloc[1])
+        self.assertTrue(fites.geometry.iloc[2].equals(Point(100, 100)))
+
+    def test_query_with_bbox(self):
+        trams = self.store.query('tram_linia_mem', bbox=(25, 5, 50, 50))
+        self.assertEqual(trams['id_tram_linia'].tolist(), [2])
+        self.assertTrue(trams.geometry.iloc[0].equals(self.trams.geometry.iloc[1]))
+        # The bounding boxes that only touch are selected too
+        trams = self.store.query('tram_linia_mem', bbox=(-10, -10, 0, 0))
+        self.assertEqual(trams['id_tram_linia'].tolist(), [1])
+        # The features without geometry never intersect a bounding box
+        fites = self.store.query('fita_mem', bbox=(-1000, -1000, 1000, 1000))
+        self.assertEqual(fites['id_fita'].tolist(), ['F1', 'F3'])
+
+    def test_query_with_filters(self):
+        trams = self.store.query('tram_linia_mem', bbox=(-10, -10, 200, 200), id_linia=10)
+        self.assertEqual(trams['id_tram_linia'].tolist(), [1, 2])
+        fites = self.store.query('fita_mem', id_fita='F3')
+        self.assertEqual(fites['id_linia'].tolist(), [20])
+        self.assertTrue(self.store.query('fita_mem', bbox=(500, 500, 600, 600)).empty)
+
+
+class ReferenceBackendTest(SimpleTestCase):
+    """Selection of the reference data backend and pooling of the PostGIS connections"""
+
+    def test_backend_selection(self):
+        gpkg = path.join(tempfile.gettempdir(), 'missing.gpkg')
+        self.assertIsInstance(get_reference(gpkg, backend='gpkg'), GpkgReference)
+        reference = get_reference(gpkg, backend='postgis', pg_connection='PG:dbname=missing')
+        self.assertIsInstance(reference, PostgisReference)
+        # The layers without a view are read from the geopackage
+        self.assertIsInstance(reference.fallback, GpkgReference)
+        self.assertTrue(reference.version.startswith('postgis:'))
+        with self.assertRaises(ValueError):
+            get_reference(gpkg, backend='sqlite')
+
+    def test_pool_returns_failed_connections(self):
+        pool = ConnectionPool('PG:dbname=missing host=127.0.0.1 port=1 connect_timeout=1', size=1)
+        with self.assertRaises(IOError):
+            with pool.connection():
+                pass
+        # The slot is given back empty, so the next checkout opens a new connection
+        self.assertEqual(pool._connections.qsize(), 1)
+        self.assertIsNone(pool._connections.get_nowait())
+
+
+@skipUnless(REFERENCE_PG_CONNECTION, "No s'ha configurat la connexio a la base de dades de referencia")
+class PostgisReferenceTest(SimpleTestCase):
+    """Reads of the PostGIS backend, which must match the ones of the geopackage snapshot it's synchronized with"""
+
+    def setUp(self):
+        self.postgis = get_reference(WORK_GPKG, backend='postgis')
+        self.gpkg = get_reference(WORK_GPKG, backend='gpkg')
+        if not self.gpkg.version:
+            self.skipTest("No s'ha publicat cap versio de les dades de referencia")
+        self.id_fita, self.id_linia = self.postgis.query(f"SELECT id_fita, id_linia FROM {REFERENCE_VIEWS['fita_mem']} "
+                                                         f"ORDER BY id_fita LIMIT 1")[0]
+
+    def test_pool_checkout_and_return(self):
+        pool = self.postgis.pool
+        with pool.connection() as ds:
+            self.assertIsNotNone(ds)
+            n_free = pool._connections.qsize()
+        self.assertEqual(pool._connections.qsize(), n_free + 1)
+        # The connection is reused by the next checkout
+        with pool.connection() as ds_reused:
+            self.assertIs(ds_reused, ds)
+
+    def test_get_first_row_parity(self):
+        columns = ('id_fita', 'id_linia')
+        self.assertEqual(self.postgis.get_first_row('fita_mem', columns, id_fita=self.id_fita),
+                         self.gpkg.get_first_row('fita_mem', columns, id_fita=self.id_fita))
+        self.assertIsNone(self.postgis.get_first_row('fita_mem', columns, id_fita=-1))
+
+    def test_read_layer_parity(self):
+        fites = self.postgis.read_features('fita_mem', id_linia=self.id_linia)
+        bbox = tuple(fites.total_bounds)
+        postgis_fites = self.postgis.read_layer('fita_mem', bbox=bbox).sort_values('id_fita')
+        gpkg_fites = self.gpkg.read_layer('fita_mem', bbox=bbox).sort_values('id_fita')
+        self.assertEqual(postgis_fites['id_fita'].tolist(), gpkg_fites['id_fita'].tolist())
+        for postgis_geom, gpkg_geom in zip(postgis_fites.geometry, gpkg_fites.geometry):
+            self.assertTrue(postgis_geom.equals_exact(gpkg_geom, 1e-6))
+
+
+class LineChecksTestCase(SimpleTestCase):
+    """Base of the tests of the line checks, which run over fixed geometries instead of a line's folder"""
+
+    def get_qa(self, trams, points=None, line_type='mtt', fites=None):
+        """
+        Get a quality check with the line's layers in memory
+        :param trams: list with the trams' geometries, whose IDs are their position from 1
+        :param points: geodataframe with the Punt layer
+        :param line_type: line type, 'mtt' or 'rep'
+        :param fites: list with the ID_FITA1 and ID_FITA2 of every tram
+        :return: qa - CheckQualityLine ready to run the checks
+        """
+        fites = fites or [(None, None)] * len(trams)
+        qa = CheckQualityLine()
+        qa.line_type = line_type
+        qa.streaming = False
+        qa.token = CancellationToken()
+        qa.logger = logging.Logger('qa_line.tests')
+        qa.tram_line_layer_name = 'Lin_TramPpta' if line_type == 'mtt' else 'Lin_Tram'
+        tram_ids = list(range(1, len(trams) + 1))
+        attributes = {'ID': tram_ids, 'ID_FITA1': [fita[0] for fita in fites], 'ID_FITA2': [fita[1] for fita in fites]}
+        if line_type == 'rep':
+            attributes['ID_TRAM'] = tram_ids
+        qa.tram_line_layer = gpd.GeoDataFrame(attributes, geometry=trams, crs=CRS)
+        qa.punt_line_gdf = points
+        qa.tram_attributes = qa.get_tram_attributes()
+        return qa
+
+    @staticmethod
+    def get_messages(logs):
+        """Get the messages of the captured logs, without their indentation"""
+        return [record.getMessage().strip() for record in logs.records]
+
+
+class TramSegmentsTest(LineChecksTestCase):
+    """Vectorised checks of the trams' segments"""
+
+    def setUp(self):
+        self.qa = self.get_qa([
+            LineString([(0, 0), (10, 0), (10, 0), (20, 0)]),
+            LineString([(0, 10), (10, 10), (10.05, 10), (20, 10)]),
+            LineString([(0, 20), (10, 20), (0, 20.5)]),
+            # The parts are joined at the same point, going back, which is neither a repeated vertex nor a spike
+            MultiLineString([[(0, 30), (10, 30)], [(10, 30), (0, 30.5)]])
+        ])
+        self.qa.tram_vertex_arrays = self.qa.get_tram_vertex_arrays()
+
+    def test_vertex_arrays(self):
+        arrays = self.qa.tram_vertex_arrays
+        self.assertEqual(arrays['coords'].shape, (15, 2))
+        self.assertEqual(arrays['part_tram'].tolist(), [0, 1, 2, 3, 3])
+        self.assertEqual(arrays['vertex_part'].tolist(), [0] * 4 + [1] * 4 + [2] * 3 + [3] * 2 + [4] * 2)
+        # The vertexs of the multi-part trams are numbered along the whole tram
+        self.assertEqual(arrays['vertex_index'].tolist(), [0, 1, 2, 3] * 2 + [0, 1, 2] + [0, 1, 2, 3])
+
+    def test_segment_errors(self):
+        with self.assertLogs(self.qa.logger, 'ERROR') as logs:
+            self.qa.check_tram_segments()
+        messages = self.get_messages(logs)
+        self.assertEqual(len(messages), 3)
+        self.assertIn('El tram 1 te el vertex 2 repetit (vertex 1)', messages)
+        self.assertIn('El tram 2 te un segment de 0.050 m entre els vertex 1 i 2', messages)
+        self.assertTrue(messages[2].startswith('El tram 3 te una punxa de 2.9 graus al vertex 1'))
+
+    def test_valid_segments(self):
+        qa = self.get_qa([LineString([(0, 0), (10, 0), (20, 5)])])
+        qa.tram_vertex_arrays = qa.get_tram_vertex_arrays()
+        with self.assertLogs(qa.logger, 'INFO') as logs:
+            qa.check_tram_segments()
+        self.assertEqual(self.get_messages(logs)[-1], "No s'ha detectat cap vertex repetit, segment curt o punxa als "
+                                                       "trams de la linia")
+
+    def test_vertex_density(self):
+        qa = self.get_qa([
+            LineString([(0, 0), (1, 0), (2, 0)]),
+            LineString([(0, 10), (1000, 10)]),
+            # The segment that joins the parts doesn't count in the tram's length
+            MultiLineString([[(0, 20), (1, 20)], [(1000, 20), (1001, 20)]])
+        ])
+        qa.tram_vertex_arrays = qa.get_tram_vertex_arrays()
+        with self.assertLogs(qa.logger, 'INFO') as logs:
+            qa.info_vertex_line()
+        self.assertEqual(self.get_messages(logs)[1:], [
+            'Tram ID: 1   Nº vertex: 3',
+            'El tram 1 te una densitat de 1500 vertex/km, superior al maxim de 1000 vertex/km',
+            'Tram ID: 2   Nº vertex: 2',
+            'Tram ID: 3   Nº vertex: 4',
+            'El tram 3 te una densitat de 2000 vertex/km, superior al maxim de 1000 vertex/km'
+        ])
+
+    def test_vertex_density_limit(self):
+        # A density equal to the maximum is allowed
+        qa = self.get_qa([LineString([(0, 0), (1000, 0)])])
+        qa.tram_vertex_arrays = qa.get_tram_vertex_arrays()
+        with mock.patch('qa_line.views.MAX_VERTEX_DENSITY', 2), self.assertLogs(qa.logger, 'INFO') as logs:
+            qa.info_vertex_line()
+        self.assertFalse([record for record in logs.records if record.levelno >= logging.ERROR])
+
+
+class LineChangesTest(LineChecksTestCase):
+    """Comparison of the line with its database version"""
+
+    def test_compare_trams(self):
+        qa = self.get_qa([
+            LineString([(0, 0), (100, 0)]),
+            LineString([(0, 200), (100, 200)]),
+            LineString([(1000, 1000), (1100, 1000)])
+        ])
+        db_trams = gpd.GeoDataFrame({'id_tram_linia': [101, 102, 103]}, geometry=[
+            LineString([(0, 0), (100, 0)]),
+            LineString([(0, 201), (100, 201)]),
+            LineString([(5000, 5000), (5100, 5000)])
+        ], crs=CRS)
+        with self.assertLogs(qa.logger, 'INFO') as logs:
+            qa.compare_trams(db_trams)
+        self.assertEqual(self.get_messages(logs), [
+            "El tram 2 s'ha modificat respecte el tram 102 de la base de dades. Distancia Hausdorff: 1.000 m   "
+            "Distancia Frechet: 1.000 m",
+            "El tram 3 es nou respecte la base de dades",
+            "El tram 103 de la base de dades no existeix a la linia",
+            "Trams sense canvis: 1"
+        ])
+
+    def test_compare_points(self):
+        points = gpd.GeoDataFrame({'ID_PUNT': ['9000-1', '9000-2', '9000-3', '9000-4']}, geometry=[
+            Point(0, 0), Point(100, 0), Point(200, 0), Point(1000, 1000)
+        ], crs=CRS)
+        qa = self.get_qa([LineString([(0, 0), (100, 0)])], points=points)
+        qa.ppf_list = points['ID_PUNT'].tolist()
+        # The point 3 has another ID in the database, so it's matched by the nearest neighbour
+        db_points = gpd.GeoDataFrame({'id_punt': ['9000-1', '9000-2', '9000-30', '9000-5']}, geometry=[
+            Point(0, 0), Point(100, 0.5), Point(200.02, 0), Point(5000, 5000)
+        ], crs=CRS)
+        with self.assertLogs(qa.logger, 'INFO') as logs:
+            qa.compare_points(db_points)
+        self.assertEqual(self.get_messages(logs), [
+            "El punt amb ID PUNT 2 s'ha desplaçat 0.500 m respecte la base de dades",
+            "El punt amb ID PUNT 4 es nou respecte la base de dades",
+            "El punt amb ID PUNT 5 de la base de dades no existeix a la linia",
+            "Punts sense canvis: 2"
+        ])
+
+    def test_frechet_distance(self):
+        line = LineString([(0, 0), (5, 0), (10, 0)])
+        self.assertAlmostEqual(CheckQualityLine.get_frechet_distance(line, LineString([(0, 1), (5, 1), (10, 1)])), 1)
+        # The lines digitized in opposite directions are compared in the same direction
+        self.assertAlmostEqual(CheckQualityLine.get_frechet_distance(line, LineString([(10, 1), (5, 1), (0, 1)])), 1)
+        # The middle vertex must be coupled with one of the ends of the other line, unlike the Hausdorff distance
+        self.assertAlmostEqual(CheckQualityLine.get_frechet_distance(line, LineString([(0, 0), (10, 0)])), 5)
+        multi_line = MultiLineString([[(0, 1), (5, 1)], [(5, 1), (10, 1)]])
+        self.assertAlmostEqual(CheckQualityLine.get_frechet_distance(line, multi_line), 1)
+        with mock.patch('qa_line.views.FRECHET_MAX_CELLS', 4):
+            self.assertIsNone(CheckQualityLine.get_frechet_distance(line, line))
+
+    def test_frechet_max_cells(self):
+        # The distance matrix of two lines of 3 vertexs has 9 cells
+        line = LineString([(0, 0), (5, 0), (10, 0)])
+        with mock.patch('qa_line.views.FRECHET_MAX_CELLS', 9):
+            self.assertAlmostEqual(CheckQualityLine.get_frechet_distance(line, line), 0)
+        with mock.patch('qa_line.views.FRECHET_MAX_CELLS', 8):
+            self.assertIsNone(CheckQualityLine.get_frechet_distance(line, line))
+
+    def test_change_tolerance(self):
+        qa = self.get_qa([
+            LineString([(0, 0), (100, 0)]),
+            LineString([(0, 200), (100, 200)])
+        ])
+        # The tram 1 moved less than the tolerance, so it's unchanged
+        db_trams = gpd.GeoDataFrame({'id_tram_linia': [101, 102]}, geometry=[
+            LineString([(0, 0.04), (100, 0.04)]),
+            LineString([(0, 200.06), (100, 200.06)])
+        ], crs=CRS)
+        with self.assertLogs(qa.logger, 'INFO') as logs:
+            qa.compare_trams(db_trams)
+        self.assertEqual(self.get_messages(logs), [
+            "El tram 2 s'ha modificat respecte el tram 102 de la base de dades. Distancia Hausdorff: 0.060 m   "
+            "Distancia Frechet: 0.060 m",
+            "Trams sense canvis: 1"
+        ])
+
+    def test_frechet_not_computed(self):
+        qa = self.get_qa([LineString([(0, 0), (50, 0), (100, 0)])])
+        db_trams = gpd.GeoDataFrame({'id_tram_linia': [101]}, geometry=[LineString([(0, 1), (100, 1)])], crs=CRS)
+        # The modified trams too big to compare are reported without their Fréchet distance
+        with mock.patch('qa_line.views.FRECHET_MAX_CELLS', 5), self.assertLogs(qa.logger, 'INFO') as logs:
+            qa.compare_trams(db_trams)
+        self.assertEqual(self.get_messages(logs)[0], "El tram 1 s'ha modificat respecte el tram 101 de la base de "
+                                                     "dades. Distancia Hausdorff: 1.000 m   Distancia Frechet: no "
+                                                     "calculada")
+
+
+class LineConnectivityTest(LineChecksTestCase):
+    """Check that the trams form one continuous chain from 3T to 3T"""
+
+    def get_chain_qa(self, fites, contactes, trams=None):
+        """Get a quality check of a line of two trams, along the points P1, P2 and P3"""
+        points = gpd.GeoDataFrame({'ID_PUNT': ['9000-1', '9000-2', '9000-3'], 'CONTACTE': contactes},
+                                  geometry=[Point(0, 0), Point(10, 0), Point(20, 0)], crs=CRS)
+        trams = trams or [LineString([(0, 0), (10, 0)]), LineString([(10, 0), (20, 0)])]
+        qa = self.get_qa(trams, points=points, fites=fites)
+        qa.points_coords_dict = {point_id: (geom.x, geom.y) for point_id, geom in zip(points['ID_PUNT'], points.geometry)}
+        return qa
+
+    def check_errors(self, trams):
+        """Run the check over some trams, without points, and get the errors reported"""
+        qa = self.get_qa(trams)
+        qa.points_coords_dict = {}
+        with self.assertLogs(qa.logger, 'ERROR') as logs:
+            qa.check_line_connectivity()
+        return self.get_messages(logs)
+
+    def test_continuous_line(self):
+        qa = self.get_chain_qa([('9000-1', '9000-2'), ('9000-2', '9000-3')], ['A', None, 'B'])
+        with self.assertLogs(qa.logger, 'INFO') as logs:
+            qa.check_line_connectivity()
+        self.assertFalse([record for record in logs.records if record.levelno >= logging.ERROR])
+        self.assertEqual(self.get_messages(logs)[-1], 'Els trams de la linia formen una cadena continua de 3 termes '
+                                                      'a 3 termes')
+
+    def test_endpoints_fites(self):
+        qa = self.get_chain_qa([('9000-1', '9000-2'), ('9000-1', '9000-3')], ['A', None, None])
+        with self.assertLogs(qa.logger, 'ERROR') as logs:
+            qa.check_line_connectivity()
+        self.assertEqual(self.get_messages(logs), [
+            "L'extrem de la linia al punt (20.0, 0.0) no coincideix amb cap fita 3 termes",
+            "Cap extrem del tram 2 coincideix amb la fita amb ID PUNT 1 indicada a ID_FITA1"
+        ])
+
+    def test_gaps(self):
+        messages = self.check_errors([
+            LineString([(0, 0), (10, 0)]),
+            LineString([(10.5, 0), (20, 0)]),
+            LineString([(100, 0), (200, 0)])
+        ])
+        self.assertEqual(messages, [
+            'Els trams de la linia formen 3 cadenes no connectades entre elles',
+            'Hi ha un forat de 0.500 m entre els trams 1 i 2',
+            'El tram 1 te un extrem penjat al punt (0.0, 0.0)',
+            'El tram 2 te un extrem penjat al punt (20.0, 0.0)',
+            'El tram 3 te un extrem penjat al punt (100.0, 0.0)',
+            'El tram 3 te un extrem penjat al punt (200.0, 0.0)'
+        ])
+
+    def test_branches(self):
+        messages = self.check_errors([
+            LineString([(0, 0), (10, 0)]),
+            LineString([(10, 0), (20, 0)]),
+            LineString([(10, 0), (10, 10)])
+        ])
+        self.assertIn("Els trams 1, 2, 3 s'uneixen al mateix punt (10.0, 0.0), formant una branca", messages)
+
+    def test_cycles(self):
+        messages = self.check_errors([
+            LineString([(0, 0), (10, 0)]),
+            LineString([(10, 0), (10, 10)]),
+            LineString([(10, 10), (0, 0)])
+        ])
+        self.assertEqual(messages, ['El tram 3 tanca un cicle a la linia'])
+
+    def test_multi_part_tram(self):
+        # The parts of a tram are joined, so only its first and last endpoints are nodes of the graph
+        trams = [MultiLineString([[(0, 0), (5, 0)], [(5, 0), (10, 0)]]), LineString([(10, 0), (20, 0)])]
+        qa = self.get_chain_qa([('9000-1', '9000-2'), ('9000-2', '9000-3')], ['A', None, 'B'], trams)
+        with self.assertLogs(qa.logger, 'INFO') as logs:
+            qa.check_line_connectivity()
+        self.assertFalse([record for record in logs.records if record.levelno >= logging.ERROR])
+
+    def test_multi_part_gap(self):
+        messages = self.check_errors([
+            MultiLineString([[(0, 0), (5, 0)], [(5, 0), (10, 0)]]),
+            MultiLineString([[(10.2, 0), (15, 0)], [(15, 0), (20, 0)]])
+        ])
+        self.assertEqual(messages, [
+            'Els trams de la linia formen 2 cadenes no connectades entre elles',
+            'Hi ha un forat de 0.200 m entre els trams 1 i 2',
+            'El tram 1 te un extrem penjat al punt (0.0, 0.0)',
+            'El tram 2 te un extrem penjat al punt (20.0, 0.0)'
+        ])
+
+    def test_ring_tram(self):
+        # A closed tram joins its own endpoints, so the line has no 3T
+        messages = self.check_errors([LineString([(0, 0), (10, 0), (10, 10), (0, 0)])])
+        self.assertEqual(messages, ['El tram 1 tanca un cicle a la linia'])
+
+    def test_multi_part_ring(self):
+        messages = self.check_errors([
+            MultiLineString([[(0, 0), (10, 0)], [(10, 0), (10, 10), (0, 0)]]),
+            LineString([(100, 0), (110, 0)])
+        ])
+        self.assertEqual(messages[0], 'El tram 1 tanca un cicle a la linia')
+        self.assertIn('Els trams de la linia formen 2 cadenes no connectades entre elles', messages)
+
+
+@skipUnless(columnar.is_available(), "pyarrow no està instal·lat")
+class ColumnarSnapshotTest(SimpleTestCase):
+    """Selection of the row groups of the columnar snapshots by their statistics"""
+
+    def setUp(self):
+        columnar_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, columnar_dir, ignore_errors=True)
+        # Every line has its own row group, as the rows are sorted by line
+        fites = gpd.GeoDataFrame({
+            'id_fita': [6, 5, 4, 3, 2, 1],
+            'id_linia': [30, 30, 20, 20, 10, 10]
+        }, geometry=[Point(200, 0), Point(210, 0), Point(100, 0), Point(110, 0), Point(0, 0), Point(10, 0)], crs=CRS)
+        self.parquet_path = columnar.get_columnar_path(columnar_dir, 'fita_mem')
+        with mock.patch('delimitapp.common.columnar.ROW_GROUP_SIZE', 2):
+            columnar.write_columnar_layer(fites, self.parquet_path)
+        self.parquet_file = columnar.pq.ParquetFile(self.parquet_path)
+
+    def test_select_row_groups(self):
+        self.assertEqual(self.parquet_file.metadata.num_row_groups, 3)
+        self.assertEqual(columnar.select_row_groups(self.parquet_file), [0, 1, 2])
+        self.assertEqual(columnar.select_row_groups(self.parquet_file, filters={'id_linia': 20}), [1])
+        self.assertEqual(columnar.select_row_groups(self.parquet_file, filters={'id_linia': 25}), [])
+        self.assertEqual(columnar.select_row_groups(self.parquet_file, bbox=(205, -5, 300, 5)), [2])
+        self.assertEqual(columnar.select_row_groups(self.parquet_file, bbox=(5, -5, 105, 5)), [0, 1])
+        self.assertEqual(columnar.select_row_groups(self.parquet_file, bbox=(5, -5, 105, 5), filters={'id_linia': 10}), [0])
+
+    def test_read_columnar_layer(self):
+        fites = columnar.read_columnar_layer(self.parquet_path, columns=['id_fita'], bbox=(5, -5, 105, 5))
+        self.assertEqual(fites['id_fita'].tolist(), [1, 4])
+        self.assertEqual(fites.columns.tolist(), ['id_fita', 'geometry'])
+        # The filters are casted to the type of their column
+        fites = columnar.read_columnar_layer(self.parquet_path, id_linia='30')
+        self.assertEqual(fites['id_fita'].tolist(), [6, 5])
+        self.assertTrue(fites.geometry.iloc[0].equals(Point(200, 0)))
+
+
+class ReprojectionTest(SimpleTestCase):
+    """Reprojection of the incoming layers to ETRS89"""
+
+    def setUp(self):
+        self.points = gpd.GeoDataFrame({'ID_PUNT': ['9000-1']}, geometry=[Point(400000.12, 4600000.34, 100.5)],
+                                       crs=f'EPSG:{ED50_EPSG}')
+
+    def test_reproject_rounded(self):
+        points, src_epsg = reproject_gdf(self.points, decimals=1)
+        self.assertEqual(src_epsg, ED50_EPSG)
+        self.assertEqual(points.crs.to_epsg(), TARGET_EPSG)
+        point = points.geometry.iloc[0]
+        self.assertEqual((point.x, point.y), (round(point.x, 1), round(point.y, 1)))
+        # The Z coordinate is kept as is
+        self.assertEqual(point.z, 100.5)
+
+    def test_reproject_target(self):
+        points = self.points.set_crs(f'EPSG:{TARGET_EPSG}', allow_override=True)
+        reprojected, src_epsg = reproject_gdf(points, decimals=1)
+        self.assertEqual(src_epsg, TARGET_EPSG)
+        # The layers already in the target CRS are not modified
+        self.assertTrue(reprojected.geometry.iloc[0].equals(points.geometry.iloc[0]))
+
+
+class CheckHistoryTest(SimpleTestCase):
+    """Errors of every check saved into the QA history"""
+
+    def test_checks_by_key(self):
+        logger = logging.Logger('qa_line.tests')
+        handler = CheckHistoryHandler()
+        logger.addHandler(handler)
+        logger.info('Versio de les dades de referencia: 20210315120000')
+        logger.info('Validant geometries...', extra={'check': 'geometry'})
+        logger.error('   El tram 1 no te una geometria valida')
+        logger.info('Iniciant controls topològics...', extra={'check': 'topology'})
+        logger.info('   No hi ha errors topològics')
+        # The error that stops the run belongs to the check that was running
+        logger.error("L'estructura de camps de la capa de trams de línia no és correcte")
+        self.assertEqual(handler.checks, {'geometry': 1, 'topology': 1})
+        self.assertEqual(handler.errors, [
+            ('geometry', 'ERROR', 'El tram 1 no te una geometria valida'),
+            ('topology', 'ERROR', "L'estructura de camps de la capa de trams de línia no és correcte")
+        ])
+
+
+class ReportRetentionTest(SimpleTestCase):
+    """Expiry of the stored reports"""
+
+    def setUp(self):
+        self.reports_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.reports_dir, ignore_errors=True)
+        patcher = mock.patch('qa_line.reports.REPORTS_DIR', self.reports_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_remove_old_reports(self):
+        old_id = save_report({'line_id': '1'})
+        new_id = save_report({'line_id': '2'})
+        temp_path = f'{get_report_path(old_id)}.tmp'
+        open(temp_path, 'w').close()
+        old_time = time.time() - 3600
+        for report_path in get_report_path(old_id), temp_path:
+            os.utime(report_path, (old_time, old_time))
+        self.assertEqual(remove_old_reports(retention=60), 2)
+        self.assertIsNone(load_report(old_id))
+        self.assertFalse(path.exists(temp_path))
+        self.assertEqual(load_report(new_id), {'line_id': '2'})
+
+
+class StageMetricsTest(SimpleTestCase):
+    """Memory metrics of the stages, shared by all the processes through METRICS_DIR"""
+
+    def setUp(self):
+        self.metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.metrics_dir, ignore_errors=True)
+        patcher = mock.patch('delimitapp.common.metrics.METRICS_DIR', self.metrics_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @skipUnless(metrics.get_rss() is not None, "El RSS del procés no es pot llegir")
+    def test_stage_peak(self):
+        run_metrics = metrics.StageMetrics('qa_line', 'test')
+        run_metrics.start_stage('peak')
+        data = b'1' * (64 * metrics.MB)
+        time.sleep(10 * metrics.RSS_SAMPLE_INTERVAL)
+        del data
+        run_metrics.finish()
+        stage = run_metrics.stages[0]
+        # The memory released before the end of the stage counts in its peak, but it's not retained
+        self.assertGreaterEqual(stage['peak_mb'], 60)
+        self.assertLess(stage['retained_mb'], stage['peak_mb'])
+        self.assertGreaterEqual(stage['peak_rss_mb'], stage['rss_mb'])
+
+    def test_recent_runs(self):
+        with mock.patch('delimitapp.common.metrics.RECENT_RUNS', 2):
+            for run_name in 'first', 'second', 'third':
+                run_metrics = metrics.StageMetrics('municat', run_name)
+                run_metrics.start_stage('1:export')
+                run_metrics.finish()
+            recent = metrics.get_recent_metrics()
+        self.assertEqual([run['run'] for run in recent['runs']], ['second', 'third'])
+        self.assertEqual(recent['stages']['municat']['export']['count'], 2)
+        self.assertEqual(len(os.listdir(self.metrics_dir)), 2)
@@ -1,5 +1,6 @@
 from django.urls import re_path
-from qa_line.views import CheckQualityLine, render_qa_page, render_report_page
+from qa_line.views import CheckQualityLine, render_qa_page, render_report_page, submit_qa_job
+from qa_line.api import QAJobListView, QAJobDetailView, QAJobReportView, QAReportView
 
 '''
 Class-based views
@@ -10,5 +11,11 @@ Class-based views
 urlpatterns = [
     re_path(r'^$', render_qa_page, name='qa-page'),
     re_path(r'^check/$', CheckQualityLine.as_view(), name='qa-line'),
+    re_path(r'^check/live/$', submit_qa_job, name='qa-line-live'),
     re_path(r'^report', render_report_page, name='qa-report'),
+    # JSON API
+    re_path(r'^api/jobs/$', QAJobListView.as_view(), name='qa-api-jobs'),
+    re_path(r'^api/jobs/(?P<job_id>[0-9a-f]{32})/$', QAJobDetailView.as_view(), name='qa-api-job'),
+    re_path(r'^api/jobs/(?P<job_id>[0-9a-f]{32})/report/$', QAJobReportView.as_view(), name='qa-api-job-report'),
+    re_path(r'^api/reports/(?P<report_id>[0-9a-f]{32})/$', QAReportView.as_view(), name='qa-api-report'),
 ]
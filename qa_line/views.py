@@ -14,19 +14,109 @@ Quality check of a line ready to upload to the database
 import os
 import os.path as path
 from datetime import datetime
+from itertools import islice
+import gc
 import logging
 import re
 import shutil
+import uuid
 
+import numpy as np
+import pandas as pd
 import geopandas as gpd
 import fiona
+from shapely.geometry import Point
 from osgeo import gdal
 from django.views import View
 from django.shortcuts import render, redirect
 from django.contrib import messages
+from django.core.paginator import Paginator
+from django.db import transaction
+from django.utils import timezone
+from dotenv import load_dotenv
 
 from qa_line.config import *
+from qa_line.reports import save_report, load_report, filter_reports, REPORT_PAGE_SIZE
+from qa_line.models import QARun, QACheckResult, QAErrorRecord
+from qa_line.jobs import submit_job
 from delimitapp.common.utils import line_id_2_txt
+from delimitapp.common.profiling import profiled
+from delimitapp.common.metrics import StageMetrics, get_sidecar_path
+from delimitapp.common.cancellation import CancellationToken, PipelineCancelled
+from delimitapp.common.workspace import Workspace
+from delimitapp.common.backends import get_reference
+from delimitapp.common.crs import reproject_gdf, get_epsg, get_transformer, TARGET_EPSG
+
+# Load dotenv in order to get the deployment-specific paths
+load_dotenv()
+
+# Segment-level geometry checks parameters
+ZERO_SEGMENT_LENGTH = 0.001   # Meters. Segments shorter than this are considered repeated vertexs
+MIN_SEGMENT_LENGTH = 0.1   # Meters
+SPIKE_MAX_ANGLE = 10   # Degrees. Vertexs with a sharper angle are considered spikes
+MAX_VERTEX_DENSITY = 1000   # Vertexs per kilometer
+MAX_SEGMENT_REPORTS = 50   # Max number of reports per check, in order to avoid flooding the log
+# Change detection parameters
+CHANGE_TOLERANCE = 0.05   # Meters. Trams or points that moved less than this distance are considered unchanged
+CHANGE_SEARCH_DISTANCE = 50   # Meters. Max distance to match an element with its database version
+FRECHET_MAX_CELLS = 4000000   # Max size of the distance matrix in order to compute the Fréchet distance
+# Line connectivity parameters
+GAP_MAX_DISTANCE = 1   # Meters. Max distance between two tram endpoints to be reported as a gap
+# Streaming mode parameters
+STREAMING_MODE = 'auto'   # 'on', 'off' or 'auto', that enables it depending on the number of line features
+STREAMING_MIN_FEATURES = 20000   # Min number of Punt and tram features to enable the streaming mode if 'auto'
+CHUNK_SIZE = 5000   # Number of features per chunk in streaming mode. Controls the peak memory of the checks
+# Elevation check parameters
+DEM_PATH = os.getenv('DEM_PATH')   # Local DEM raster. The check is skipped if it's not configured
+DEM_MAX_DIFFERENCE = 5   # Meters. Max difference between the surveyed Z of a found point and the terrain
+# Directory of the runs' private workspaces
+WORKSPACES_DIR = path.join(WORK_DIR, 'workspaces')
+# Pipeline stages, in order, and their time budgets in seconds. A run that exceeds a budget stops and
+# sends a partial report. The 'total' budget limits the whole run
+QA_STAGES = ('preflight', 'preparation', 'ingestion', 'reference_load', 'check_database', 'check_fields',
+             'check_geometry', 'check_points', 'check_topology', 'export')
+# Keys of the checks, as saved into the QA history. They are stable, unlike the text of the checks' headers
+QA_CHECKS = ('line_structure', 'preparation', 'line_exists', 'line_changes', 'tram_fields', 'geometry', 'tram_vertexs',
+             'tram_segments', 'p_proposta', 'points', 'points_tables', 'topology', 'interrupted')
+QA_STAGE_BUDGETS = {
+    'total': 3600,
+    'reference_load': 600,
+    'check_database': 600,
+    'check_geometry': 900,
+    'check_points': 900,
+    'check_topology': 900
+}
+# Fields that every layer and table must have, validated by the pre-flight stage reading only the files' headers
+PREFLIGHT_FIELDS = {
+    'Lin_TramPpta': ('ID_LINIA', 'ID', 'DATA', 'COMENTARI', 'P1', 'P2', 'P3', 'P4', 'PF', 'ID_FITA1', 'ID_FITA2'),
+    'Lin_Tram': ('ID', 'ID_LINIA', 'ID_SECTOR', 'ID_TRAM', 'OBSERVACIO', 'CORR_DIF', 'ID_FITA1', 'ID_FITA2'),
+    'Punt': ('ID_PUNT', 'ETIQUETA', 'CONTACTE', 'FOTOS'),
+    'PUNT_FIT': ('ID_PUNT', 'ID_FITA', 'TROBADA', 'AUX'),
+    'P_Proposta': ('ID_PUNT', 'PFF', 'ESFITA', 'ORDPF')
+}
+
+
+class CheckHistoryHandler(logging.Handler):
+    """
+    Logging handler that counts the errors of every check for the QA history. The checks are identified by the
+    stable key of their header's report, so the history doesn't depend on the reports' text
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.check = ''
+        self.checks = {}   # Check's key -> Nº of errors, keeping the checks order
+        self.errors = []   # Check's key, level and message of every error
+
+    def emit(self, record):
+        check = getattr(record, 'check', None)
+        if check is not None:   # Header of a check
+            self.check = check
+            self.checks.setdefault(check, 0)
+        # The reports before the first check, as the reference data version, don't belong to any check
+        if self.check and record.levelno >= logging.ERROR:
+            self.checks[self.check] += 1
+            self.errors.append((self.check, record.levelname, record.getMessage().strip()))
 
 
 class CheckQualityLine(View):
@@ -37,9 +127,18 @@ class CheckQualityLine(View):
     line_id = None
     line_type = None
     line_id_txt = None
+    run_id = None
     current_date = None
+    started_at = None
+    metrics = None
+    token = None
+    workspace = None
+    reference = None
+    reference_version = None
+    streaming = False
     logger = logging.getLogger()
     log_path = None
+    history_handler = None
     ppf_list = None
     fites_list = None
     found_points_dict = None
@@ -58,6 +157,8 @@ class CheckQualityLine(View):
     lin_tram_line_gdf = None
     punt_line_gdf = None
     tram_line_layer = None
+    tram_line_layer_name = None
+    tram_attributes = None
     db_line_layer = None
     db_point_layer = None
     p_proposta_df = None
@@ -65,9 +166,16 @@ class CheckQualityLine(View):
     # Coordinates data structures
     points_coords_dict = None
     line_coords_list = None
+    tram_vertex_arrays = None
+    # Line size, for the QA history
+    n_trams = None
+    n_vertexs = None
+    n_points = None
     # Json response
     response_data = {}
+    report_id = None
 
+    @profiled(lambda view: path.splitext(view.log_path)[0] if view.log_path else None, entry_name='check_line')
     def get(self, request):
         """
         Main entry point. Here is where the magic is done. This method is called when someone wants to init the process of quality
@@ -78,53 +186,101 @@ class CheckQualityLine(View):
         # Set up parameters
         line_id = request.GET.get('line_id')
         line_type = request.GET.get('line_type')
-        # Check the line ID input
-        if not line_id:
-            messages.error(request, "No s'ha introduit cap ID Linia")
-            return redirect("qa-page")
-        if int(line_id) < 0:
-            messages.error(request, "L'ID Linia no es vàlid")
+        # Check the line ID input and that the upload line directory exists
+        input_error = self.check_input(line_id)
+        if input_error:
+            messages.error(request, input_error)
             return redirect("qa-page")
-        # Check that the upload line directory exists
+        # Run the quality check
+        response = self.run_qa(line_id, line_type)
+        if response['response']['result'] == 'error':
+            return render(request, '../templates/qa_reports.html', response)
+        # Keep only the stored report's ID into the session
+        request.session['report_id'] = self.report_id
+        return redirect('qa-report')
+
+    def check_input(self, line_id):
+        """
+        Check the line ID input and that the upload line directory exists
+        :param line_id: line ID introduced by the user
+        :return: error_message - Message with the input error, or None if the input is valid
+        """
+        if not line_id:
+            return "No s'ha introduit cap ID Linia"
+        if not str(line_id).isdigit():
+            return "L'ID Linia no es vàlid"
         line_dir_exists = self.check_line_dir_exists(line_id)
         if not line_dir_exists:
-            messages.error(request, f"No existeix la carpeta de la linia {line_id} al directori de càrrega.")
-            return redirect("qa-page")
+            return f"No existeix la carpeta de la linia {line_id} al directori de càrrega."
+
+        return None
+
+    def run_qa(self, line_id, line_type, log_handlers=None, token=None, run_id=None):
+        """
+        Run the quality check of a line whose folder exists into the uploading directory
+        :param line_id: line ID from the line the class is going to check
+        :param line_type: line type from the line the class is going to check, 'mtt' or 'rep'
+        :param log_handlers: extra logging handlers that receive the reports while they are produced
+        :param token: cancellation token of the run. If not given, the run is only limited by QA_STAGE_BUDGETS
+        :param run_id: ID of the run, as the job ID. If not given, a new one is created
+        :return: response - Dict with the response data
+        """
         # Set up environment variables
-        self.set_up(line_id, line_type)
-        # Check and set directories paths
+        self.set_up(line_id, line_type, log_handlers, run_id)
+        # The reference data backend is resolved once, so a refresh of the snapshot during the run doesn't affect it
+        self.reference = get_reference(WORK_GPKG)
+        self.reference_version = self.reference.version
+        self.response_data['reference_version'] = self.reference_version
+        self.logger.info(f"Versio de les dades de referencia: {self.reference_version or 'sense versio'}")
+        self.metrics = StageMetrics('qa_line', line_id)
+        self.token = token or CancellationToken(QA_STAGE_BUDGETS)
+        # The line's layers are copied into a private workspace, so the runs don't share any writable file
+        self.workspace = Workspace(WORKSPACES_DIR, prefix=f'qa_{self.line_id_txt}_')
+        try:
+            return self.check_line()
+        except PipelineCancelled as e:
+            return self.create_partial_response(e)
+        finally:
+            self.workspace.remove()
+            self.metrics.finish(get_sidecar_path(self.log_path))
+            self.reset_logger()  # Reset the logger to avoid modify tbe later reports done
+
+    def check_line(self):
+        """
+        Prepare the workspace and the line and check its geometry and attributes
+        :return: response - Dict with the response data
+        """
         # From this step to above the bugs and reports are going to be written into the log report
-        self.logger.info("Validant i preparant l'entorn de treball...")
-        directory_tree_valid = self.check_directories()
-        if directory_tree_valid:
-            self.set_directories()
-        else:
-            msg = "L'estructura de directoris de la carpeta de la linia no és vàlida. Si us plau, revisa" \
-                  " que la carpeta DocDelim existeixi i que tots els seus subdirectoris també."
-            response = self.create_error_response(msg)
-            return render(request, '../templates/qa_reports.html', response)
+        # Check the structure of the line's folder before any heavy work, reading only the files' headers
+        self.start_stage('preflight')
+        self.logger.info("Validant l'estructura de la carpeta de la linia...", extra={'check': 'line_structure'})
+        structure_problems = self.check_line_structure(os.path.join(UPLOAD_DIR, str(self.line_id)))
+        if structure_problems:
+            msg = f"L'estructura de la carpeta de la linia no és vàlida: {'; '.join(structure_problems)}."
+            return self.create_error_response(msg)
+        # Copy the line's folder and set directories paths
+        self.start_stage('preparation')
+        self.logger.info("Preparant l'entorn de treball...", extra={'check': 'preparation'})
+        self.copy_line_dir()
+        self.set_directories()
         # Remove temp files from the workspace
         try:
             self.rm_temp()
         except Exception as e:
             msg = f'Error esborrant arxius temporals => {e}'
-            response = self.create_error_response(msg)
-            return render(request, '../templates/qa_reports.html', response)
-        # Check if all the necessary entities exist
-        entities_exist = self.check_entities_exist()
-        if not entities_exist:
-            msg = "Falten capes o taules necessaries pel procés de control de qualitat. Si us plau, revisa que totes les capes i taules" \
-                  " estiguin a les carpetes 'Cartografia' i 'Taules'."
-            response = self.create_error_response(msg)
-            return render(request, '../templates/qa_reports.html', response)
+            return self.create_error_response(msg)
         # Copy layers and tables from line's folder to the workspace
+        self.start_stage('ingestion')
         copied_data_ok = self.copy_data_2_gpkg()
         if not copied_data_ok:
             msg = "No s'han pogut copiar capes o taules. Veure log per més informació."
-            response = self.create_error_response(msg)
-            return render(request, '../templates/qa_reports.html', response)
-        # Set the layers geodataframes
+            return self.create_error_response(msg)
+        # Set the layers geodataframes, enabling the streaming mode if the line is very large
+        self.start_stage('reference_load')
+        self.streaming = self.check_streaming_mode()
         self.set_layers_gdf()
+        # Get the trams' IDs and fites, used to report the trams without keeping the whole line layer
+        self.tram_attributes = self.get_tram_attributes()
         # Create list with only points that are "Proposta Final"
         if self.line_type == 'mtt': self.ppf_list = self.get_ppf_list()
         # Create list with only points that are "Fita"
@@ -134,27 +290,40 @@ class CheckQualityLine(View):
         # Get a dict with the points ID and their coordinates
         self.points_coords_dict = self.get_point_coordinates()
         # Get a list with the line coordinates
-        self.line_coords_list = self.get_line_coordinates()
+        # In streaming mode it is computed only when needed in order to reduce the peak memory
+        if not self.streaming: self.line_coords_list = self.get_line_coordinates()
 
         # #######################
         # DATA CHECKING
         # Check if the line ID already exists into the database
+        self.start_stage('check_database')
         self.check_line_id_exists()
+        # Compare the line with its current version into the database, if exists
+        self.check_line_changes()
         # Check if the line's field structure and content is correct
+        self.start_stage('check_fields')
         tram_line_ok = self.check_tram_line_layer()
         if not tram_line_ok:
             msg = "L'estructura de camps de la capa de trams de línia no és correcte i no es pot continuar el procés," \
                   " donat que hi ha algun camp que falta o sobra a la capa. Si us plau, revisa-la."
-            response = self.create_error_response(msg)
-            return render(request, '../templates/qa_reports.html', response)
+            return self.create_error_response(msg)
         # Check the line and point's geometry
+        self.start_stage('check_geometry')
         self.check_layers_geometry()
         # Check that all the points indicated in the line layer exists in the tables and have filled correctly
         # all the attributes
         self.check_lin_tram_points()
         # Get info from the parts and vertex of every line tram
+        self.tram_vertex_arrays = self.get_tram_vertex_arrays()
+        self.n_trams = self.tram_attributes.shape[0]
+        self.n_vertexs = self.tram_vertex_arrays['coords'].shape[0]
+        self.n_points = self.count_features('Punt')
         self.info_vertex_line()
+        # Check the line's segments in order to find tiny segments, spikes and repeated vertexs
+        self.check_tram_segments()
+        self.release_frames('tram_vertex_arrays')
         # Check some aspects about found points, first of all checking if exists any found point
+        self.start_stage('check_points')
         if self.found_points_dict: self.check_found_points()
         # Check if the 3T points are indicated correctly
         self.check_3termes()
@@ -166,28 +335,43 @@ class CheckQualityLine(View):
             self.info_p_proposta()
         # Check the relation between the tables and the point layer
         self.check_relation_points_tables()
+        self.release_frames('p_proposta_df')
         # Check the topology in order to avoid topological errors
+        self.start_stage('check_topology')
         self.check_topology()
+        self.release_frames('tram_line_mem_gdf', 'fita_mem_gdf', 'tram_line_rep_gdf', 'fita_rep_gdf', 'db_line_layer',
+                            'db_point_layer', 'line_coords_list', 'points_coords_dict', 'tram_attributes')
 
         # #######################
         # RESPONSE SEND
+        self.start_stage('export')
         # Remove working directory
         self.rm_working_directory()
         # Send response as OK
         self.response_data['result'] = 'OK'
-        self.response_data['message'] = f'Linia {line_id} validada'
+        self.response_data['message'] = f'Linia {self.line_id} validada'
         response = self.add_response_data()
-        request.session['response'] = response
-        self.reset_logger()  # Reset the logger to avoid modify tbe later reports done
-        return redirect('qa-report')
+        # Store the report server-side, in order to keep only its ID into the session
+        self.report_id = save_report(response)
+        # Save the run into the QA history
+        self.save_history(self.report_id)
+
+        return response
 
-    def set_up(self, line_id, line_type):
+    def set_up(self, line_id, line_type, log_handlers=None, run_id=None):
         """
         Set up the environment parameters that the class would need
         :param line_id: line ID from the line the class is going to check
         :param line_type: line type from the line the class is going to check. It can be 'mtt' or 'rep', and
                           means whether the line is official or not
+        :param log_handlers: extra logging handlers that receive the reports while they are produced
+        :param run_id: ID of the run. If not given, a new one is created
         """
+        self.run_id = run_id or uuid.uuid4().hex
+        # Restart response data, line folder and run's start time
+        self.response_data = {}
+        self.line_folder = None
+        self.started_at = timezone.now()
         # Set line ID
         self.line_id = line_id
         # Set line type
@@ -195,21 +379,26 @@ class CheckQualityLine(View):
         # Convert line ID from integer to string nnnn
         self.line_id_txt = line_id_2_txt(self.line_id)
         # Configure logger
-        self.set_logging_config()
+        self.set_logging_config(log_handlers)
         # Write first log message
         self.write_first_report()
 
-    def set_logging_config(self):
+    def set_logging_config(self, log_handlers=None):
         """
-        Set up the logger config
+        Set up the logger config. Every run has its own logger and log file, in order to avoid mixing the reports of
+        concurrent runs, even of the same line
+        :param log_handlers: extra logging handlers that receive the reports while they are produced
         """
+        # The logger is not registered into the logging module, so it's released with the run
+        self.logger = logging.Logger(f'qa_line.{self.line_id_txt}.{self.run_id}')
+        self.logger.propagate = False
         # Logging level
         self.logger.setLevel(logging.INFO)
         # Message format
         log_format = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
         # Log filename and path
         self.current_date = datetime.now().strftime("%Y%m%d-%H%M")
-        log_name = f"QA_log-{self.line_id_txt}-{self.current_date}.txt"
+        log_name = f"QA_log-{self.line_id_txt}-{self.current_date}-{self.run_id[:8]}.txt"
         log_dir = WORK_REC_DIR if self.line_type == 'mtt' else WORK_REP_DIR
         self.log_path = path.join(LINES_DIR, self.line_id, log_dir, log_name)
         if path.exists(self.log_path):  # If a log with the same filename exists, removes it
@@ -217,129 +406,279 @@ class CheckQualityLine(View):
         file_handler = logging.FileHandler(filename=self.log_path, mode='a')
         file_handler.setFormatter(log_format)
         self.logger.addHandler(file_handler)
+        self.history_handler = CheckHistoryHandler()
+        self.logger.addHandler(self.history_handler)
+        for handler in log_handlers or []:
+            self.logger.addHandler(handler)
 
     def check_line_dir_exists(self, line_id):
         """
-        Check if the line folder exists in the uploading directory and copy it into the working directory
+        Check if the line folder exists in the uploading directory
         :return: boolean that indicates whether the line folder exists or not
         """
-        line_folder = os.path.join(UPLOAD_DIR, str(line_id))
-        if path.exists(line_folder):
-            local_line_folder = os.path.join(WORK_DIR, str(line_id))
-            if os.path.exists(local_line_folder):
-                shutil.rmtree(local_line_folder)
-            shutil.copytree(line_folder, local_line_folder)
-            self.line_folder = local_line_folder
-            return True
-        else:
-            return False
+        return path.isdir(os.path.join(UPLOAD_DIR, str(line_id)))
 
-    def check_directories(self):
+    def copy_line_dir(self):
         """
-        Check if the directory tree structure and content is correct
-        :return: boolean that indicates if the line's folder's directory tree is correct or not
+        Copy the line folder from the uploading directory into the run's workspace, so the concurrent runs of the same
+        line don't share it
         """
-        tree_valid = True
+        line_folder = os.path.join(UPLOAD_DIR, str(self.line_id))
+        self.line_folder = os.path.join(self.workspace.dir, str(self.line_id))
+        shutil.copytree(line_folder, self.line_folder)
 
-        doc_delim = os.path.join(self.line_folder, 'DocDelim')
-        if path.exists(doc_delim):  # Check the DocDelim folder exists
-            self.doc_delim = doc_delim
-            for sub_dir in SUB_DIR_LIST:  # Check if all the subdirs exist
-                if sub_dir not in os.listdir(self.doc_delim):
-                    tree_valid = False
-                    self.logger.critical(f'   No existeix el subdirectori {sub_dir}')
-        else:
-            self.logger.critical('   No existeix DocDelim dins el directori de la linia')
-            tree_valid = False
+    def check_line_structure(self, line_folder):
+        """
+        Check the line's folder structure: the directory tree, the necessary shapefiles and tables and their fields.
+        Only the files' headers are read, so all the structural problems are reported before any heavy work starts
+        :param line_folder: path to the line's folder
+        :return: problems - List with all the structural problems found, empty if the structure is correct
+        """
+        problems = self.check_directories(line_folder)
+        if not problems:
+            doc_delim = os.path.join(line_folder, 'DocDelim')
+            problems += self.check_entities_exist(doc_delim)
+            problems += self.check_entities_schema(doc_delim)
+
+        for problem in problems:
+            self.logger.critical(f'   {problem}')
+        if not problems:
+            self.logger.info('   Estructura de directoris, capes, taules i camps OK')
 
-        if tree_valid:
-            self.logger.info('   Estructura de directoris OK')
-            return tree_valid
+        return problems
+
+    @staticmethod
+    def check_directories(line_folder):
+        """
+        Check if the directory tree structure is correct
+        :param line_folder: path to the line's folder
+        :return: problems - List with the directory tree problems
+        """
+        doc_delim = os.path.join(line_folder, 'DocDelim')
+        if not path.isdir(doc_delim):  # Check the DocDelim folder exists
+            return ['No existeix DocDelim dins el directori de la linia']
+
+        doc_delim_content = os.listdir(doc_delim)
+        return [f'No existeix el subdirectori {sub_dir}' for sub_dir in SUB_DIR_LIST
+                if sub_dir not in doc_delim_content]
 
     def set_directories(self):
         """Set paths to directories"""
-
+        self.doc_delim = os.path.join(self.line_folder, 'DocDelim')
         self.carto_folder = os.path.join(self.doc_delim, 'Cartografia')
         self.tables_folder = os.path.join(self.doc_delim, 'Taules')
         self.photo_folder = os.path.join(self.doc_delim, 'Fotografies')
 
     def set_layers_gdf(self):
-        """Open all the necessary layers as geodataframes with geopandas"""
+        """
+        Open all the necessary layers as geodataframes with geopandas. The database layers are read from the
+        memory-mapped geometry store shared by the workers, reading only the database features close to the line.
+        In streaming mode the line's layers and tables are not loaded at all: the checks read them in chunks and keep
+        only small aggregates, as the features' IDs and the trams' endpoints
+        """
+        self.tram_line_layer_name = 'Lin_TramPpta' if self.line_type == 'mtt' else 'Lin_Tram'
+        bbox = self.get_line_bbox()
+        # DB layers
+        if self.line_type == 'mtt':
+            self.tram_line_mem_gdf = self.reference.read_layer('tram_linia_mem', bbox=bbox)
+            self.fita_mem_gdf = self.reference.read_layer('fita_mem', bbox=bbox)
+            self.db_line_layer = self.tram_line_mem_gdf
+            self.db_point_layer = self.fita_mem_gdf
+        elif self.line_type == 'rep':
+            self.tram_line_rep_gdf = self.reference.read_layer('tram_linia_rep', bbox=bbox)
+            self.fita_rep_gdf = self.reference.read_layer('fita_rep', bbox=bbox)
+            self.db_line_layer = self.tram_line_rep_gdf
+            self.db_point_layer = self.fita_rep_gdf
+        if self.streaming:
+            return
+
         # Lines and points
         if self.line_type == 'mtt':
-            # DB layers
-            self.tram_line_mem_gdf = gpd.read_file(WORK_GPKG, layer='tram_linia_mem')
-            self.fita_mem_gdf = gpd.read_file(WORK_GPKG, layer='fita_mem')
             # Line layer
-            self.lin_tram_ppta_line_gdf = gpd.read_file(WORK_GPKG, layer='Lin_TramPpta')
+            self.lin_tram_ppta_line_gdf = gpd.read_file(self.workspace.gpkg, layer='Lin_TramPpta')
             # Tables
-            self.p_proposta_df = gpd.read_file(WORK_GPKG, layer='P_Proposta')
+            self.p_proposta_df = gpd.read_file(self.workspace.gpkg, layer='P_Proposta')
         elif self.line_type == 'rep':
-            # DB layers
-            self.tram_line_rep_gdf = gpd.read_file(WORK_GPKG, layer='tram_linia_rep')
-            self.fita_rep_gdf = gpd.read_file(WORK_GPKG, layer='fita_rep')
             # Line layer
-            self.lin_tram_line_gdf = gpd.read_file(WORK_GPKG, layer='Lin_Tram')
+            self.lin_tram_line_gdf = gpd.read_file(self.workspace.gpkg, layer='Lin_Tram')
             # Tables
-            if 'P_Proposta' in fiona.listlayers(WORK_GPKG):   # P_Proposta table can be empty if the line type is a replantejament
-                self.p_proposta_df = gpd.read_file(WORK_GPKG, layer='P_Proposta')
-        self.punt_line_gdf = gpd.read_file(WORK_GPKG, layer='Punt')
-        self.punt_fit_df = gpd.read_file(WORK_GPKG, layer='PUNT_FIT')
+            if 'P_Proposta' in fiona.listlayers(self.workspace.gpkg):   # P_Proposta table can be empty if the line type is a replantejament
+                self.p_proposta_df = gpd.read_file(self.workspace.gpkg, layer='P_Proposta')
+        self.punt_line_gdf = gpd.read_file(self.workspace.gpkg, layer='Punt')
+        self.punt_fit_df = gpd.read_file(self.workspace.gpkg, layer='PUNT_FIT')
 
         # Set common line type layer. Depending on the function logic it has to take the official line layer or
         # the non official line layer. In order to don't repeat the layer variable declaration, it is declared here
-        if self.line_type == 'mtt':
-            # Line layer
-            self.tram_line_layer = self.lin_tram_ppta_line_gdf
-            # Database layers
-            self.db_line_layer = self.tram_line_mem_gdf
-            self.db_point_layer = self.fita_mem_gdf
-        elif self.line_type == 'rep':
-            self.db_line_layer = self.tram_line_rep_gdf
-            self.db_point_layer = self.fita_rep_gdf
-            self.tram_line_layer = self.lin_tram_line_gdf
+        self.tram_line_layer = self.lin_tram_ppta_line_gdf if self.line_type == 'mtt' else self.lin_tram_line_gdf
 
-    def check_entities_exist(self):
+    def check_streaming_mode(self):
         """
-        Check if all the necessary shapefiles and tables exists
-        :return: entities_exist - Boolean that means if all the entities exists in the source workspace
+        Check whether the streaming mode must be enabled. In streaming mode the per-feature checks process the layers
+        in chunks and the line's layers are never loaded whole, in order to bound the memory used by very large lines
+        :return: boolean that indicates if the streaming mode is enabled
         """
-        shapes_exist, tables_exist = False, False
-        for shape in SHAPES_LIST:
-            shape_path = os.path.join(self.carto_folder, shape)
-            if path.exists(shape_path):
-                shapes_exist = True
-            else:
-                shapes_exist = False
+        if STREAMING_MODE in ('on', 'off'):
+            streaming = STREAMING_MODE == 'on'
+        else:
+            line_layer = 'Lin_TramPpta' if self.line_type == 'mtt' else 'Lin_Tram'
+            n_features = self.count_features(line_layer) + self.count_features('Punt')
+            streaming = n_features >= STREAMING_MIN_FEATURES
+        if streaming:
+            self.logger.info(f'   Mode streaming activat, amb blocs de {CHUNK_SIZE} elements')
 
-        for dbf in TABLE_LIST:
-            dbf_path = os.path.join(self.tables_folder, dbf)
-            if path.exists(dbf_path):
-                tables_exist = True
-            else:
-                tables_exist = False
+        return streaming
 
-        if not shapes_exist and not tables_exist:
-            self.logger.critical('   Falten capes i taules necessàries a les carpetes de Cartografia i Taules')
-            return False
-        elif not shapes_exist and tables_exist:
-            self.logger.critical('   Falten capes necessàries a la carpeta de Cartografia')
-            return False
-        elif shapes_exist and not tables_exist:
-            self.logger.critical('   Falten taules necessàries a la carpeta de Taules')
-            return False
-        else:
-            return True
+    def get_line_bbox(self):
+        """
+        Get the line's bounding box, expanded in order to find the database features close to the line
+        :return: bbox - Tuple with the bounding box (minx, miny, maxx, maxy)
+        """
+        with fiona.open(self.workspace.gpkg, layer=self.tram_line_layer_name) as src:
+            minx, miny, maxx, maxy = src.bounds
+        margin = CHANGE_SEARCH_DISTANCE
+
+        return minx - margin, miny - margin, maxx + margin, maxy + margin
+
+    def count_features(self, layer_name):
+        """
+        Count the features of a line's layer into the workspace, without reading them
+        :param layer_name: name of the layer into the workspace
+        :return: n_features - Number of features of the layer
+        """
+        with fiona.open(self.workspace.gpkg, layer=layer_name) as src:
+            return len(src)
+
+    def iter_layer_chunks(self, layer_name):
+        """
+        Iterate over a line's layer or table. In streaming mode the layer is read from the workspace in chunks of
+        CHUNK_SIZE features, in order to bound the memory used by the per-feature checks. If not, the whole layer's
+        geodataframe is returned at once
+        :param layer_name: name of the layer into the workspace, Punt, PUNT_FIT, P_Proposta or the line layer
+        :return: chunk - Geodataframe with a chunk of the layer's features
+        """
+        if not self.streaming:
+            layers = {'Punt': self.punt_line_gdf, 'PUNT_FIT': self.punt_fit_df, 'P_Proposta': self.p_proposta_df}
+            layer = layers.get(layer_name, self.tram_line_layer)
+            if layer is not None:   # P_Proposta table can be missing if the line type is a replantejament
+                yield layer
+            return
+
+        if layer_name not in fiona.listlayers(self.workspace.gpkg):
+            return
+        with fiona.open(self.workspace.gpkg, layer=layer_name) as src:
+            features = iter(src)
+            while True:
+                chunk_features = list(islice(features, CHUNK_SIZE))
+                if not chunk_features:
+                    break
+                self.token.check()
+                chunk = gpd.GeoDataFrame.from_features(chunk_features, crs=src.crs)
+                del chunk_features
+                yield chunk
+                del chunk
+
+    def release_frames(self, *attributes):
+        """
+        Release the geodataframes and data structures that are no longer needed, in order to reduce the peak memory
+        :param attributes: names of the class attributes to release
+        """
+        for attribute in attributes:
+            setattr(self, attribute, None)
+        gc.collect()
+
+    def get_tram_attributes(self):
+        """
+        Get the attributes of the line's trams without their geometries, in order to report the trams and their fites
+        by the tram's position without keeping the whole line layer
+        :return: tram_attributes - Dataframe with the ID, ID_TRAM, ID_FITA1 and ID_FITA2 of every tram, if exist
+        """
+        fields = ('ID', 'ID_TRAM', 'ID_FITA1', 'ID_FITA2')
+        chunks = [pd.DataFrame(trams[[field for field in fields if field in trams.columns]])
+                  for trams in self.iter_layer_chunks(self.tram_line_layer_name)]
+        if not chunks:
+            return pd.DataFrame(columns=list(fields))
+
+        return pd.concat(chunks, ignore_index=True)
+
+    def iter_tram_geometries(self):
+        """
+        Iterate over the geometries of the line's trams, chunk by chunk in streaming mode
+        :return: tram_pos - Position of the tram into the line layer, as in tram_attributes
+        :return: geom - Tram's geometry
+        """
+        tram_pos = 0
+        for trams in self.iter_layer_chunks(self.tram_line_layer_name):
+            for geom in trams['geometry']:
+                yield tram_pos, geom
+                tram_pos += 1
+
+    def check_entities_exist(self, doc_delim):
+        """
+        Check if all the necessary shapefiles and tables of the line type exists
+        :param doc_delim: path to the line's DocDelim folder
+        :return: problems - List with the missing shapefiles and tables
+        """
+        shapes_list = OFFICIAL_SHAPES_LIST if self.line_type == 'mtt' else NONOFFICIAL_SHAPES_LIST
+        problems = [f'Falta la capa {shape} a la carpeta de Cartografia' for shape in shapes_list
+                    if not path.exists(os.path.join(doc_delim, 'Cartografia', shape))]
+        problems += [f'Falta la taula {dbf} a la carpeta de Taules' for dbf in TABLE_LIST
+                     if not path.exists(os.path.join(doc_delim, 'Taules', dbf))]
+
+        return problems
+
+    def check_entities_schema(self, doc_delim):
+        """
+        Check that the shapefiles and tables can be opened and have all the necessary fields, and that the .prj of the
+        shapefiles is a known CRS, reading only their schema
+        :param doc_delim: path to the line's DocDelim folder
+        :return: problems - List with the unreadable entities, the missing fields and the unknown CRS
+        """
+        problems = []
+        shapes_list = OFFICIAL_SHAPES_LIST if self.line_type == 'mtt' else NONOFFICIAL_SHAPES_LIST
+        entities = [os.path.join(doc_delim, 'Cartografia', shape) for shape in shapes_list]
+        entities += [os.path.join(doc_delim, 'Taules', dbf) for dbf in TABLE_LIST]
+        for entity_path in entities:
+            entity_name = path.splitext(path.basename(entity_path))[0]
+            if not path.exists(entity_path):   # Already reported as missing
+                continue
+            try:
+                with fiona.open(entity_path) as src:
+                    entity_fields = src.schema['properties']
+                    entity_crs = src.crs_wkt
+            except Exception as e:
+                problems.append(f"No s'ha pogut llegir {entity_name} => {e}")
+                continue
+            # The shapefiles without .prj are considered to be in the target CRS, but a .prj that can't be
+            # resolved would be silently ignored
+            if path.exists(f'{path.splitext(entity_path)[0]}.prj') and get_epsg(entity_crs) is None:
+                problems.append(f"El sistema de referencia del .prj de {entity_name} no es reconeix")
+            missing_fields = [field for field in PREFLIGHT_FIELDS.get(entity_name, ()) if field not in entity_fields]
+            if missing_fields:
+                problems.append(f"A {entity_name} li falten els camps {', '.join(missing_fields)}")
+
+        return problems
 
     def copy_data_2_gpkg(self):
-        """Copy all the feature classes and tables from the line's folder to the local work geopackage"""
+        """
+        Copy all the feature classes and tables from the line's folder to the run's workspace. The layers that
+        are not in ETRS89, as the ED50 ones, are reprojected while copying them. All the layers are written
+        into the workspace in a single transaction
+        """
+        layers = {}
         shapes_list = OFFICIAL_SHAPES_LIST if self.line_type == 'mtt' else NONOFFICIAL_SHAPES_LIST
         for shape in shapes_list:
             shape_name = shape.split('.')[0]
             shape_path = os.path.join(self.carto_folder, shape)
             try:
                 shape_gdf = gpd.read_file(shape_path)
-                shape_gdf.to_file(WORK_GPKG, layer=shape_name, driver="GPKG")
+                # The official lines are surveyed to the decimetre, so the reprojected coordinates are rounded to it
+                shape_gdf, src_epsg = reproject_gdf(shape_gdf, decimals=1 if self.line_type == 'mtt' else None)
+                if src_epsg is None:
+                    self.logger.warning(f"   La capa {shape_name} no te sistema de referencia conegut, "
+                                        f"es considera EPSG:{TARGET_EPSG}")
+                elif src_epsg != TARGET_EPSG:
+                    self.logger.info(f"   Capa {shape_name} reprojectada de EPSG:{src_epsg} a EPSG:{TARGET_EPSG}")
+                layers[shape_name] = shape_gdf
             except Exception as e:
                 self.logger.critical(f"   No s'ha pogut copiar la capa {shape_name} => {e}")
                 return False
@@ -351,32 +690,34 @@ class CheckQualityLine(View):
                 dbf_gdf = gpd.read_file(dbf_path)
                 if self.line_type == 'rep' and dbf_name == 'P_Proposta':   # P_Proposta table can be empty if the line type is a replantejament
                     if not dbf_gdf.empty:
-                        dbf_gdf.to_file(WORK_GPKG, layer=dbf_name, driver="GPKG")
+                        layers[dbf_name] = dbf_gdf
                 else:
-                    dbf_gdf.to_file(WORK_GPKG, layer=dbf_name, driver="GPKG")
+                    layers[dbf_name] = dbf_gdf
             except Exception as e:
                 self.logger.error(f"   No s'ha pogut copiar la taula {dbf_name} => {e}")
                 return False
 
-        self.logger.info(f"   Capes i taules de la linia {self.line_id} copiades correctament al geopackage local")
+        try:
+            self.workspace.write_layers(layers)
+        except Exception as e:
+            self.logger.critical(f"   No s'han pogut escriure les capes i taules a l'espai de treball => {e}")
+            return False
+
+        self.logger.info(f"   Capes i taules de la linia {self.line_id} copiades correctament a l'espai de treball")
         return True
 
     def check_line_id_exists(self):
         """Check if the line ID already exists into the database, both into fita_mem and lin_tram_mem"""
-        self.logger.info("Comprovant l'existencia de la linia a la base de dades...")
+        self.logger.info("Comprovant l'existencia de la linia a la base de dades...", extra={'check': 'line_exists'})
         line_id_in_lin_tram, line_id_in_fita_g = False, False
         line_type = 'mem' if self.line_type == 'mtt' else 'rep'
 
         # Check in lin_tram layer
-        tram_duplicated_id = self.db_line_layer['id_linia'] == int(self.line_id)
-        tram_line_id = self.db_line_layer[tram_duplicated_id]
-        if not tram_line_id.empty:
+        if self.reference.feature_exists(f'tram_linia_{line_type}', id_linia=int(self.line_id)):
             line_id_in_lin_tram = True
 
         # Check in fita layer
-        fita_duplicated_id = self.db_point_layer['id_linia'] == int(self.line_id)
-        fita_line_id = self.db_point_layer[fita_duplicated_id]
-        if not fita_line_id.empty:
+        if self.reference.feature_exists(f'fita_{line_type}', id_linia=int(self.line_id)):
             line_id_in_fita_g = True
 
         if line_id_in_fita_g and line_id_in_lin_tram:
@@ -388,11 +729,168 @@ class CheckQualityLine(View):
         elif not line_id_in_fita_g and not line_id_in_lin_tram:
             self.logger.info(f"   L'ID de linia no esta repetit a fita_{line_type} ni a lin_tram_{line_type} de SIDM3")
 
+    def check_line_changes(self):
+        """
+        Compare the line with its current version into the database, if exists, and report the trams and points
+        that have been moved, added or removed
+        """
+        self.logger.info('Comparant la linia amb la versio actual de la base de dades...', extra={'check': 'line_changes'})
+        line_type = 'mem' if self.line_type == 'mtt' else 'rep'
+        db_trams = self.reference.read_features(f'tram_linia_{line_type}', id_linia=int(self.line_id))
+        db_points = self.reference.read_features(f'fita_{line_type}', id_linia=int(self.line_id))
+        if db_trams.empty and db_points.empty:
+            self.logger.info("   La linia no existeix a la base de dades, no hi ha canvis a comparar")
+            return
+
+        self.compare_trams(db_trams)
+        self.compare_points(db_points)
+
+    def compare_trams(self, db_trams):
+        """
+        Match every line tram with its closest database tram, using the Hausdorff distance, and report the
+        trams that have been moved, added or removed
+        :param db_trams: geodataframe with the database trams of the line
+        """
+        db_sindex = db_trams.sindex if not db_trams.empty else None
+        matched_db_trams = set()
+        n_unchanged = 0
+        for tram_pos, geom in self.iter_tram_geometries():
+            self.token.check()
+            if geom is None or geom.is_empty:
+                continue
+            tram_id = self.get_tram_id(tram_pos)
+            # Get the database trams whose bounding box is close to the tram and keep the closest one
+            best_match, best_distance = None, None
+            if db_sindex is not None:
+                minx, miny, maxx, maxy = geom.bounds
+                candidates = db_sindex.intersection((minx - CHANGE_SEARCH_DISTANCE, miny - CHANGE_SEARCH_DISTANCE,
+                                                     maxx + CHANGE_SEARCH_DISTANCE, maxy + CHANGE_SEARCH_DISTANCE))
+                for candidate in candidates:
+                    distance = geom.hausdorff_distance(db_trams['geometry'].iloc[candidate])
+                    if best_distance is None or distance < best_distance:
+                        best_match, best_distance = candidate, distance
+
+            if best_match is None or best_distance > CHANGE_SEARCH_DISTANCE:
+                self.logger.info(f"   El tram {tram_id} es nou respecte la base de dades")
+                continue
+            matched_db_trams.add(best_match)
+            if best_distance <= CHANGE_TOLERANCE:
+                n_unchanged += 1
+                continue
+            # Moved tram
+            frechet_distance = self.get_frechet_distance(geom, db_trams['geometry'].iloc[best_match])
+            db_tram_id = db_trams['id_tram_linia'].iloc[best_match]
+            frechet_msg = f"{frechet_distance:.3f} m" if frechet_distance is not None else "no calculada"
+            self.logger.info(f"   El tram {tram_id} s'ha modificat respecte el tram {db_tram_id} de la base de dades. "
+                             f"Distancia Hausdorff: {best_distance:.3f} m   Distancia Frechet: {frechet_msg}")
+
+        # Removed trams
+        for db_tram_pos in range(db_trams.shape[0]):
+            if db_tram_pos not in matched_db_trams:
+                db_tram_id = db_trams['id_tram_linia'].iloc[db_tram_pos]
+                self.logger.info(f"   El tram {db_tram_id} de la base de dades no existeix a la linia")
+
+        self.logger.info(f"   Trams sense canvis: {n_unchanged}")
+
+    def compare_points(self, db_points):
+        """
+        Match every point with its database version, firstly by the ID PUNT and then by the nearest neighbour, and
+        report the points that have been moved, added or removed
+        :param db_points: geodataframe with the database points of the line
+        """
+        # Only the points that are fites, and PPF if the line is official
+        check_points_list = set(self.ppf_list if self.line_type == 'mtt' else self.fites_list)
+        points_ids, points_x, points_y = [], [np.empty(0)], [np.empty(0)]
+        for points in self.iter_layer_chunks('Punt'):
+            points = points[points['ID_PUNT'].isin(check_points_list)]
+            points_ids += points['ID_PUNT'].to_list()
+            points_x.append(points['geometry'].x.to_numpy())
+            points_y.append(points['geometry'].y.to_numpy())
+        points_x, points_y = np.concatenate(points_x), np.concatenate(points_y)
+        db_points_x, db_points_y = db_points['geometry'].x.to_numpy(), db_points['geometry'].y.to_numpy()
+
+        # Match by ID
+        db_point_pos = {point_id: pos for pos, point_id in enumerate(db_points['id_punt'])}
+        point_match = np.array([db_point_pos.get(point_id, -1) for point_id in points_ids], dtype=int)
+        # Match by nearest neighbour the points that don't have an ID match
+        matched_db = np.zeros(db_points.shape[0], dtype=bool)
+        matched_db[point_match[point_match >= 0]] = True
+        if not db_points.empty and (point_match < 0).any():
+            db_sindex = db_points.sindex
+            for pos in np.flatnonzero(point_match < 0):
+                x, y = points_x[pos], points_y[pos]
+                candidates = np.array(list(db_sindex.intersection((x - CHANGE_SEARCH_DISTANCE, y - CHANGE_SEARCH_DISTANCE,
+                                                                   x + CHANGE_SEARCH_DISTANCE, y + CHANGE_SEARCH_DISTANCE))),
+                                      dtype=int)
+                candidates = candidates[~matched_db[candidates]]
+                if candidates.size == 0:
+                    continue
+                distances = np.hypot(db_points_x[candidates] - x, db_points_y[candidates] - y)
+                nearest = candidates[np.argmin(distances)]
+                if distances.min() <= CHANGE_SEARCH_DISTANCE:
+                    point_match[pos] = nearest
+                    matched_db[nearest] = True
+
+        # Moved points
+        matched = np.flatnonzero(point_match >= 0)
+        distances = np.hypot(points_x[matched] - db_points_x[point_match[matched]],
+                             points_y[matched] - db_points_y[point_match[matched]])
+        for pos, distance in zip(matched[distances > CHANGE_TOLERANCE], distances[distances > CHANGE_TOLERANCE]):
+            point_id = points_ids[pos].split('-')[-1]
+            self.logger.info(f"   El punt amb ID PUNT {point_id} s'ha desplaçat {distance:.3f} m respecte la base de dades")
+        # Added points
+        for pos in np.flatnonzero(point_match < 0):
+            point_id = points_ids[pos].split('-')[-1]
+            self.logger.info(f"   El punt amb ID PUNT {point_id} es nou respecte la base de dades")
+        # Removed points
+        for db_pos in np.flatnonzero(~matched_db):
+            db_point_id = str(db_points['id_punt'].iloc[db_pos]).split('-')[-1]
+            self.logger.info(f"   El punt amb ID PUNT {db_point_id} de la base de dades no existeix a la linia")
+
+        self.logger.info(f"   Punts sense canvis: {int((distances <= CHANGE_TOLERANCE).sum())}")
+
+    @staticmethod
+    def get_frechet_distance(geom_a, geom_b):
+        """
+        Compute the discrete Fréchet distance between two lines, walking the distance matrix by anti-diagonals in
+        order to vectorise the computation
+        :param geom_a: first line geometry
+        :param geom_b: second line geometry
+        :return: frechet_distance - Discrete Fréchet distance, or None if the lines are too big to compare
+        """
+        coords_list = []
+        for geom in geom_a, geom_b:
+            parts = geom.geoms if geom.geom_type == 'MultiLineString' else [geom]
+            coords_list.append(np.concatenate([np.asarray(part.coords, dtype=float)[:, :2] for part in parts]))
+        p, q = coords_list
+        n, m = p.shape[0], q.shape[0]
+        if n * m > FRECHET_MAX_CELLS:
+            return None
+        # The lines can be digitized in opposite directions
+        if np.hypot(*(p[0] - q[-1])) < np.hypot(*(p[0] - q[0])):
+            q = q[::-1]
+
+        dist = np.hypot(p[:, None, 0] - q[None, :, 0], p[:, None, 1] - q[None, :, 1])
+        coupling = np.full((n, m), np.inf)
+        coupling[0, 0] = dist[0, 0]
+        for k in range(1, n + m - 1):
+            i = np.arange(max(0, k - m + 1), min(n, k + 1))
+            j = k - i
+            previous = np.full(i.size, np.inf)
+            has_i, has_j = i > 0, j > 0
+            has_both = has_i & has_j
+            previous[has_i] = coupling[i[has_i] - 1, j[has_i]]
+            previous[has_j] = np.minimum(previous[has_j], coupling[i[has_j], j[has_j] - 1])
+            previous[has_both] = np.minimum(previous[has_both], coupling[i[has_both] - 1, j[has_both] - 1])
+            coupling[i, j] = np.maximum(previous, dist[i, j])
+
+        return float(coupling[-1, -1])
+
     def check_tram_line_layer(self):
         """Check line's layer's field structure and content"""
         # The line's layer's field structure is critic for the correct running of the QA process. If it's not correct,
         # the process must stop
-        self.logger.info("Validant l'estructura de camps i contingut de la capa de trams...")
+        self.logger.info("Validant l'estructura de camps i contingut de la capa de trams...", extra={'check': 'tram_fields'})
         fields_lin_tram_ok = self.check_fields_tram_line_layer()
         if not fields_lin_tram_ok:
             return False
@@ -403,19 +901,20 @@ class CheckQualityLine(View):
 
     def check_fields_tram_line_layer(self):
         """Check line's layer's field structure is correct"""
-        lin_tram_fields, true_fields, layer = None, None, ''
+        true_fields, layer = None, ''
 
         if self.line_type == 'mtt':
             # Fields that the line's layer must have
             true_fields = ('ID_LINIA', 'ID', 'DATA', 'COMENTARI', 'P1', 'P2', 'P3', 'P4', 'PF',
                            'ID_FITA1', 'ID_FITA2', 'geometry')
-            lin_tram_fields = list(self.lin_tram_ppta_line_gdf.columns)
             layer = 'Lin Tram Proposta'
         elif self.line_type == 'rep':
             true_fields = ('ID', 'ID_LINIA', 'ID_SECTOR', 'ID_TRAM', 'OBSERVACIO', 'CORR_DIF', 'ID_FITA1', 'ID_FITA2',
                            'geometry')
-            lin_tram_fields = list(self.lin_tram_line_gdf.columns)
             layer = 'Lin Tram'
+        # Read only the layer's schema
+        with fiona.open(self.workspace.gpkg, layer=self.tram_line_layer_name) as src:
+            lin_tram_fields = list(src.schema['properties']) + ['geometry']
 
         # Compare
         field_match = 0
@@ -431,25 +930,21 @@ class CheckQualityLine(View):
 
     def check_fields_content_lint_tram_ppta(self):
         """Check line's layer's content is correct"""
-        # Check that doesn't exist the line ID from another line
-        line_id_error = False
-        not_line_id = self.lin_tram_ppta_line_gdf['ID_LINIA'] != int(self.line_id)
-        tram_not_line_id = self.lin_tram_ppta_line_gdf[not_line_id]
-        if not tram_not_line_id.empty:
-            line_id_error = True
+        line_id_error, id_fita_error = False, False
+        for trams in self.iter_layer_chunks('Lin_TramPpta'):
+            # Check that doesn't exist the line ID from another line
+            not_line_id = trams['ID_LINIA'] != int(self.line_id)
+            if not_line_id.any():
+                line_id_error = True
+            # Check that the fita ID is correct
+            id_f1_bad = trams['ID_FITA1'] == '1'
+            id_f2_bad = trams['ID_FITA2'] == '1'
+            if id_f1_bad.any() or id_f2_bad.any():
+                id_fita_error = True
+
+        if line_id_error:
             self.logger.error("   Existeixen trams de linia amb l'ID d'una altra linia")
-
-        # Check that the fita ID is correct
-        id_fita_error = False
-        # F1
-        id_f1_bad = self.lin_tram_ppta_line_gdf['ID_FITA1'] == '1'
-        tram_id_f1_bad = self.lin_tram_ppta_line_gdf[id_f1_bad]
-        # F2
-        id_f2_bad = self.lin_tram_ppta_line_gdf['ID_FITA2'] == '1'
-        tram_id_f2_bad = self.lin_tram_ppta_line_gdf[id_f2_bad]
-
-        if not tram_id_f1_bad.empty or not tram_id_f2_bad.empty:
-            id_fita_error = True
+        if id_fita_error:
             self.logger.error("   El camp ID FITA d'algun dels trams de la linia no és valid")
 
         if not line_id_error and not id_fita_error:
@@ -460,9 +955,10 @@ class CheckQualityLine(View):
         Get dataframe with the ID of the only points that are "Punt Proposta Final", as known as "PPF"
         :return: ppf_list - List with the ID of the PPF
         """
-        is_ppf = self.p_proposta_df['PFF'] == 1
-        ppf_df = self.p_proposta_df[is_ppf]
-        ppf_list = ppf_df['ID_PUNT'].to_list()
+        ppf_list = []
+        for p_proposta in self.iter_layer_chunks('P_Proposta'):
+            is_ppf = p_proposta['PFF'] == 1
+            ppf_list += p_proposta[is_ppf]['ID_PUNT'].to_list()
 
         return ppf_list
 
@@ -471,7 +967,9 @@ class CheckQualityLine(View):
         Get dataframe with the ID of the only points that are "fites".
         :return: fites_list - List with the ID of the fites
         """
-        fites = self.punt_fit_df['ID_PUNT'].to_list()
+        fites = []
+        for punt_fit in self.iter_layer_chunks('PUNT_FIT'):
+            fites += punt_fit['ID_PUNT'].to_list()
 
         return fites
 
@@ -482,35 +980,32 @@ class CheckQualityLine(View):
         :return: points_found_dict - Dict of the found points with the key, value -> ID_FITA, ID_Punt
         """
         points_found_dict = {}
-        found = self.punt_fit_df['TROBADA'] == '1'
-        points_found = self.punt_fit_df[found]
-        if not points_found.empty:
+        any_found = False
+        ppf = set(self.ppf_list) if self.line_type == 'mtt' else None
+        for punt_fit in self.iter_layer_chunks('PUNT_FIT'):
+            found = punt_fit['TROBADA'] == '1'
+            points_found = punt_fit[found]
+            if points_found.empty:
+                continue
+            any_found = True
             for index, feature in points_found.iterrows():
-                if self.line_type == 'mtt':
-                    if feature['ID_PUNT'] in self.ppf_list:
-                        if feature['AUX'] == '1':
-                            point_num = f"{feature['ID_FITA']}-aux"
-                        else:
-                            point_num = feature['ID_FITA']
-                        point_id = feature['ID_PUNT']
-                        points_found_dict[point_num] = point_id
-                elif self.line_type == 'rep':
-                    if feature['AUX'] == '1':
-                        point_num = f"{feature['ID_FITA']}-aux"
-                    else:
-                        point_num = feature['ID_FITA']
-                    point_id = feature['ID_PUNT']
-                    points_found_dict[point_num] = point_id
-
-            return points_found_dict
+                if self.line_type == 'mtt' and feature['ID_PUNT'] not in ppf:
+                    continue
+                if feature['AUX'] == '1':
+                    point_num = f"{feature['ID_FITA']}-aux"
+                else:
+                    point_num = feature['ID_FITA']
+                point_id = feature['ID_PUNT']
+                points_found_dict[point_num] = point_id
 
-        else:
+        if not any_found:
             return False
+        return points_found_dict
 
     def check_layers_geometry(self):
         """ Check the geometry of both line and points """
         line_layer = 'Lin Tram Proposta' if self.line_type == 'mtt' else 'Lin Tram'
-        self.logger.info('Validant geometries...')
+        self.logger.info('Validant geometries...', extra={'check': 'geometry'})
         self.logger.info(f'   {line_layer}:')
         self.check_lin_tram_geometry()
         self.logger.info('   Punt:')
@@ -522,8 +1017,8 @@ class CheckQualityLine(View):
         tables and have all them attributes correctly filled
         :return: boolean - Indicates whether the points exist in the tables or not
         """
-        lin_tram_point_1 = self.tram_line_layer['ID_FITA1'].to_list()
-        lin_tram_point_2 = self.tram_line_layer['ID_FITA2'].to_list()
+        lin_tram_point_1 = self.tram_attributes['ID_FITA1'].to_list()
+        lin_tram_point_2 = self.tram_attributes['ID_FITA2'].to_list()
         lin_tram_points = lin_tram_point_1 + lin_tram_point_2
         lin_tram_points = list(set(lin_tram_points))
         none_exists = any(x is None for x in lin_tram_points)
@@ -554,84 +1049,222 @@ class CheckQualityLine(View):
         # Set line type layer
         layer = 'Lin Tram Proposta' if self.line_type == 'mtt' else 'Lin Tram'
 
-        # Check if there are empty features
-        is_empty = self.tram_line_layer.is_empty
-        empty_features = self.tram_line_layer[is_empty]
-        if not empty_features.empty:
-            for index, feature in empty_features.iterrows():
-                tram_id = feature['ID']
-                self.logger.error(f'      El tram {tram_id} esta buit')
-        # Check if there is a ring
-        is_ring = self.tram_line_layer.is_empty
-        ring_features = self.tram_line_layer[is_ring]
-        if not ring_features.empty:
-            for index, feature in ring_features.iterrows():
-                tram_id = feature['ID']
-                self.logger.error(f'      El tram {tram_id} te un anell interior')
-        # Check if the line is multi-part and count the parts in that case
-        not_multipart = True
-        for index, feature in self.tram_line_layer.iterrows():
-            geom_type = feature['geometry'].geom_type
-            if geom_type == 'MultiLineString':
-                not_multipart = False
-                tram_id = feature['ID']
-                n_parts = feature['geometry'].geoms
-                self.logger.error(f'      El tram {tram_id} es multi-part i te {n_parts} parts')
-
-        if empty_features.empty and ring_features.empty and not_multipart:
+        geometry_valid = True
+        for trams in self.iter_layer_chunks(self.tram_line_layer_name):
+            # Check if there are empty features
+            is_empty = trams.is_empty
+            empty_features = trams[is_empty]
+            if not empty_features.empty:
+                for index, feature in empty_features.iterrows():
+                    tram_id = feature['ID']
+                    self.logger.error(f'      El tram {tram_id} esta buit')
+            # Check if there is a ring
+            is_ring = trams.is_empty
+            ring_features = trams[is_ring]
+            if not ring_features.empty:
+                for index, feature in ring_features.iterrows():
+                    tram_id = feature['ID']
+                    self.logger.error(f'      El tram {tram_id} te un anell interior')
+            # Check if the line is multi-part and count the parts in that case
+            not_multipart = True
+            for index, feature in trams.iterrows():
+                geom_type = feature['geometry'].geom_type
+                if geom_type == 'MultiLineString':
+                    not_multipart = False
+                    tram_id = feature['ID']
+                    n_parts = feature['geometry'].geoms
+                    self.logger.error(f'      El tram {tram_id} es multi-part i te {n_parts} parts')
+
+            if not empty_features.empty or not ring_features.empty or not not_multipart:
+                geometry_valid = False
+
+        if geometry_valid:
             self.logger.info(f"      No s'ha detectat cap error de geometria a {layer}")
 
     def check_points_geometry(self):
         """Check the points' geometry"""
-        # Check if there are empty features
-        is_empty = self.punt_line_gdf.is_empty
-        empty_features = self.punt_line_gdf[is_empty]
-        if not empty_features.empty:
-            for index, feature in empty_features.iterrows():
-                point_id = feature['ID_PUNT']
-                self.logger.error(f'      El punt {point_id} esta buit')
-        # Check if the geometry is valid
-        is_valid = self.punt_line_gdf.is_valid
-        invalid_features = self.punt_line_gdf[~is_valid]
-        if not invalid_features.empty:
-            for index, feature in invalid_features.iterrows():
-                point_id = feature['ID_PUNT']
-                self.logger.error(f'      El punt {point_id} no te una geometria valida')
+        geometry_valid = True
+        for points in self.iter_layer_chunks('Punt'):
+            # Check if there are empty features
+            is_empty = points.is_empty
+            empty_features = points[is_empty]
+            if not empty_features.empty:
+                for index, feature in empty_features.iterrows():
+                    point_id = feature['ID_PUNT']
+                    self.logger.error(f'      El punt {point_id} esta buit')
+            # Check if the geometry is valid
+            is_valid = points.is_valid
+            invalid_features = points[~is_valid]
+            if not invalid_features.empty:
+                for index, feature in invalid_features.iterrows():
+                    point_id = feature['ID_PUNT']
+                    self.logger.error(f'      El punt {point_id} no te una geometria valida')
+
+            if not empty_features.empty or not invalid_features.empty:
+                geometry_valid = False
 
-        if empty_features.empty and invalid_features.empty:
+        if geometry_valid:
             self.logger.info("      No s'ha detectat cap error de geometria a la capa Punt")
 
+    def get_tram_vertex_arrays(self):
+        """
+        Pull the coordinates of every line tram into contiguous arrays, in order to check them in a vectorised way.
+        Multi-part trams are split into their parts, so a segment never joins two different parts.
+        :return: vertex_arrays - Dict with the following arrays:
+                    coords -> (n, 2) array with the coordinates of all the vertexs
+                    vertex_part -> array with the part that every vertex belongs to
+                    vertex_index -> array with the index of every vertex inside its tram
+                    part_tram -> array with the tram's position that every part belongs to
+        """
+        coords_list, part_tram, part_start_index = [], [], []
+        for tram_pos, geom in self.iter_tram_geometries():
+            if geom is None or geom.is_empty:
+                continue
+            parts = geom.geoms if geom.geom_type == 'MultiLineString' else [geom]
+            tram_n_vertex = 0
+            for part in parts:
+                part_coords = np.asarray(part.coords, dtype=float)[:, :2]
+                coords_list.append(part_coords)
+                part_tram.append(tram_pos)
+                part_start_index.append(tram_n_vertex)
+                tram_n_vertex += part_coords.shape[0]
+
+        if not coords_list:
+            coords = np.empty((0, 2), dtype=float)
+            part_lengths = np.empty(0, dtype=int)
+        else:
+            coords = np.ascontiguousarray(np.concatenate(coords_list))
+            part_lengths = np.array([c.shape[0] for c in coords_list], dtype=int)
+        part_offsets = np.concatenate(([0], np.cumsum(part_lengths)))
+        vertex_part = np.repeat(np.arange(part_lengths.size), part_lengths)
+        part_start_index = np.array(part_start_index, dtype=int)
+        vertex_index = np.arange(coords.shape[0]) - part_offsets[vertex_part] + part_start_index[vertex_part]
+
+        return {
+            'coords': coords,
+            'vertex_part': vertex_part,
+            'vertex_index': vertex_index,
+            'part_tram': np.array(part_tram, dtype=int)
+        }
+
+    def get_tram_id(self, tram_pos):
+        """
+        Get the tram ID from its position in the line layer
+        :param tram_pos: position of the tram in the line layer
+        :return: tram_id - ID of the tram
+        """
+        tram_id_field = 'ID' if self.line_type == 'mtt' else 'ID_TRAM'
+        return self.tram_attributes[tram_id_field].iloc[tram_pos]
+
     def info_vertex_line(self):
-        """Get info and make a recount of the line's vertexs"""
-        self.logger.info('Obtenint relacio de vertex per tram de linia...')
+        """Get info and make a recount of the line's vertexs and their density"""
+        self.logger.info('Obtenint relacio de vertex per tram de linia...', extra={'check': 'tram_vertexs'})
         # TODO sort by tram ID
-        for index, feature in self.tram_line_layer.iterrows():
-            tram_id = feature['ID']
-            tram_vertexs = len(feature['geometry'].coords)  # Nº of vertexs that compose the tram
-            self.logger.info(f"   Tram ID: {tram_id}   Nº vertex: {tram_vertexs}")
+        coords = self.tram_vertex_arrays['coords']
+        vertex_part = self.tram_vertex_arrays['vertex_part']
+        vertex_tram = self.tram_vertex_arrays['part_tram'][vertex_part]
+        n_trams = self.tram_attributes.shape[0]
+        # Length of every segment, without the segments that join two different parts
+        same_part = vertex_part[1:] == vertex_part[:-1]
+        segment_lengths = np.hypot(*(coords[1:] - coords[:-1]).T) * same_part
+        # Recount of vertexs and length by tram
+        tram_vertexs = np.bincount(vertex_tram, minlength=n_trams)
+        tram_lengths = np.bincount(vertex_tram[:-1], weights=segment_lengths, minlength=n_trams)
+        for tram_pos in range(n_trams):
+            tram_id = self.tram_attributes['ID'].iloc[tram_pos]
+            n_vertexs = tram_vertexs[tram_pos]  # Nº of vertexs that compose the tram
+            self.logger.info(f"   Tram ID: {tram_id}   Nº vertex: {n_vertexs}")
+            if tram_lengths[tram_pos] > 0:
+                density = n_vertexs / (tram_lengths[tram_pos] / 1000)
+                if density > MAX_VERTEX_DENSITY:
+                    self.logger.error(f"   El tram {tram_id} te una densitat de {density:.0f} vertex/km, superior al "
+                                      f"maxim de {MAX_VERTEX_DENSITY} vertex/km")
+
+    def check_tram_segments(self):
+        """
+        Check the line's segments in a vectorised way, like:
+            - Repeated vertexs, as known as zero length segments
+            - Segments shorter than the minimum length
+            - Spikes, as known as vertexs with a very sharp angle where the line goes back over itself
+        """
+        self.logger.info('Validant els segments dels trams de linia...', extra={'check': 'tram_segments'})
+        coords = self.tram_vertex_arrays['coords']
+        vertex_part = self.tram_vertex_arrays['vertex_part']
+        vertex_index = self.tram_vertex_arrays['vertex_index']
+        vertex_tram = self.tram_vertex_arrays['part_tram'][vertex_part]
+        if coords.shape[0] < 2:
+            self.logger.info("   No hi ha segments a validar")
+            return
+        # Segment i goes from the vertex i to the vertex i + 1. Avoid the segments that join two different parts
+        segments = coords[1:] - coords[:-1]
+        segment_lengths = np.hypot(segments[:, 0], segments[:, 1])
+        same_part = vertex_part[1:] == vertex_part[:-1]
+        # Repeated vertexs
+        zero_segments = same_part & (segment_lengths < ZERO_SEGMENT_LENGTH)
+        # Tiny segments
+        tiny_segments = same_part & ~zero_segments & (segment_lengths < MIN_SEGMENT_LENGTH)
+        # Spikes. The angle at vertex i + 1 is the one between the segments i and i + 1, avoiding the ones that are
+        # part of a repeated vertex, because they don't have a direction
+        valid_segments = same_part & ~zero_segments
+        both_valid = valid_segments[:-1] & valid_segments[1:]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cos_angle = -np.einsum('ij,ij->i', segments[:-1], segments[1:]) / (segment_lengths[:-1] * segment_lengths[1:])
+        angles = np.degrees(np.arccos(np.clip(np.nan_to_num(cos_angle, nan=1.0), -1, 1)))
+        spikes = both_valid & (angles < SPIKE_MAX_ANGLE)
+
+        # Report
+        zero_idx = np.flatnonzero(zero_segments)
+        self.report_segment_errors(zero_idx, vertex_tram,
+                                   lambda tram_id, i: f"   El tram {tram_id} te el vertex {vertex_index[i + 1]} "
+                                                      f"repetit (vertex {vertex_index[i]})")
+        tiny_idx = np.flatnonzero(tiny_segments)
+        self.report_segment_errors(tiny_idx, vertex_tram,
+                                   lambda tram_id, i: f"   El tram {tram_id} te un segment de {segment_lengths[i]:.3f} m "
+                                                      f"entre els vertex {vertex_index[i]} i {vertex_index[i + 1]}")
+        spike_idx = np.flatnonzero(spikes) + 1   # Index of the vertex where the spike is
+        self.report_segment_errors(spike_idx, vertex_tram,
+                                   lambda tram_id, i: f"   El tram {tram_id} te una punxa de {angles[i - 1]:.1f} graus "
+                                                      f"al vertex {vertex_index[i]}")
+
+        if zero_idx.size == 0 and tiny_idx.size == 0 and spike_idx.size == 0:
+            self.logger.info("   No s'ha detectat cap vertex repetit, segment curt o punxa als trams de la linia")
+
+    def report_segment_errors(self, error_idx, vertex_tram, message):
+        """
+        Log the segment errors, limiting the number of reports in order to avoid flooding the log
+        :param error_idx: array with the index of the vertexs with errors
+        :param vertex_tram: array with the tram's position that every vertex belongs to
+        :param message: function that returns the error message from the tram ID and the error index
+        """
+        for i in error_idx[:MAX_SEGMENT_REPORTS]:
+            tram_id = self.get_tram_id(vertex_tram[i])
+            self.logger.error(message(tram_id, i))
+        if error_idx.size > MAX_SEGMENT_REPORTS:
+            self.logger.error(f"   ... i {error_idx.size - MAX_SEGMENT_REPORTS} errors mes del mateix tipus")
 
     def check_points_decimals(self):
         """Check if the points's decimals are correct and are rounded to 1 decimal"""
         decim_valid = True
-        for index, feature in self.punt_line_gdf.iterrows():
-            # Point parameters
-            '''
-            Due the add respone function converts all the logger's messages into a JSON splitting the reports by "-"
-            is mandatory to avoid using that character in the reports in order to don't lose data adding the messages
-            to the JSON.
-            '''
-            if feature['ID_PUNT'] in self.ppf_list:  # Check if the point is a ppf point
-                point_num = feature['ETIQUETA'].split('-')[-1]
-                point_id = feature['ID_PUNT'].split('-')[-1]
-                point_x = feature['geometry'].x
-                point_y = feature['geometry'].y
-                # Check if rounded correctly
-                dif_x = abs(point_x - round(point_x, 1))
-                dif_y = abs(point_y - round(point_y, 1))
-                if dif_x > 0.01 or dif_y > 0.01:
-                    decim_valid = False
-                    self.logger.error(
-                        f"   La fita {point_num} amb ID_PUNT {point_id} no esta correctament decimetritzada")
+        for points in self.iter_layer_chunks('Punt'):
+            for index, feature in points.iterrows():
+                # Point parameters
+                '''
+                Due the add respone function converts all the logger's messages into a JSON splitting the reports by "-"
+                is mandatory to avoid using that character in the reports in order to don't lose data adding the messages
+                to the JSON.
+                '''
+                if feature['ID_PUNT'] in self.ppf_list:  # Check if the point is a ppf point
+                    point_num = feature['ETIQUETA'].split('-')[-1]
+                    point_id = feature['ID_PUNT'].split('-')[-1]
+                    point_x = feature['geometry'].x
+                    point_y = feature['geometry'].y
+                    # Check if rounded correctly
+                    dif_x = abs(point_x - round(point_x, 1))
+                    dif_y = abs(point_y - round(point_y, 1))
+                    if dif_x > 0.01 or dif_y > 0.01:
+                        decim_valid = False
+                        self.logger.error(
+                            f"   La fita {point_num} amb ID_PUNT {point_id} no esta correctament decimetritzada")
 
         if decim_valid:
             self.logger.info('   Les fites estan correctament decimetritzades')
@@ -643,7 +1276,7 @@ class CheckQualityLine(View):
             - Check that the field ORDPF is not NULL
             - Check that an auxiliary point is not indicated as a real point
         """
-        self.logger.info('Obtenint informacio de les fites proposta...')
+        self.logger.info('Obtenint informacio de les fites proposta...', extra={'check': 'p_proposta'})
         # Count the points in the table P_Proposta depending on the point's type
         self.count_points()
         # Check that ORDPF is not null
@@ -655,20 +1288,17 @@ class CheckQualityLine(View):
 
     def count_points(self):
         """Count the points in the table P_Proposta and distinguish them depending on its type"""
-        # Not final points
-        # PFF = 0
-        not_ppf = self.p_proposta_df['PFF'] == 0
-        not_final_points = self.p_proposta_df[not_ppf]
-        n_not_final_points = not_final_points.shape[0]
-        # Real points
-        # PFF = 1 AND ESFITA = 1
-        proposta_points = self.p_proposta_df.loc[(self.p_proposta_df['PFF'] == 1) & (self.p_proposta_df['ESFITA'] == 1)]
-        n_proposta_points = proposta_points.shape[0]
-        # Auxiliary points
-        # PFF = 1 AND ESFITA = 0
-        auxiliary_points = self.p_proposta_df.loc[
-            (self.p_proposta_df['PFF'] == 1) & (self.p_proposta_df['ESFITA'] == 0)]
-        n_auxiliary_points = auxiliary_points.shape[0]
+        n_not_final_points, n_proposta_points, n_auxiliary_points = 0, 0, 0
+        for p_proposta in self.iter_layer_chunks('P_Proposta'):
+            # Not final points
+            # PFF = 0
+            n_not_final_points += int((p_proposta['PFF'] == 0).sum())
+            # Real points
+            # PFF = 1 AND ESFITA = 1
+            n_proposta_points += int(((p_proposta['PFF'] == 1) & (p_proposta['ESFITA'] == 1)).sum())
+            # Auxiliary points
+            # PFF = 1 AND ESFITA = 0
+            n_auxiliary_points += int(((p_proposta['PFF'] == 1) & (p_proposta['ESFITA'] == 0)).sum())
 
         self.logger.info(f'   Fites PPF reals: {n_proposta_points}')
         self.logger.info(f'   Fites PPF auxiliars: {n_auxiliary_points}')
@@ -680,14 +1310,15 @@ class CheckQualityLine(View):
         :return valid - Boolean that means if the ORDPF field is OK
         """
         valid = True
-        ordpf_null = self.p_proposta_df['ORDPF'].isnull()
-        points_ordpf_null = self.p_proposta_df[ordpf_null]
+        for p_proposta in self.iter_layer_chunks('P_Proposta'):
+            ordpf_null = p_proposta['ORDPF'].isnull()
+            points_ordpf_null = p_proposta[ordpf_null]
 
-        if not points_ordpf_null.empty:
-            valid = False
-            for index, feature in points_ordpf_null.iterrows():
-                point_id = feature['ID_PUNT'].split('-')[-1]
-                self.logger.error(f"   El camp ORDPF del punt {point_id} a la taula P_PROPOSTA es nul")
+            if not points_ordpf_null.empty:
+                valid = False
+                for index, feature in points_ordpf_null.iterrows():
+                    point_id = feature['ID_PUNT'].split('-')[-1]
+                    self.logger.error(f"   El camp ORDPF del punt {point_id} a la taula P_PROPOSTA es nul")
 
         return valid
 
@@ -695,17 +1326,17 @@ class CheckQualityLine(View):
         """Check that an auxiliary point is not indicated as a real point"""
         # If PPF = 1 and ORDPF = 0 => ESFITA MUST BE 0
         valid = True
-        bad_auxiliary_points = self.p_proposta_df.loc[(self.p_proposta_df['PFF'] == 1) &
-                                                      (self.p_proposta_df['ORDPF'] == 0) &
-                                                      (self.p_proposta_df['ESFITA'] != 0)]
-
-        if not bad_auxiliary_points.empty:
-            valid = False
-            for index, feature in bad_auxiliary_points.iterrows():
-                point_id = feature['ID_PUNT'].split('-')[-1]
-                self.logger.error(
-                    f"   El punt amb ID PUNT : {point_id} està mal indicat a P_Proposta: sembla que es tracta "
-                    f"d'una fita auxiliar indicada com a fita real.")
+        for p_proposta in self.iter_layer_chunks('P_Proposta'):
+            bad_auxiliary_points = p_proposta.loc[(p_proposta['PFF'] == 1) & (p_proposta['ORDPF'] == 0) &
+                                                  (p_proposta['ESFITA'] != 0)]
+
+            if not bad_auxiliary_points.empty:
+                valid = False
+                for index, feature in bad_auxiliary_points.iterrows():
+                    point_id = feature['ID_PUNT'].split('-')[-1]
+                    self.logger.error(
+                        f"   El punt amb ID PUNT : {point_id} està mal indicat a P_Proposta: sembla que es tracta "
+                        f"d'una fita auxiliar indicada com a fita real.")
 
         return valid
 
@@ -716,20 +1347,24 @@ class CheckQualityLine(View):
             - The photography exists in its folder
             - If the point has Z coordinate must be found point
         """
-        self.logger.info("Validant el contingut de la capa de fites...")
+        self.logger.info("Validant el contingut de la capa de fites...", extra={'check': 'points'})
         # Check that the point has a photography indicated
         self.check_photo_exists()
         # Check that the photography exists in the photo's folder
         self.check_photo_name()
         # Check that if the point has Z coordinate is a found point
         self.check_cota_fita()
+        # Check that the found points' Z coordinate agrees with the terrain
+        self.check_fites_elevation()
 
     def check_photo_exists(self):
         """Check that a found point has a photography"""
         # Get a list of points with photography
-        photo_exists = self.punt_line_gdf['FOTOS'].notnull()
-        points_with_photo = self.punt_line_gdf[photo_exists]
-        points_with_photo_list = points_with_photo['ID_PUNT'].to_list()
+        points_with_photo_list = []
+        for points in self.iter_layer_chunks('Punt'):
+            photo_exists = points['FOTOS'].notnull()
+            points_with_photo = points[photo_exists]
+            points_with_photo_list += points_with_photo['ID_PUNT'].to_list()
 
         points_with_photo_checklist = []
         if self.line_type == 'mtt':
@@ -760,14 +1395,15 @@ class CheckQualityLine(View):
                                    os.path.isfile(os.path.join(self.photo_folder, f)) and
                                    (f.endswith(".jpg") or f.endswith(".JPG"))]
         # Get a list with the photographies's filename, from PPF if the line is official
-        photo_exists = self.punt_line_gdf['FOTOS'].notnull()
-        points_with_photo = self.punt_line_gdf[photo_exists]
         found_points_photos = []
-        if self.line_type == 'mtt':
-            found_points_photos = [feature['FOTOS'] for index, feature in points_with_photo.iterrows() if
-                                   feature['ID_PUNT'] in self.ppf_list]
-        elif self.line_type == 'rep':
-            found_points_photos = [feature['FOTOS'] for index, feature in points_with_photo.iterrows()]
+        for points in self.iter_layer_chunks('Punt'):
+            photo_exists = points['FOTOS'].notnull()
+            points_with_photo = points[photo_exists]
+            if self.line_type == 'mtt':
+                found_points_photos += [feature['FOTOS'] for index, feature in points_with_photo.iterrows() if
+                                        feature['ID_PUNT'] in self.ppf_list]
+            elif self.line_type == 'rep':
+                found_points_photos += [feature['FOTOS'] for index, feature in points_with_photo.iterrows()]
         # Check that the photography in the point layer has the same filename as the photography into the folder
         photos_valid = True
         for photo_filename in found_points_photos:
@@ -782,17 +1418,18 @@ class CheckQualityLine(View):
         """Check that a point with Z coordinate is found"""
         # Get a list with the PPF that have Z coordinate
         points_z_dict = {}
-        for index, feature in self.punt_line_gdf.iterrows():
-            etiqueta = feature['ETIQUETA']
-            point_id = feature['ID_PUNT']
-            z_coord = feature['geometry'].z
-            if z_coord > 0 and point_id in self.found_points_dict.values():
-                points_z_dict[etiqueta] = point_id
-            elif z_coord == 0 and point_id in self.found_points_dict.values():
-                etiqueta = etiqueta.split('-')[-1]
-                point_id = point_id.split('-')[-1]
-                # TODO check if the point has an auxiliary point with z coordinate
-                self.logger.error(f'   La F {etiqueta} amb ID PUNT {point_id} es trobada pero no te coordenada Z')
+        for points in self.iter_layer_chunks('Punt'):
+            for index, feature in points.iterrows():
+                etiqueta = feature['ETIQUETA']
+                point_id = feature['ID_PUNT']
+                z_coord = feature['geometry'].z
+                if z_coord > 0 and point_id in self.found_points_dict.values():
+                    points_z_dict[etiqueta] = point_id
+                elif z_coord == 0 and point_id in self.found_points_dict.values():
+                    etiqueta = etiqueta.split('-')[-1]
+                    point_id = point_id.split('-')[-1]
+                    # TODO check if the point has an auxiliary point with z coordinate
+                    self.logger.error(f'   La F {etiqueta} amb ID PUNT {point_id} es trobada pero no te coordenada Z')
 
         z_coord_valid = True
         for etiqueta, point_id in points_z_dict.items():
@@ -805,86 +1442,156 @@ class CheckQualityLine(View):
         if z_coord_valid:
             self.logger.info('   Totes les fites amb coordenada Z son trobades')
 
+    def check_fites_elevation(self):
+        """
+        Check that the Z coordinate of the found points doesn't deviate from the terrain more than DEM_MAX_DIFFERENCE.
+        The points are transformed to the DEM's CRS if it isn't the target one, and the DEM is sampled by raster
+        block, reading only the blocks that have any point, so the points far apart don't read the whole raster
+        """
+        if not DEM_PATH or not path.exists(DEM_PATH):
+            self.logger.info("   No s'ha configurat cap MDT, no es valida la cota de les fites trobades")
+            return
+
+        # Get the found points with Z coordinate
+        found_points = set(self.found_points_dict.values())
+        etiquetes, coords = [], []
+        for points in self.iter_layer_chunks('Punt'):
+            points = points[points['ID_PUNT'].isin(found_points)]
+            for id_punt, etiqueta, geom in zip(points['ID_PUNT'], points['ETIQUETA'], points['geometry']):
+                if geom is not None and geom.has_z and geom.z > 0:
+                    # The points without ETIQUETA are identified by their ID_PUNT
+                    etiquetes.append(etiqueta.split('-')[-1] if etiqueta else id_punt)
+                    coords.append((geom.x, geom.y, geom.z))
+        if not coords:
+            return
+        coords = np.array(coords)
+
+        dem = gdal.Open(DEM_PATH)
+        if dem is None:
+            self.logger.warning(f"   No s'ha pogut obrir el MDT {DEM_PATH}")
+            return
+        dem_epsg = get_epsg(dem.GetProjection())
+        if dem_epsg is None:
+            self.logger.warning(f"   No es reconeix el sistema de referència del MDT {DEM_PATH}, no es valida la cota "
+                                f"de les fites trobades")
+            return
+        # Coordinates of the points in the DEM's CRS
+        dem_x, dem_y = coords[:, 0], coords[:, 1]
+        if dem_epsg != TARGET_EPSG:
+            dem_x, dem_y = get_transformer(TARGET_EPSG, dem_epsg).transform(dem_x, dem_y)
+            dem_x, dem_y = np.asarray(dem_x), np.asarray(dem_y)
+        band = dem.GetRasterBand(1)
+        # Convert the points' coordinates to pixel positions
+        inv_geotransform = gdal.InvGeoTransform(dem.GetGeoTransform())
+        cols = np.floor(inv_geotransform[0] + inv_geotransform[1] * dem_x + inv_geotransform[2] * dem_y).astype(int)
+        rows = np.floor(inv_geotransform[3] + inv_geotransform[4] * dem_x + inv_geotransform[5] * dem_y).astype(int)
+        inside = (cols >= 0) & (cols < dem.RasterXSize) & (rows >= 0) & (rows < dem.RasterYSize)
+        if not inside.any():
+            self.logger.warning("   Les fites trobades queden fora de l'extensió del MDT")
+            return
+        # Read every raster block that has any point only once
+        block_width, block_height = band.GetBlockSize()
+        blocks = {}
+        for pos in np.flatnonzero(inside):
+            blocks.setdefault((rows[pos] // block_height, cols[pos] // block_width), []).append(pos)
+        terrain_z = np.full(coords.shape[0], np.nan)
+        for (block_row, block_col), positions in blocks.items():
+            row_off, col_off = int(block_row * block_height), int(block_col * block_width)
+            window = band.ReadAsArray(col_off, row_off, min(block_width, dem.RasterXSize - col_off),
+                                      min(block_height, dem.RasterYSize - row_off))
+            terrain_z[positions] = window[rows[positions] - row_off, cols[positions] - col_off]
+        nodata = band.GetNoDataValue()
+        if nodata is not None:
+            terrain_z[terrain_z == nodata] = np.nan
+        dem = None
+
+        elevation_valid = True
+        differences = np.abs(coords[:, 2] - terrain_z)
+        for pos in np.flatnonzero(differences > DEM_MAX_DIFFERENCE):
+            elevation_valid = False
+            self.logger.error(f'   La F {etiquetes[pos]} te una cota de {coords[pos, 2]:.2f} m que difereix '
+                              f'{differences[pos]:.2f} m del terreny')
+        n_no_terrain = int(np.isnan(terrain_z).sum())
+        if n_no_terrain:
+            self.logger.warning(f'   {n_no_terrain} fites trobades no tenen cota del terreny al MDT')
+        if elevation_valid:
+            self.logger.info(f'   La cota de les fites trobades no difereix més de {DEM_MAX_DIFFERENCE} m del terreny')
+
     def check_3termes(self):
         """Check 3 terms points"""
         self.logger.info("   Validant el contacte de les fites tres termes...")
-        # Get df with points sorted by etiqueta, firstly creating a new sorting column that containts the numbers
-        # from the ETIQUETA field as integers, in order to correctly sort the point numbers
-        sorted_points_df_temp = self.punt_line_gdf
-        etiquetes = sorted_points_df_temp['ETIQUETA'].tolist()
-        etiquetes_int = []
+        # Get the number from the ETIQUETA field as integer and the CONTACTE field of every point, PPF if the line is
+        # official, in order to correctly sort the point numbers
+        sorting_points = []
+        n_indicated_3t_points = 0
         # TODO solo ordenar las fitas que tengan 'F' en su etiqueta, o sea, que sean fitas reales
-        for i in etiquetes:
-            if i is None:
-                i = ''
-            point_num = re.search(r'\d+', i)
-            if point_num:
-                point_num = int(point_num.group())
-            etiquetes_int.append(point_num)
-        # Add sorting column
-        sorted_points_df_temp['sorting'] = etiquetes_int
-        # Sort by the new column
-        sorted_points_df = sorted_points_df_temp.sort_values(by=['sorting'])
-        # Filter by PPF points if official
-        if self.line_type == 'mtt':
-            ppf_point = sorted_points_df['ID_PUNT'].isin(self.ppf_list)
-            sorted_points_df = sorted_points_df[ppf_point]
-            if sorted_points_df.empty:
+        for points in self.iter_layer_chunks('Punt'):
+            # Recount how many points have the CONTACTE field not empty
+            n_indicated_3t_points += int(points['CONTACTE'].notnull().sum())
+            if self.line_type == 'mtt':
+                points = points[points['ID_PUNT'].isin(self.ppf_list)]
+            for etiqueta, contacte in zip(points['ETIQUETA'], points['CONTACTE']):
+                point_num = re.search(r'\d+', etiqueta or '')
+                sorting_points.append((int(point_num.group()) if point_num else None, contacte))
+        if not sorting_points:
+            if self.line_type == 'mtt':
                 self.logger.error("   No hi ha punts indicats com Proposta.")
-                return
-        # Get a list with the contact field from both first and last point
-        first_point = sorted_points_df.iloc[0]
-        last_point = sorted_points_df.iloc[-1]
-        if first_point['CONTACTE'] and last_point['CONTACTE']:
+            return
+        # Sort by the point number. The points without number are sorted at the end
+        sorting_points.sort(key=lambda point: (point[0] is None, point[0] or 0))
+        # Get the contact field from both first and last point
+        first_contacte, last_contacte = sorting_points[0][1], sorting_points[-1][1]
+        if first_contacte and last_contacte:
             self.logger.info('      Les fites 3 termes tenen informat el camp CONTACTE')
         else:
             self.logger.error('      Hi ha fites 3 termes que no tenen informat el camp CONTACTE')
 
-        # Recount how many points have the CONTACTE field not empty
-        indicated_3t_points = self.punt_line_gdf[self.punt_line_gdf['CONTACTE'].notnull()]
-        n_indicated_3t_points = indicated_3t_points.shape[0]
         self.logger.info(f'      Hi ha un total de {n_indicated_3t_points} fites amb el camp CONTACTE informat')
 
     def check_relation_points_tables(self):
         """Check that all the points that exist in the tables exist in the point layer"""
-        self.logger.info('Validant la correspondencia entre les taules i la capa Punt...')
-        points_id_list = self.punt_line_gdf['ID_PUNT'].tolist()
+        self.logger.info('Validant la correspondencia entre les taules i la capa Punt...', extra={'check': 'points_tables'})
+        points_id_list = set(self.points_coords_dict)
 
         if self.line_type == 'mtt':
             # Check that all the ID_PUNT from P_Proposta exist in the point layer
             p_proposta_valid = True
-            for index, feature in self.p_proposta_df.iterrows():
-                point_id = feature['ID_PUNT']
-                if point_id not in points_id_list:
-                    p_proposta_valid = False
-                    point_id = point_id.split('-')[-1]
-                    self.logger.error(
-                        f'   El registre amb ID PUNT {point_id} de la taula P_PROPOSTA no esta a la capa Punt')
+            for p_proposta in self.iter_layer_chunks('P_Proposta'):
+                for point_id in p_proposta['ID_PUNT']:
+                    if point_id not in points_id_list:
+                        p_proposta_valid = False
+                        point_id = point_id.split('-')[-1]
+                        self.logger.error(
+                            f'   El registre amb ID PUNT {point_id} de la taula P_PROPOSTA no esta a la capa Punt')
             if p_proposta_valid:
                 self.logger.info('   Correspondència OK entre els punts de P_PROPOSTA i Punt')
 
         # Check that all the ID_PUNT from PUNT_FIT exist in the point layer
         punt_fit_valid = True
-        for index_, feature_ in self.punt_fit_df.iterrows():
-            point_id_ = feature_['ID_PUNT']
-            if point_id_ not in points_id_list:
-                punt_fit_valid = False
-                point_id_ = point_id_.split('-')[-1]
-                self.logger.error(f'   El registre amb ID PUNT {point_id_} de la taula PUNT_FIT no esta a la capa Punt')
+        for punt_fit in self.iter_layer_chunks('PUNT_FIT'):
+            for point_id_ in punt_fit['ID_PUNT']:
+                if point_id_ not in points_id_list:
+                    punt_fit_valid = False
+                    point_id_ = point_id_.split('-')[-1]
+                    self.logger.error(f'   El registre amb ID PUNT {point_id_} de la taula PUNT_FIT no esta a la capa Punt')
         if punt_fit_valid:
             self.logger.info('   Correspondencia OK entre els punts de PUNT_FIT i Punt')
 
     def check_topology(self):
         """Check topology"""
-        self.logger.info('Iniciant controls topològics...')
+        self.logger.info('Iniciant controls topològics...', extra={'check': 'topology'})
         # Check that the line doesn't crosses or overlaps itself
         self.check_line_crosses_itself()
+        self.token.check()
         # Check that the line doesn't intersect the db lines
         self.check_line_intersects_db()
         # Check that the line doesn't overlaps the db lines
         self.check_line_overlaps_db()
         # Check that the lines endpoints are equal to any point
         self.check_endpoint_covered_point()
+        self.token.check()
+        # Check that the trams form one continuous chain from 3T to 3T
+        self.check_line_connectivity()
         # Check that if a point is not over a line is because it's an auxiliary point
         # This check is not done for unofficial lines because almost the lines have a lot of control points that
         # are not covered by the line.
@@ -893,97 +1600,245 @@ class CheckQualityLine(View):
     def check_line_crosses_itself(self):
         """
         Check that the line doesn't intersects or touches itself. In order to do that, iterates over
-        every line's geometry and checks if it crosses any of the other lines
+        every line's geometry and checks if it crosses any of the other lines close to it. In streaming mode every
+        chunk of trams is checked against itself and the following chunks, so only two chunks are in memory at once
         """
         valid = True
-        # Check if some tram does self-intersect
-        tram_is_valid = self.tram_line_layer.is_valid
-        invalid_features = self.tram_line_layer[~tram_is_valid]
-        if not invalid_features.empty:
-            valid = False
-            for i, invalid_feature in invalid_features.iterrows():
-                tram_id = invalid_feature['ID']
-                self.logger.error(f"   El tram {tram_id} de la linia s'intersecta o toca a si mateix")
-        # Check if some tram intersects another line's tram
-        for i, tram in self.tram_line_layer.iterrows():
-            line = self.tram_line_layer[self.tram_line_layer['geometry'] != tram['geometry']]
-            # Iterates over the other line's trams to check if the curren tram crosses the others
-            for i_, tram_ in line.iterrows():
-                if tram['geometry'].crosses(tram_['geometry']):
-                    valid = False
-                    tram_id = tram["ID"] if self.line_type == 'mtt' else tram["ID_TRAM"]
-                    self.logger.error(f'   El tram {tram_id} de la linia talla el '
-                                      f'tram {tram_id} de la mateixa linia')
+        chunk_offset = 0
+        for trams in self.iter_layer_chunks(self.tram_line_layer_name):
+            trams = trams.reset_index(drop=True)
+            # Check if some tram does self-intersect
+            tram_is_valid = trams.is_valid
+            invalid_features = trams[~tram_is_valid]
+            if not invalid_features.empty:
+                valid = False
+                for i, invalid_feature in invalid_features.iterrows():
+                    tram_id = invalid_feature['ID']
+                    self.logger.error(f"   El tram {tram_id} de la linia s'intersecta o toca a si mateix")
+            # Check if some tram crosses another line's tram
+            other_offset = 0
+            for other_trams in self.iter_layer_chunks(self.tram_line_layer_name):
+                if other_offset >= chunk_offset:
+                    self.token.check()
+                    if not self.check_trams_cross(trams, chunk_offset, other_trams.reset_index(drop=True),
+                                                  other_offset):
+                        valid = False
+                other_offset += other_trams.shape[0]
+            chunk_offset += trams.shape[0]
         if valid:
             self.logger.info("   Els trams de la linia no s'intersecten o toquen a si mateixos")
 
+    def check_trams_cross(self, trams, offset, other_trams, other_offset):
+        """
+        Check that the trams of a chunk don't cross the trams of another chunk, or of the same one
+        :param trams: geodataframe with a chunk of trams
+        :param offset: position of the chunk's first tram into the line layer
+        :param other_trams: geodataframe with the other chunk of trams
+        :param other_offset: position of the other chunk's first tram into the line layer
+        :return: valid - Boolean that indicates whether no tram crosses another one
+        """
+        valid = True
+        other_sindex = other_trams.sindex if not other_trams.empty else None
+        if other_sindex is None:
+            return valid
+        for tram_pos, geom in enumerate(trams['geometry']):
+            if geom is None or geom.is_empty:
+                continue
+            for other_pos in sorted(other_sindex.intersection(geom.bounds)):
+                # Every pair of trams is checked only once
+                if other_offset + other_pos <= offset + tram_pos:
+                    continue
+                if geom.crosses(other_trams['geometry'].iloc[other_pos]):
+                    valid = False
+                    tram_id = self.get_tram_id(offset + tram_pos)
+                    other_tram_id = self.get_tram_id(other_offset + other_pos)
+                    self.logger.error(f'   El tram {tram_id} de la linia talla el '
+                                      f'tram {other_tram_id} de la mateixa linia')
+
+        return valid
+
     def check_line_intersects_db(self):
         """Check that the line doesn't intersects or crosses the database lines"""
-        db_line_layer = self.tram_line_mem_gdf if self.line_type == 'mtt' else self.tram_line_rep_gdf
-        features_intersects_db = gpd.sjoin(self.tram_line_layer, db_line_layer, op='contains')
-        if not features_intersects_db.empty:
+        valid = True
+        for trams in self.iter_layer_chunks(self.tram_line_layer_name):
+            features_intersects_db = gpd.sjoin(trams, self.db_line_layer, op='contains')
             for index, feature in features_intersects_db.iterrows():
+                valid = False
                 self.logger.error(f"   El tram {feature['ID']} de la linia talla algun tram de la base de dades")
-        else:
+        if valid:
             self.logger.info('   Els trams de la linia no intersecten cap tram de la base de dades')
 
     def check_line_overlaps_db(self):
         """Check that the line doesn't overlaps the database lines"""
-        db_line_layer = self.tram_line_mem_gdf if self.line_type == 'mtt' else self.tram_line_rep_gdf
-        features_overlaps_db = gpd.sjoin(self.tram_line_layer, db_line_layer, op='contains')
-        if not features_overlaps_db.empty:
+        valid = True
+        for trams in self.iter_layer_chunks(self.tram_line_layer_name):
+            features_overlaps_db = gpd.sjoin(trams, self.db_line_layer, op='contains')
             for index, feature in features_overlaps_db.iterrows():
+                valid = False
                 self.logger.error(f"   El tram {feature['ID']} de la linia es sobreposa a algun tram de la base de dades")
-        else:
+        if valid:
             self.logger.info('   Els trams de la linia no es sobreposen a cap tram de la base de dades')
 
     def check_endpoint_covered_point(self):
         """Check that the coordinates of the lines endpoints are equal to any point"""
         # Check if the lines endpoints coordinates are equal to any point
         endpoint_covered = True
-        for index, feature in self.tram_line_layer.iterrows():
-            tram_id = feature['ID'] if self.line_type == 'mtt' else feature['ID_TRAM']
-            # Get endpoints coordinates
-            first_endpoint_no_rounded = feature['geometry'].coords[0]
-            last_endpoint_no_rounded = feature['geometry'].coords[-1]
-            # Rount them if the line is official
-            first_endpoint, last_endpoint = None, None
-            if self.line_type == 'mtt':
-                first_endpoint = (round(first_endpoint_no_rounded[0], 1), round(first_endpoint_no_rounded[1], 1))
-                last_endpoint = (round(last_endpoint_no_rounded[0], 1), round(last_endpoint_no_rounded[1], 1))
-            elif self.line_type == 'rep':
-                first_endpoint = first_endpoint_no_rounded
-                last_endpoint = last_endpoint_no_rounded
+        points_coords = set(self.points_coords_dict.values())
+        for trams in self.iter_layer_chunks(self.tram_line_layer_name):
+            for index, feature in trams.iterrows():
+                tram_id = feature['ID'] if self.line_type == 'mtt' else feature['ID_TRAM']
+                # Get endpoints coordinates
+                first_endpoint_no_rounded = feature['geometry'].coords[0]
+                last_endpoint_no_rounded = feature['geometry'].coords[-1]
+                # Rount them if the line is official
+                first_endpoint, last_endpoint = None, None
+                if self.line_type == 'mtt':
+                    first_endpoint = (round(first_endpoint_no_rounded[0], 1), round(first_endpoint_no_rounded[1], 1))
+                    last_endpoint = (round(last_endpoint_no_rounded[0], 1), round(last_endpoint_no_rounded[1], 1))
+                elif self.line_type == 'rep':
+                    first_endpoint = first_endpoint_no_rounded
+                    last_endpoint = last_endpoint_no_rounded
 
-            if (first_endpoint or last_endpoint) not in self.points_coords_dict.values():
-                endpoint_covered = False
-                self.logger.error(f'   Algun dels punts finals del tram {tram_id} no coincideixen amb una fita de la capa Punt')
+                if (first_endpoint or last_endpoint) not in points_coords:
+                    endpoint_covered = False
+                    self.logger.error(f'   Algun dels punts finals del tram {tram_id} no coincideixen amb una fita de la capa Punt')
 
         if endpoint_covered:
             self.logger.info('   Tots els punts finals dels trams de la linia coincideixen amb una fita de la capa Punt')
 
+    def check_line_connectivity(self):
+        """
+        Check that the line's trams form one continuous chain from 3T to 3T. In order to do that, builds a graph
+        whose nodes are the trams' endpoints, hashed by their coordinates, and whose edges are the trams. Also checks
+        that every tram's endpoints are the fites indicated in its ID_FITA1 and ID_FITA2 fields
+        """
+        self.logger.info('   Validant la connectivitat dels trams de la linia...')
+        decimals = 1 if self.line_type == 'mtt' else 3
+        valid = True
+
+        # Build the graph
+        nodes = {}   # Endpoint coordinates -> node
+        edges = []   # Tram position, first node, last node
+        for tram_pos, geom in self.iter_tram_geometries():
+            if geom is None or geom.is_empty:
+                continue
+            parts = geom.geoms if geom.geom_type == 'MultiLineString' else [geom]
+            first_endpoint, last_endpoint = parts[0].coords[0], parts[-1].coords[-1]
+            edge_nodes = []
+            for endpoint in first_endpoint, last_endpoint:
+                endpoint_key = (round(endpoint[0], decimals), round(endpoint[1], decimals))
+                edge_nodes.append(nodes.setdefault(endpoint_key, len(nodes)))
+            edges.append((tram_pos, edge_nodes[0], edge_nodes[1]))
+        if not edges:
+            self.logger.error('      La linia no te cap tram amb geometria')
+            return
+        node_coords = list(nodes.keys())
+        node_trams = [[] for _ in node_coords]
+        for tram_pos, first_node, last_node in edges:
+            node_trams[first_node].append(tram_pos)
+            node_trams[last_node].append(tram_pos)
+
+        # Connected components and cycles with an union-find structure
+        parent = list(range(len(node_coords)))
+
+        def find(node):
+            while parent[node] != node:
+                parent[node] = parent[parent[node]]
+                node = parent[node]
+            return node
+
+        for tram_pos, first_node, last_node in edges:
+            first_root, last_root = find(first_node), find(last_node)
+            if first_root == last_root:
+                valid = False
+                self.logger.error(f"      El tram {self.get_tram_id(tram_pos)} tanca un cicle a la linia")
+            else:
+                parent[first_root] = last_root
+        n_components = len({find(node) for node in range(len(node_coords))})
+        if n_components > 1:
+            valid = False
+            self.logger.error(f"      Els trams de la linia formen {n_components} cadenes no connectades entre elles")
+
+        # Branches
+        for node, trams in enumerate(node_trams):
+            if len(trams) > 2:
+                valid = False
+                trams_ids = ', '.join(str(self.get_tram_id(tram_pos)) for tram_pos in trams)
+                self.logger.error(f"      Els trams {trams_ids} s'uneixen al mateix punt {node_coords[node]}, "
+                                  f"formant una branca")
+
+        # Gaps and dangling trams. A continuous line only has two free endpoints, the 3T
+        free_nodes = [node for node, trams in enumerate(node_trams) if len(trams) == 1]
+        if len(free_nodes) > 2:
+            valid = False
+            gap_nodes = set()
+            # Only the free endpoints whose bounding box is closer than GAP_MAX_DISTANCE are compared
+            free_sindex = gpd.GeoSeries([Point(node_coords[node]) for node in free_nodes]).sindex
+            for i, node in enumerate(free_nodes):
+                x, y = node_coords[node]
+                candidates = free_sindex.intersection((x - GAP_MAX_DISTANCE, y - GAP_MAX_DISTANCE,
+                                                       x + GAP_MAX_DISTANCE, y + GAP_MAX_DISTANCE))
+                for node_ in [free_nodes[j] for j in sorted(candidates) if j > i]:
+                    distance = np.hypot(x - node_coords[node_][0], y - node_coords[node_][1])
+                    if distance <= GAP_MAX_DISTANCE:
+                        gap_nodes.update((node, node_))
+                        tram_id, tram_id_ = self.get_tram_id(node_trams[node][0]), self.get_tram_id(node_trams[node_][0])
+                        self.logger.error(f"      Hi ha un forat de {distance:.3f} m entre els trams {tram_id} i {tram_id_}")
+            for node in free_nodes:
+                if node not in gap_nodes:
+                    self.logger.error(f"      El tram {self.get_tram_id(node_trams[node][0])} te un extrem penjat "
+                                      f"al punt {node_coords[node]}")
+        # The free endpoints must be 3T points
+        points_3t_coords = set()
+        for points in self.iter_layer_chunks('Punt'):
+            points_3t = points[points['CONTACTE'].notnull()]
+            points_3t_coords.update((round(point.x, decimals), round(point.y, decimals)) for point in points_3t['geometry'])
+        if len(free_nodes) == 2:
+            for node in free_nodes:
+                if node_coords[node] not in points_3t_coords:
+                    valid = False
+                    self.logger.error(f"      L'extrem de la linia al punt {node_coords[node]} no coincideix amb cap "
+                                      f"fita 3 termes")
+
+        # The trams' endpoints must be the fites indicated in ID_FITA1 and ID_FITA2
+        points_coords = {point_id: (round(x, decimals), round(y, decimals))
+                         for point_id, (x, y) in self.points_coords_dict.items()}
+        for tram_pos, first_node, last_node in edges:
+            endpoints = {node_coords[first_node], node_coords[last_node]}
+            for field in 'ID_FITA1', 'ID_FITA2':
+                point_id = self.tram_attributes[field].iloc[tram_pos]
+                if point_id is None or point_id not in points_coords:   # Already reported by other checks
+                    continue
+                if points_coords[point_id] not in endpoints:
+                    valid = False
+                    self.logger.error(f"      Cap extrem del tram {self.get_tram_id(tram_pos)} coincideix amb la fita "
+                                      f"amb ID PUNT {point_id.split('-')[-1]} indicada a {field}")
+
+        if valid:
+            self.logger.info('      Els trams de la linia formen una cadena continua de 3 termes a 3 termes')
+
     def get_point_coordinates(self):
         """
         Get a dict of the points ID and coordinates, and round them to 1 decimal if the line is official
         :return: points_coord_dict - Dict of points coordinates with format (x, y)
         """
-        # Get ID
-        points_id = self.punt_line_gdf['ID_PUNT'].tolist()
-        # Get coordinates
-        x_coords_no_round_list = self.punt_line_gdf['geometry'].x.tolist()
-        y_coords_no_round_list = self.punt_line_gdf['geometry'].y.tolist()
-        # Round the coordinates if the line is official
-        x_coords_list, y_coords_list = None, None
-        if self.line_type == 'mtt':
-            x_coords_list = [round(x, 1) for x in x_coords_no_round_list]
-            y_coords_list = [round(y, 1) for y in y_coords_no_round_list]
-        elif self.line_type == 'rep':
-            x_coords_list = x_coords_no_round_list
-            y_coords_list = y_coords_no_round_list
-        # Get list with the points coordinates
-        points_coord_list = list(zip(x_coords_list, y_coords_list))
-        # Enrich list with the point id and convert to dict
-        points_coord_dict = dict(zip(points_id, points_coord_list))
+        points_coord_dict = {}
+        for points in self.iter_layer_chunks('Punt'):
+            # Get ID
+            points_id = points['ID_PUNT'].tolist()
+            # Get coordinates
+            x_coords_no_round_list = points['geometry'].x.tolist()
+            y_coords_no_round_list = points['geometry'].y.tolist()
+            # Round the coordinates if the line is official
+            x_coords_list, y_coords_list = None, None
+            if self.line_type == 'mtt':
+                x_coords_list = [round(x, 1) for x in x_coords_no_round_list]
+                y_coords_list = [round(y, 1) for y in y_coords_no_round_list]
+            elif self.line_type == 'rep':
+                x_coords_list = x_coords_no_round_list
+                y_coords_list = y_coords_no_round_list
+            # Enrich the points coordinates with the point id
+            points_coord_dict.update(zip(points_id, zip(x_coords_list, y_coords_list)))
 
         return points_coord_dict
 
@@ -991,21 +1846,31 @@ class CheckQualityLine(View):
         """
         Check if a point that is not covered by the line is an auxiliary point
         """
-        # Check if the point is covered by the line
-        for point_id, point_coords in self.points_coords_dict.items():
-            if point_coords not in self.line_coords_list:  # Check if the point coordinates are not covered by the line
-                if point_id in self.ppf_list:  # Check if the point is a ppf point
-                    point = self.punt_fit_df.loc[self.punt_fit_df['ID_PUNT'] == point_id]
-                    aux = point['AUX'].values
-                    if len(aux) < 1:
-                        return
-                    aux = aux[0]
-                    n_fita = point['ID_FITA'].values[0]
-                    point_id = point_id.split('-')[-1]
-                    if aux == '1':
-                        self.logger.info(f'   La fita F {n_fita} amb ID PUNT {point_id} no esta a sobre de la linia pero es auxiliar')
-                    else:
-                        self.logger.error(f'   La fita F {n_fita} amb ID PUNT {point_id} no esta a sobre de la linia i NO es auxiliar')
+        # In streaming mode the line coordinates are only computed when needed
+        if self.line_coords_list is None: self.line_coords_list = self.get_line_coordinates()
+        line_coords = set(self.line_coords_list)
+        ppf = set(self.ppf_list)
+        # Get the ppf points that are not covered by the line
+        not_covered_points = [point_id for point_id, point_coords in self.points_coords_dict.items()
+                              if point_coords not in line_coords and point_id in ppf]
+        if not not_covered_points:
+            return
+        # Get the AUX and ID_FITA fields of the points not covered from PUNT_FIT
+        not_covered_fites = {}
+        for punt_fit in self.iter_layer_chunks('PUNT_FIT'):
+            punt_fit = punt_fit[punt_fit['ID_PUNT'].isin(not_covered_points)]
+            for point_id, aux, n_fita in zip(punt_fit['ID_PUNT'], punt_fit['AUX'], punt_fit['ID_FITA']):
+                not_covered_fites.setdefault(point_id, (aux, n_fita))
+
+        for point_id in not_covered_points:
+            if point_id not in not_covered_fites:
+                return
+            aux, n_fita = not_covered_fites[point_id]
+            point_id = point_id.split('-')[-1]
+            if aux == '1':
+                self.logger.info(f'   La fita F {n_fita} amb ID PUNT {point_id} no esta a sobre de la linia pero es auxiliar')
+            else:
+                self.logger.error(f'   La fita F {n_fita} amb ID PUNT {point_id} no esta a sobre de la linia i NO es auxiliar')
 
     def get_line_coordinates(self):
         """
@@ -1013,8 +1878,7 @@ class CheckQualityLine(View):
         :return: line_coords_list - List with the line's coordinates
         """
         line_coords_no_rounded = []
-        trams = self.tram_line_layer['geometry'].tolist()
-        for t in trams:
+        for tram_pos, t in self.iter_tram_geometries():
             if t is None:
                 self.logger.error(f"   Existeix algun tram sense coordenades. Si us plau, elimina'l")
             else:
@@ -1043,29 +1907,63 @@ class CheckQualityLine(View):
 
     def rm_temp(self):
         """Remove temporal files from the workspace"""
-        gpkg = gdal.OpenEx(WORK_GPKG, gdal.OF_UPDATE, allowed_drivers=['GPKG'])
-        for layer in TEMP_ENTITIES:
-            layer_name = layer.split('.')[0]
-            gpkg.ExecuteSQL(f'DROP TABLE {layer_name}')
+        self.workspace.clear()
 
         self.logger.info('   Arxius temporals esborrats')
 
     def rm_working_directory(self):
-        """Remove temporal local line directory"""
-        shutil.rmtree(self.line_folder)
+        """Remove the line directory copied into the workspace, before the workspace itself is removed"""
+        shutil.rmtree(self.line_folder, ignore_errors=True)
+
+    def start_stage(self, name):
+        """
+        Start a new stage of the pipeline, measuring it and checking that the run has not been cancelled
+        :param name: stage name, from QA_STAGES
+        """
+        self.token.start_stage(name)
+        self.metrics.start_stage(name)
+
+    def create_partial_response(self, cancellation):
+        """
+        Create the response of a run that has been cancelled or has exceeded a time budget, with the reports of
+        the checks done and the list of the checks skipped
+        :param cancellation: PipelineCancelled exception raised
+        :return: response - Dict with the response data
+        """
+        stage = cancellation.stage
+        skipped = QA_STAGES[QA_STAGES.index(stage):] if stage in QA_STAGES else QA_STAGES
+        self.logger.error(f"Control de qualitat interromput a l'etapa {stage} => {cancellation.reason}", extra={'check': 'interrupted'})
+        self.logger.error(f"   Controls no executats: {', '.join(skipped)}")
+        if self.line_folder and path.exists(self.line_folder):
+            self.rm_working_directory()
+        self.response_data['result'] = 'partial'
+        self.response_data['message'] = f'Control de qualitat de la linia {self.line_id} interromput a l\'etapa ' \
+                                        f'{stage}. Informe parcial'
+        self.response_data['skipped'] = list(skipped)
+        response = self.add_response_data()
+        self.report_id = save_report(response)
+        self.save_history(self.report_id)
+
+        return response
 
     def create_error_response(self, message):
         """Create a error JSON for the response data"""
         self.logger.error(message)
         self.response_data['result'] = 'error'
         self.response_data['message'] = message
-        logging.shutdown()
+        self.save_history()
+        self.flush_logger()
 
         return {'response': self.response_data}
 
     def add_response_data(self):
-        """Add the log's reports to the JSON response data"""
+        """
+        Add the log's reports to the JSON response data. Every report is related to the check it belongs to, that is
+        the last report without indentation
+        """
         report_list = []
+        check = ''
+        self.flush_logger()
         with open(self.log_path, 'r') as f:
             reports = f.read().splitlines()  # Avoid reading with newline character
             for report in reports:
@@ -1075,23 +1973,64 @@ class CheckQualityLine(View):
                     report_info = report_split[0]
                 else:
                     report_date, report_level, report_info = report_split[0], report_split[1], report_split[2]
+                    if not report_info.startswith(' '):
+                        check = report_info
                 item = {
                     'level': report_level,
-                    'report_message': report_info
+                    'report_message': report_info,
+                    'check': check
                 }
                 report_list.append(item)
         self.response_data['reports'] = report_list
-        logging.shutdown()
 
         return {'response': self.response_data}
 
+    def save_history(self, report_id=''):
+        """
+        Save the run, the status of every check and the errors reported into the QA history, in order to query
+        them across lines. The checks are saved by their key, and the runs that end with an error save the check
+        that failed too
+        :param report_id: ID of the stored report
+        """
+        try:
+            with transaction.atomic():
+                run = QARun.objects.create(
+                    line_id=int(self.line_id),
+                    line_type=self.line_type,
+                    started_at=self.started_at,
+                    duration=(timezone.now() - self.started_at).total_seconds(),
+                    result=self.response_data.get('result', ''),
+                    message=self.response_data.get('message', ''),
+                    report_id=report_id,
+                    reference_version=self.reference_version or '',
+                    n_trams=self.n_trams,
+                    n_vertexs=self.n_vertexs,
+                    n_points=self.n_points
+                )
+                QACheckResult.objects.bulk_create([
+                    QACheckResult(run=run, check_name=check, n_errors=n_errors,
+                                  status=QACheckResult.ERROR if n_errors else QACheckResult.OK)
+                    for check, n_errors in self.history_handler.checks.items()
+                ])
+                QAErrorRecord.objects.bulk_create([
+                    QAErrorRecord(run=run, check_name=check, level=level, message=message)
+                    for check, level, message in self.history_handler.errors
+                ])
+        except Exception as e:
+            self.logger.warning(f"No s'ha pogut desar el control de qualitat a l'historic => {e}")
+
     def reset_logger(self):
         """
         Reset all the loggers handlers and config in order to avoid maintaining it and modifying the later reports
         """
-        for h in self.logger.handlers:
+        for h in list(self.logger.handlers):
             self.logger.removeHandler(h)
-        logging.shutdown()
+            h.close()
+
+    def flush_logger(self):
+        """Flush the logger's handlers, in order to have all the reports written"""
+        for h in self.logger.handlers:
+            h.flush()
 
 
 def render_qa_page(request):
@@ -1103,11 +2042,48 @@ def render_qa_page(request):
     return render(request, '../templates/qa_page.html')
 
 
+def submit_qa_job(request):
+    """
+    Submit the quality check of a line as a background job and render the page that follows its progress live
+    :param request: Http request
+    :return: Rendering of the progress page
+    """
+    line_id = request.GET.get('line_id')
+    line_type = request.GET.get('line_type')
+    if not line_id or not str(line_id).isdigit():
+        messages.error(request, "L'ID Linia no es vàlid")
+        return redirect("qa-page")
+    job = submit_job(line_id, line_type)
+    return render(request, '../templates/qa_progress.html', {'job_id': job.job_id, 'line_id': line_id})
+
+
 def render_report_page(request):
     """
-    Render the report page with the response created
+    Render the report page with the stored report, paginated and filtered by level and check
     :param request: Http request
     :return: Rendering of the report page
     """
-    response = request.session['response']
-    return render(request, '../templates/qa_reports.html', response)
+    report_id = request.GET.get('report_id') or request.session.get('report_id')
+    response = load_report(report_id)
+    if response is None:
+        messages.error(request, "No s'ha trobat l'informe del control de qualitat")
+        return redirect("qa-page")
+    response = response['response']
+
+    all_reports = response.get('reports', [])
+    level = request.GET.get('level', '')
+    check = request.GET.get('check', '')
+    reports = filter_reports(all_reports, level, check)
+    page = Paginator(reports, REPORT_PAGE_SIZE).get_page(request.GET.get('page'))
+    response['reports'] = page.object_list
+
+    context = {
+        'response': response,
+        'report_id': report_id,
+        'page': page,
+        'level': level,
+        'check': check,
+        'levels': sorted({report['level'] for report in all_reports}),
+        'checks': [check_ for check_ in dict.fromkeys(report.get('check', '') for report in all_reports) if check_]
+    }
+    return render(request, '../templates/qa_reports.html', context)